@@ -0,0 +1,532 @@
+"""
+Offline benchmarks for the crawler
+
+Pages are served by local stand-in HTTP servers, one per host, so no
+request leaves the machine.
+
+Usage: python3 benchmarks.py <name> args...
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.robotparser import RobotFileParser
+from fetcher import Fetcher, robots_delay
+from frontier import Frontier
+from seen import open_seen
+from crawl_log import CrawlLog, CrawlState
+from docstore import DocStore
+from page_record import parse_page
+from near_dup import SimHashIndex, simhash
+from build_adj_matrix import filter_links
+import build_adj_matrix
+import contextlib
+from bs4 import BeautifulSoup
+from urllib.parse import urljoin
+from multiprocessing import Process, Queue
+import os
+import pickle
+import random
+import requests
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import sys
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves /robots.txt and HTML pages /page/<i> that link to the next pages
+        of the same host, after waiting server.latency seconds
+
+    Page i is at version server.versions.get(i, 0), sent with a matching ETag,
+        and a request whose If-None-Match names the current version gets a 304
+    """
+
+    def do_GET(self):
+        server = self.server
+        headers = {}
+        if self.path == '/robots.txt':
+            body = f'User-agent: *\nCrawl-delay: {server.delay}\nDisallow: /private\n'
+            content_type = 'text/plain'
+        elif self.path.startswith('/page/'):
+            time.sleep(server.latency)
+            i = int(self.path[len('/page/'):])
+            version = getattr(server, 'versions', {}).get(i, 0)
+            headers['ETag'] = f'"{i}-{version}"'
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                self.send_response(304)
+                self.send_header('ETag', headers['ETag'])
+                self.end_headers()
+                return
+            links = ''.join(f'<a href="/page/{j}">page {j}</a>' for j in range(i + 1, i + 4))
+            body = (f'<html><head><title>Page {i}</title></head><body><p>Page {i} of {server.name}</p>'
+                f'<p>{"Updated " * version}{"filler " * getattr(server, "filler", 0)}</p>{links}</body></html>')
+            content_type = 'text/html; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_hosts(n, delay=1, latency=0.05):
+    """
+    Starts n stub servers on local ports, each asking for a Crawl-delay of delay seconds
+
+    Returns the servers and their base urls
+    """
+    servers = []
+    for i in range(n):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        server.daemon_threads = True
+        server.name = f'host {i}'
+        server.delay = delay
+        server.latency = latency
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers, [f'http://127.0.0.1:{server.server_port}' for server in servers]
+
+def fetch_sequential(urls):
+    """
+    Fetches urls one at a time like the original crawl loop:
+        robots.txt is read on every domain switch and each request is followed by the delay
+    """
+    domain = ''
+    delay = 1
+    for url in urls:
+        base = url[:url.index('/page/')]
+        if base != domain:
+            rp = RobotFileParser(f'{base}/robots.txt')
+            rp.read()
+            domain = base
+            delay = robots_delay(rp)
+        if rp.can_fetch('*', url):
+            requests.get(url)
+        time.sleep(delay)
+
+def bench_fetch(hosts=8, pages=5, delay=1, latency=0.05, workers=8):
+    """
+    Reports pages/sec of fetching pages pages from each of hosts stub hosts,
+        one at a time and with the concurrent Fetcher
+    """
+    hosts, pages, delay, latency, workers = int(hosts), int(pages), int(delay), float(latency), int(workers)
+    servers, bases = start_hosts(hosts, delay, latency)
+    urls = [f'{base}/page/{i}' for base in bases for i in range(pages)]
+    print(f'{len(urls)} pages from {hosts} hosts, Crawl-delay {delay}s, {latency * 1000:.0f} ms latency')
+
+    start = time.perf_counter()
+    fetch_sequential(urls)
+    seconds = time.perf_counter() - start
+    print(f'{"sequential":<12}{seconds:>8.2f}s{len(urls) / seconds:>8.2f} pages/sec')
+
+    fetcher = Fetcher(workers)
+    start = time.perf_counter()
+    fetched = sum(1 for url, response, error in fetcher.fetch(urls) if response is not None and response.ok)
+    seconds = time.perf_counter() - start
+    fetcher.close()
+    print(f'{"concurrent":<12}{seconds:>8.2f}s{fetched / seconds:>8.2f} pages/sec')
+
+    for server in servers:
+        server.shutdown()
+
+def bench_frontier(n=10000000, chunk_size=100000, list_n=200000):
+    """
+    Pushes n urls (one in ten on a preferred domain) onto a Frontier spilling to a temporary
+        directory and pops them all, then times list_n pushes with the old list.insert(0, url)
+    """
+    n, chunk_size, list_n = int(n), int(chunk_size), int(list_n)
+    spill_dir = tempfile.mkdtemp()
+    try:
+        frontier = Frontier(['https://myanimelist.net/'], spill_dir=spill_dir, chunk_size=chunk_size)
+        start = time.perf_counter()
+        for i in range(n):
+            frontier.push(f'https://{"myanimelist.net" if i % 10 == 0 else f"host{i % 1000}.example"}/page/{i}')
+        pushed = time.perf_counter() - start
+        start = time.perf_counter()
+        while len(frontier) > 0:
+            frontier.pop()
+        popped = time.perf_counter() - start
+        frontier.collect()
+    finally:
+        shutil.rmtree(spill_dir)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'Frontier: {n} pushes in {pushed:.2f}s ({n / pushed:,.0f}/sec), {n} pops in {popped:.2f}s ({n / popped:,.0f}/sec), peak RSS {rss:.0f} MB')
+
+    stack = []
+    start = time.perf_counter()
+    for i in range(list_n):
+        stack.insert(0, f'https://host{i % 1000}.example/page/{i}')
+    seconds = time.perf_counter() - start
+    print(f'list.insert(0): {list_n} pushes in {seconds:.2f}s ({list_n / seconds:,.0f}/sec)')
+
+def fill_seen(kind, path, n, results):
+    """
+    Adds n urls to a new seen-URL store and looks each one up again,
+        putting the seconds taken, false positives and peak RSS in results
+    """
+    seen = open_seen(kind, path, capacity=n)
+    start = time.perf_counter()
+    false_positives = 0
+    for i in range(n):
+        url = f'https://host{i % 1000}.example/page/{i}'
+        if url in seen:
+            false_positives += 1
+        seen.add(url)
+    if hasattr(seen, 'flush'):
+        seen.flush()
+    seconds = time.perf_counter() - start
+    assert all(f'https://host{i % 1000}.example/page/{i}' in seen for i in range(0, n, 1000))
+    results.put((seconds, false_positives, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+def bench_seen(n=1000000):
+    """
+    Reports the time, false positives, peak RSS and file size of adding n urls to each seen-URL store
+    """
+    n = int(n)
+    work_dir = tempfile.mkdtemp()
+    try:
+        print(f'{"store":<8}{"seconds":>10}{"false +":>10}{"RSS MB":>10}{"file MB":>10}')
+        for kind in ('set', 'bloom', 'sqlite'):
+            path = os.path.join(work_dir, f'seen_{kind}.dat')
+            results = Queue()
+            process = Process(target=fill_seen, args=(kind, path, n, results))
+            process.start()
+            seconds, false_positives, rss = results.get()
+            process.join()
+            size = os.path.getsize(path) / 2**20 if os.path.exists(path) else 0
+            print(f'{kind:<8}{seconds:>10.2f}{false_positives:>10}{rss:>10.0f}{size:>10.1f}')
+    finally:
+        shutil.rmtree(work_dir)
+
+def record_page(log, i, links=20):
+    """
+    Records the events of crawling synthetic page i
+    """
+    url = f'https://myanimelist.net/page/{i}'
+    targets = [f'https://myanimelist.net/page/{i * links + j}' for j in range(1, links + 1)]
+    log.record(('touch', url))
+    log.record(('visit', url))
+    log.record(('save', url, f'{i}.html', None, None))
+    log.record(('links', url, targets, targets))
+
+def bench_checkpoint(sizes='10000,100000,300000', period=100):
+    """
+    Compares a checkpoint after period more pages, for crawls of each of sizes pages,
+        between pickling all metadata (the old store_data backup) and the crawl log
+    """
+    period = int(period)
+    work_dir = tempfile.mkdtemp()
+    try:
+        print(f'{"pages":>8}{"store_data ms":>16}{"crawl log ms":>16}')
+        for size in (int(size) for size in sizes.split(',')):
+            seen = open_seen('bloom', os.path.join(work_dir, f'seen_{size}.dat'), capacity=size * 21)
+            frontier = Frontier(['https://myanimelist.net/'], seen=seen, spill_dir=os.path.join(work_dir, f'frontier_{size}'))
+            state = CrawlState(frontier, seen)
+            log = CrawlLog(state, os.path.join(work_dir, f'metadata_{size}.dat'), os.path.join(work_dir, f'url_map_{size}.dat'), os.path.join(work_dir, f'crawl_log_{size}'), compact_bytes=2**40)
+            log.replay()
+            for i in range(size):
+                record_page(log, i)
+            log.compact()
+
+            start = time.perf_counter()
+            with open(os.path.join(work_dir, 'old_metadata.dat'), 'wb') as file:
+                pickle.dump((list(state.adj_dict), set(state.url_map), state.adj_dict, state.collisions, state.pages_visited, state.docs_saved, state.total_time), file)
+            with open(os.path.join(work_dir, 'old_url_map.dat'), 'wb') as file:
+                pickle.dump(state.url_map, file)
+            old = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            for i in range(size, size + period):
+                record_page(log, i)
+            log.checkpoint()
+            new = (time.perf_counter() - start) * 1000
+            log.close()
+            print(f'{size:>8}{old:>16.1f}{new:>16.1f}')
+    finally:
+        shutil.rmtree(work_dir)
+
+def bench_docstore(n=20000, size=60000):
+    """
+    Compares writing n synthetic pages of about size bytes as two files each (the old _docs_raw
+        and _docs_cleaned layout) and to a DocStore, then reading them all back sequentially and in random order
+    """
+    n, size = int(n), int(size)
+    rng = random.Random(0)
+    words = [f'word{i}' for i in range(5000)]
+    body = ' '.join(rng.choices(words, k=size // 9))
+    work_dir = tempfile.mkdtemp()
+    try:
+        print(f'{"layout":<10}{"write s":>10}{"seq read s":>12}{"random s":>10}{"MB":>8}')
+        order = list(range(n))
+        rng.shuffle(order)
+
+        raw_dir, cleaned_dir = os.path.join(work_dir, 'raw'), os.path.join(work_dir, 'cleaned')
+        os.makedirs(raw_dir)
+        os.makedirs(cleaned_dir)
+        start = time.perf_counter()
+        for i in range(n):
+            with open(os.path.join(raw_dir, f'{i}.html'), 'w', encoding='UTF-8') as file:
+                file.write(f'<html><head><title>{i}</title></head><body>{body}</body></html>')
+            with open(os.path.join(cleaned_dir, f'{i}.html'), 'w', encoding='UTF-8') as file:
+                file.write(f'{i} {body}')
+        write = time.perf_counter() - start
+        def read_files(keys):
+            for i in keys:
+                for directory in (raw_dir, cleaned_dir):
+                    with open(os.path.join(directory, f'{i}.html'), 'r', encoding='UTF-8') as file:
+                        file.read()
+        start = time.perf_counter()
+        read_files(sorted(int(name[:-5]) for name in os.listdir(raw_dir)))
+        sequential = time.perf_counter() - start
+        start = time.perf_counter()
+        read_files(order)
+        shuffled = time.perf_counter() - start
+        mb = sum(os.path.getsize(os.path.join(d, f)) for d in (raw_dir, cleaned_dir) for f in os.listdir(d)) / 2**20
+        print(f'{"files":<10}{write:>10.2f}{sequential:>12.2f}{shuffled:>10.2f}{mb:>8.0f}')
+
+        store_dir = os.path.join(work_dir, 'docs')
+        docs = DocStore(store_dir)
+        start = time.perf_counter()
+        for i in range(n):
+            docs.put(i, {'url': f'https://example.com/{i}', 'html': f'<html><head><title>{i}</title></head><body>{body}</body></html>', 'text': f'{i} {body}'})
+        docs.close()
+        write = time.perf_counter() - start
+        docs = DocStore(store_dir, readonly=True)
+        start = time.perf_counter()
+        for key, document in docs:
+            pass
+        sequential = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in order:
+            docs.get(i)
+        shuffled = time.perf_counter() - start
+        docs.close()
+        mb = sum(os.path.getsize(os.path.join(store_dir, f)) for f in os.listdir(store_dir)) / 2**20
+        print(f'{"docstore":<10}{write:>10.2f}{sequential:>12.2f}{shuffled:>10.2f}{mb:>8.0f}')
+    finally:
+        shutil.rmtree(work_dir)
+
+def parse_three_times(html, url):
+    """
+    Processes a page like the pipeline did before page records:
+        the crawler parsed it with html.parser for its text and links,
+        the indexer parsed it with lxml for its title,
+        and build_adj_matrix.py parsed it with html.parser again for its links
+    """
+    page = BeautifulSoup(html, 'html.parser')
+    page.get_text()
+    [urljoin(url, link['href']) for link in page.find_all('a', href=True)]
+    BeautifulSoup(html, 'lxml').title
+    links = {}
+    for link in BeautifulSoup(html, 'html.parser').find_all('a', href=filter_links):
+        full_url = urljoin(url, link['href'])
+        links[full_url] = links.get(full_url, 0) + 1
+
+def parse_once(html, url):
+    """
+    Processes a page into a page record, which the indexer and build_adj_matrix.py read as is
+    """
+    record = parse_page(html, url)
+    {link: count for link, count in record['links'].items() if filter_links(link)}
+
+def bench_parse(raw_dir='../search_engine/sample/_docs_raw', repeat=3):
+    """
+    Reports the CPU time per page of processing every raw HTML file in raw_dir repeat times,
+        parsing each page three times with BeautifulSoup and once into a page record
+    """
+    pages = []
+    for fn in sorted(os.listdir(raw_dir)):
+        with open(os.path.join(raw_dir, fn), 'r', encoding='utf-8') as file:
+            pages.append(('https://myanimelist.net/' + fn, file.read()))
+    mb = sum(len(html) for url, html in pages) / 2**20
+    print(f'{len(pages)} pages, {mb:.1f} MB')
+    times = {}
+    for name, process in (('bs4 x3', parse_three_times), ('record', parse_once)):
+        start = time.process_time()
+        for _ in range(int(repeat)):
+            for url, html in pages:
+                process(html, url)
+        times[name] = (time.process_time() - start) / (int(repeat) * len(pages))
+        print(f'{name:<8}{times[name] * 1000:>8.1f} ms CPU/page')
+    print(f'speedup {times["bs4 x3"] / times["record"]:.1f}x')
+
+def bench_links(copies=20, raw_dir='../search_engine/sample/_docs_raw'):
+    """
+    Times build_adj_matrix.build_adj_dict over copies copies of the pages in raw_dir, stored in a document
+        store the way the crawler stores them, with 1, 2, 4 and all CPU processes
+    """
+    work_dir = tempfile.mkdtemp()
+    try:
+        docs = DocStore(os.path.join(work_dir, 'docs'))
+        url_map = {}
+        for fn in sorted(os.listdir(raw_dir)):
+            with open(os.path.join(raw_dir, fn), 'r', encoding='utf-8') as file:
+                html = file.read()
+            for copy in range(int(copies)):
+                url = f'https://myanimelist.net/{copy}/{fn}'
+                url_map[url] = len(url_map)
+                docs.put(url_map[url], dict(parse_page(html, url), url=url, html=html))
+        docs.close()
+        build_adj_matrix.DOCS_DIR = os.path.join(work_dir, 'docs')
+        save_fn = os.path.join(work_dir, 'adj_dict.dat')
+        print(f'{len(url_map)} documents')
+        for procs in sorted({1, 2, 4, os.cpu_count() or 1}):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                build_adj_matrix.build_adj_dict(url_map, save_fn, procs)
+            seconds = time.perf_counter() - start
+            print(f'{procs:>3} processes {seconds:>8.2f}s {len(url_map) / seconds:>8.0f} docs/sec')
+    finally:
+        shutil.rmtree(work_dir)
+
+def bench_recrawl(pages=200, changed=0.1, filler=2000):
+    """
+    Crawls pages pages from a stub host, changes a changed fraction of them and recrawls them,
+        reporting the bytes received and pages rewritten by a full crawl and by a conditional recrawl
+    """
+    import crawler
+    pages, changed, filler = int(pages), float(changed), int(filler)
+    servers, bases = start_hosts(1, 0, 0)
+    servers[0].versions = {}
+    servers[0].filler = filler
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        crawler.DEBUG = False
+        crawler.DOMAINS = [bases[0] + '/']
+        crawler.DEFAULT_CRAWL_DELAY = 0
+        crawler.DOCS_COUNT = pages
+        # The filler makes every page a near-duplicate of the others
+        crawler.NEAR_DUP_DISTANCE = None
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            crawler.crawl([bases[0] + '/page/0'])
+        seconds = time.perf_counter() - start
+        docs = DocStore(crawler.DOCS_FN, readonly=True)
+        crawled = sum(len(document['html'].encode('utf-8')) for key, document in docs)
+        docs.close()
+        print(f'{"full crawl":<12}{seconds:>8.2f}s{crawled:>12} bytes{pages:>8} pages written')
+
+        with open(crawler.URL_MAP_FN, 'rb') as file:
+            url_map = pickle.load(file)
+        for i in random.Random(0).sample(range(pages), int(pages * changed)):
+            servers[0].versions[i] = 1
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            counts = crawler.recrawl(now=time.time() + crawler.RECRAWL_MAX_INTERVAL)
+        seconds = time.perf_counter() - start
+        print(f'{"recrawl":<12}{seconds:>8.2f}s{counts["bytes"]:>12} bytes{counts["changed"]:>8} pages written'
+              f' ({counts["unchanged"]} unchanged, {counts["failed"]} failed, {len(url_map)} saved)')
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+        for server in servers:
+            server.shutdown()
+
+def bench_near_dup(n=2000000, distance=3, lookups=20000, raw_dir='../search_engine/sample/_docs_raw'):
+    """
+    Reports the SimHash time and near-duplicates of the pages in raw_dir, then the lookup time, recall
+        and memory of an index of n random fingerprints, looking up fingerprints up to distance bits
+        away from indexed ones and random ones
+    """
+    n, distance, lookups = int(n), int(distance), int(lookups)
+    texts = []
+    for fn in sorted(os.listdir(raw_dir)):
+        with open(os.path.join(raw_dir, fn), 'r', encoding='utf-8') as file:
+            texts.append(parse_page(file.read(), 'https://myanimelist.net/')['text'])
+    start = time.perf_counter()
+    fingerprints = [simhash(text) for text in texts]
+    seconds = time.perf_counter() - start
+    index = SimHashIndex(distance)
+    duplicates = 0
+    for i, fingerprint in enumerate(fingerprints):
+        if index.find(fingerprint) is None:
+            index.add(fingerprint, i)
+        else:
+            duplicates += 1
+    print(f'{len(texts)} sample pages: {seconds / len(texts) * 1000:.2f} ms/page to fingerprint, '
+          f'{duplicates} near-duplicates within {distance} bits')
+
+    rng = random.Random(0)
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    index = SimHashIndex(distance)
+    start = time.perf_counter()
+    for i in range(n):
+        index.add(rng.getrandbits(64), i)
+    seconds = time.perf_counter() - start
+    memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory) / 1024
+    print(f'{n} fingerprints: {seconds:.1f}s to add, {memory:.0f} MB')
+
+    near = []
+    for _ in range(lookups):
+        fingerprint = index.fingerprints[rng.randrange(n)]
+        for bit in rng.sample(range(64), rng.randint(0, distance)):
+            fingerprint ^= 1 << bit
+        near.append(fingerprint)
+    far = [rng.getrandbits(64) for _ in range(lookups)]
+    for name, queries in (('near', near), ('random', far)):
+        start = time.perf_counter()
+        found = sum(1 for fingerprint in queries if index.find(fingerprint) is not None)
+        seconds = time.perf_counter() - start
+        print(f'{name:<8}{seconds / lookups * 1e6:>8.1f} us/lookup, found {found}/{lookups}')
+
+def bench_robots(hosts=8, urls=10000):
+    """
+    Checks an interleaved stream of urls of hosts stub hosts and one host that refuses connections against robots.txt,
+        reading robots.txt whenever the host changes (like the original crawl loop)
+        and with the Fetcher's robots.txt cache, on a first run and after a restart
+    """
+    hosts, urls = int(hosts), int(urls)
+    servers, bases = start_hosts(hosts, 0, 0)
+    rng = random.Random(0)
+    stream = [f'{rng.choice(bases + ["http://127.0.0.1:9"])}/page/{i}' for i in range(urls)]
+    work_dir = tempfile.mkdtemp()
+    try:
+        domain = ''
+        fetched = 0
+        start = time.perf_counter()
+        for url in stream:
+            base = url[:url.index('/page/')]
+            if base != domain:
+                rp = RobotFileParser(f'{base}/robots.txt')
+                try:
+                    rp.read()
+                except Exception:
+                    rp.allow_all = True
+                domain = base
+                fetched += 1
+            rp.can_fetch('*', url)
+        seconds = time.perf_counter() - start
+        print(f'{"per switch":<12}{seconds:>8.2f}s{fetched:>8} robots.txt requests')
+
+        for name in ('cached', 'restarted'):
+            fetcher = Fetcher(robots_fn=os.path.join(work_dir, 'robots.dat'))
+            start = time.perf_counter()
+            for url in stream:
+                fetcher.host(url).rp.can_fetch('*', url)
+            seconds = time.perf_counter() - start
+            print(f'{name:<12}{seconds:>8.2f}s{fetcher.robots_fetched:>8} robots.txt requests')
+            fetcher.close()
+    finally:
+        shutil.rmtree(work_dir)
+        for server in servers:
+            server.shutdown()
+
+def main():
+    benchmarks = {'fetch': bench_fetch, 'frontier': bench_frontier, 'seen': bench_seen, 'checkpoint': bench_checkpoint, 'docstore': bench_docstore, 'parse': bench_parse, 'links': bench_links, 'recrawl': bench_recrawl, 'near_dup': bench_near_dup, 'robots': bench_robots}
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(f'usage: python3 benchmarks.py <{" | ".join(benchmarks)}> args...')
+        return
+    benchmarks[sys.argv[1]](*sys.argv[2:])
+
+if __name__ == '__main__':
+    main()
@@ -1,128 +1,213 @@
-from urllib.parse import urljoin
-from bs4 import BeautifulSoup
-import pandas as pd
-import numpy as np
+from graph import build_graph, save_graph
+from docstore import DocStore
+from page_record import parse_page
+from multiprocessing import Pool
+from scipy import sparse
 import pickle
+import time
 import sys
+import os
 import re
 
+# Links to leave out of the graph, in one pattern so each link is searched once
+# (Do not include Random, as it could cause problems while storing the urls)
+FILTER_RE = re.compile('/wiki/Special:Random|#|Category:|:Citation')
+DOCS_DIR = './_docs' # document store written by the crawler
+CHUNK_SIZE = 256 # documents handed to a worker process at a time
+
 
 def filter_links(href: str):
 	"""
 	Filter invalid or unhelpful links.
  
     Params
-        href: The link to filter
+        href: The link to filter (as found in the page or joined with its URL)
     
     Returns
         Whether the link should be kept
 	"""
 	if href:
-		# Do not include Random, as it could cause problems while storing the urls
-		if re.compile('/wiki/Special:Random').search(href):
-			return False
-		if re.compile('#').search(href):
-			return False
-		if re.compile('Category:').search(href):
-			return False
-		if re.compile(':Citation').search(href):
-			return False
-		return True
+		return FILTER_RE.search(href) is None
 	return False
 
-def build_adj_dict(url_map: dict[str, str], save_fn: str) -> dict[str, dict[str, int]]:
+def read_links(url: str, doc: int | str, docs: DocStore) -> dict[str, int]:
+    """
+    Reads the links of a document, which the crawler stored with the document when it parsed it.
+    Only documents saved by older crawls are parsed again.
+    
+    Params
+        url:  URL of the document
+        doc:  Document id in the document store, or file name in ./_docs_raw/ for pages saved by older crawls
+        docs: Document store
+    
+    Returns
+        Dictionary of outgoing links to their count
+    """
+    if isinstance(doc, int):
+        record = docs.get(doc)
+        if record is None:
+            raise KeyError(f'document {doc} is not in the document store')
+        if 'links' in record:
+            return record['links']
+        html = record['html']
+    else:
+        with open('./_docs_raw/' + doc, 'r', encoding='utf-8') as file:
+            html = file.read()
+    return parse_page(html, url)['links']
+
+docs = None # Document store opened by this worker process
+
+def extract_links(chunk: list[tuple[str, int | str]]) -> tuple[dict[str, dict[str, int]], list[str]]:
+    """
+    Reads and filters the links of a chunk of documents (run by the worker processes).
+    Documents that can't be read are skipped.
+    
+    Params
+        chunk: List of (url, document id or name)
+    
+    Returns
+        Adjacency dictionary of the chunk, and an error message for each skipped document
+    """
+    global docs
+    if docs is None:
+        docs = DocStore(DOCS_DIR, readonly=True)
+    adj_dict = {}
+    errors = []
+    for url, doc in chunk:
+        try:
+            links = read_links(url, doc, docs)
+        except Exception as e:
+            errors.append(f'Skipping {url} ({doc}): {e!r}')
+            continue
+        adj_dict[url] = {link: count for link, count in links.items() if filter_links(link)}
+    return adj_dict, errors
+
+def load_partial(part_fn: str) -> tuple[dict[str, dict[str, int]], int]:
+    """
+    Reads the chunks saved by an interrupted build_adj_dict.
+    A chunk cut short by a crash ends the file and is discarded.
+    
+    Params
+        part_fn: File the chunks were appended to
+    
+    Returns
+        Adjacency dictionary of the saved chunks, and the size of the file up to the last whole chunk
+    """
+    adj_dict = {}
+    end = 0
+    if os.path.exists(part_fn):
+        with open(part_fn, 'rb') as file:
+            while True:
+                try:
+                    adj_dict.update(pickle.load(file))
+                except (EOFError, pickle.UnpicklingError, ValueError, TypeError):
+                    break
+                end = file.tell()
+    return adj_dict, end
+
+def build_adj_dict(url_map: dict[str, int | str], save_fn: str, procs: int | None = None) -> dict[str, dict[str, int]]:
     """
     Builds a dictionary mapping urls to a dictionary which maps outgoing links to their count
     Structures the adjacency dictionary as follows:
         {url: {outgoing_link: count}}
     
+    The documents are split into chunks of CHUNK_SIZE that a pool of procs processes reads in parallel.
+    Each finished chunk is appended to save_fn + '.part', so an interrupted run continues where it stopped,
+    and documents that can't be read are logged and skipped.
+    
     Params
-        url_map: Dictionary of urls to document names
+        url_map: Dictionary of urls to document ids (or names)
         save_fn: File name to save adjacency dict to
+        procs:   Number of worker processes (all CPUs by default)
     
     Returns
         Adjacency dictionary
     """
-    adj_dict = {}
-    
-    for url, docFN in url_map.items():
-        with open('./_docs_raw/' + docFN, 'r', encoding='utf-8') as file:
-            soup = BeautifulSoup(file, 'html.parser')
-            
-            links = {}
-            for link in soup.find_all('a', href=filter_links):
-                try:
-                    full_url = urljoin(url, link['href'])
-                    
-                    if full_url in links:
-                        links[full_url] += 1
-                    else:
-                        links[full_url] = 1
-                except Exception as e:
-                    print('Error occurred while joining url:', e)
-                    if input('continue? (Y/n) ').lower() == 'n':
-                        with open(save_fn, 'wb') as file:
-                            pickle.dump(adj_dict, file)
-                        return adj_dict
-            
-            adj_dict[url] = links
-            
+    procs = procs or os.cpu_count() or 1
+    part_fn = save_fn + '.part'
+    adj_dict, end = load_partial(part_fn)
+    if adj_dict:
+        print(f'Resuming after {len(adj_dict)} documents')
+    items = [(url, doc) for url, doc in url_map.items() if url not in adj_dict]
+    chunks = [items[i:i + CHUNK_SIZE] for i in range(0, len(items), CHUNK_SIZE)]
+
+    done = 0
+    skipped = 0
+    start = time.perf_counter()
+    with open(part_fn, 'ab') as part:
+        part.truncate(end)
+        if procs == 1:
+            results = map(extract_links, chunks)
+        else:
+            pool = Pool(procs)
+            results = pool.imap_unordered(extract_links, chunks)
+        try:
+            for chunk_dict, errors in results:
+                for error in errors:
+                    print(error)
+                part.write(pickle.dumps(chunk_dict))
+                part.flush()
+                adj_dict.update(chunk_dict)
+                done += len(chunk_dict) + len(errors)
+                skipped += len(errors)
+                seconds = time.perf_counter() - start
+                print(f'{done}/{len(items)} documents ({done / seconds if seconds > 0 else 0:.0f} docs/sec)')
+        finally:
+            if procs != 1:
+                pool.terminate()
+                pool.join()
+
+    seconds = time.perf_counter() - start
+    print(f'Read the links of {done - skipped} documents in {seconds:.1f}s '
+          f'({done / seconds if seconds > 0 else 0:.0f} docs/sec, {procs} processes), skipped {skipped}')
+
     with open(save_fn, 'wb') as file:
         pickle.dump(adj_dict, file)
+    os.remove(part_fn)
 
     return adj_dict
 
-def build_adj_matrix(adj_dict: dict[str, dict[str, int]], save_fn: str) -> pd.DataFrame:
+def build_adj_matrix(adj_dict: dict[str, dict[str, int]], save_fn: str) -> sparse.csr_matrix:
     """
-    Creates an adjacency matrix for a list of URLs.
+    Creates a sparse adjacency matrix for a list of URLs in time proportional to the number of links.
+    Entry (i, j) is the number of links from URL i to URL j, and links from a page to itself are dropped.
+    The matrix is saved together with its URL list as a compressed .npz file (see graph.load_graph).
     
     Params
         adj_dict: Adjacency dictionary
         save_fn:  File name to save adjacency matrix to
     
     Returns
-        DataFrame containing adjacency matrix
+        CSR matrix containing adjacency matrix
     """
-    urls = adj_dict.keys()
-    n = len(urls)
-    adjacency_matrix = np.zeros((n, n), dtype=np.uint8)
-
-    for i, url in enumerate(urls):
-        links = adj_dict[url]
-        for j, target_url in enumerate(urls):
-            if target_url in links and i != j:
-                adjacency_matrix[i][j] = links[target_url]
-
-    df = pd.DataFrame(adjacency_matrix, index=urls, columns=urls)
-    
-    with open(save_fn, 'wb') as file:
-        pickle.dump(df, file)
+    adjacency_matrix, urls = build_graph(adj_dict)
+    save_graph(adjacency_matrix, urls, save_fn)
         
-    return df
+    return adjacency_matrix
     
 def main():
     """
     Builds either an adjacency dictionary or an adjacency matrix.
     The adjacency dict must exist in order to build the adjacency matrix.
     
-    Run with the -d option to build the adjacency dictionary.
+    Run with the -d option to build the adjacency dictionary (optionally followed by the number of processes).
     Run with the -m option to build the adjacency matrix.
     """
     if len(sys.argv) > 1:
         if sys.argv[1] == '-d':
             with open('url_map.dat', 'rb') as file:
                 print('building adjacency dictionary...')
-                build_adj_dict(pickle.load(file), 'adj_dict.dat')
+                build_adj_dict(pickle.load(file), 'adj_dict.dat', int(sys.argv[2]) if len(sys.argv) > 2 else None)
             print('finished')
         elif sys.argv[1] == '-m':
             with open('adj_dict.dat', 'rb') as file:
                 print('building adjacency matrix...')
-                build_adj_matrix(pickle.load(file), 'adj_matrix.dat')
+                build_adj_matrix(pickle.load(file), 'adj_matrix.npz')
             print('finished')
         else:
-            print('usage: python3 build_adj_matrix.py <-d | -m>')
+            print('usage: python3 build_adj_matrix.py <-d [procs] | -m>')
     else:
-        print('usage: python3 build_adj_matrix.py <-d | -m>')
+        print('usage: python3 build_adj_matrix.py <-d [procs] | -m>')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
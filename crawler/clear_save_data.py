@@ -31,5 +31,8 @@ def remove_docs(fn):
 if __name__ == "__main__":
     if input('Will delete all save data. Continue? (Y/n) ').lower() == 'y':
         remove_files('dat')
+        remove_files('npz')
         remove_docs('_docs_raw')
         remove_docs('_docs_cleaned')
+        remove_docs('_frontier')
+        remove_docs('_docs')
@@ -0,0 +1,199 @@
+"""
+Append-only checkpointing of the crawl
+
+The crawl state is a snapshot plus a log of the events that changed it
+since. Every change goes through CrawlLog.record, which appends the event
+to the log and applies it to the state, so resuming loads the snapshot and
+applies the logged events again. A checkpoint only flushes the events
+recorded since the previous one; once the log outgrows the snapshot, the
+log is compacted into a new snapshot written under a temporary name and
+renamed over the old one.
+
+Events:
+    ('take', n)                      Take up to n urls off the frontier
+    ('done', url)                    Mark a taken url as processed
+    ('requeue',)                     Put taken urls back on the frontier
+    ('touch', url)                   Add url to the seen urls
+    ('visit', url)                   Count url as visited
+    ('save', url, fn, key, count)    Map url to document fn (its id in the document store), with collisions[key] = count
+    ('links', url, links, pushed)    Record the links of url (unless it is a near-duplicate) and push the new ones
+    ('duplicate', url, doc_id)       Record url as a near-duplicate of document doc_id instead of saving it
+    ('time', total_time)             Record the total crawl time
+"""
+
+from datetime import timedelta
+import os
+import pickle
+
+def write_atomic(data, fn):
+    """
+    Pickles data to fn so that fn always holds either the old or the new data
+    """
+    with open(fn + '.tmp', 'wb') as file:
+        pickle.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(fn + '.tmp', fn)
+
+class CrawlState:
+    """
+    Everything a crawl needs to resume: its frontier, seen urls,
+        adjacency dict, file name collisions, counters, near-duplicates and url map
+
+    The url map is saved in a file of its own (see CrawlLog.compact)
+    """
+
+    def __init__(self, frontier, touched, adj_dict=None, collisions=None, pages_visited=0, docs_saved=0, total_time=None):
+        self.frontier = frontier
+        self.touched = touched
+        self.adj_dict = adj_dict if adj_dict is not None else dict()
+        self.collisions = collisions if collisions is not None else dict()
+        self.pages_visited = pages_visited
+        self.docs_saved = docs_saved
+        self.total_time = total_time if total_time is not None else timedelta(seconds=0)
+        self.duplicates = dict() # url -> id of the document it is a near-duplicate of
+        self.url_map = dict()
+        self.generation = 0 # Number of the log that follows this snapshot
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['url_map']
+        return state
+
+    def __setstate__(self, state):
+        self.duplicates = dict()
+        self.__dict__.update(state)
+        self.url_map = dict()
+
+    def apply(self, event):
+        """
+        Applies an event to the state and returns its result (the taken urls for 'take')
+        """
+        kind = event[0]
+        if kind == 'take':
+            return self.frontier.take(event[1])
+        if kind == 'done':
+            self.frontier.done(event[1])
+        elif kind == 'requeue':
+            self.frontier.requeue()
+        elif kind == 'touch':
+            self.touched.add(event[1])
+        elif kind == 'visit':
+            self.pages_visited += 1
+        elif kind == 'save':
+            url, fn, key, count = event[1:]
+            self.url_map[url] = fn
+            # A url whose duplicate event was replayed but whose done was lost is fetched
+            # again, and may be saved this time
+            self.duplicates.pop(url, None)
+            if count is not None:
+                self.collisions[key] = count
+            self.docs_saved += 1
+        elif kind == 'links':
+            url, links, pushed = event[1:]
+            # Near-duplicates are left out of the link graph, like they are left out of the index
+            if url not in self.duplicates:
+                self.adj_dict[url] = set(links)
+            for link in pushed:
+                self.frontier.append(link)
+        elif kind == 'duplicate':
+            self.duplicates[event[1]] = event[2]
+        elif kind == 'time':
+            self.total_time = event[1]
+        else:
+            raise ValueError(f'Unknown crawl event: {kind}')
+        return None
+
+class CrawlLog:
+    """
+    Records the events of a crawl after its snapshot
+
+    state:        CrawlState loaded from snapshot_fn (or a new one)
+    snapshot_fn:  File name of the pickled CrawlState
+    url_map_fn:   File name of the pickled url map
+    log_fn:       File name prefix of the event logs, one per snapshot generation
+    compact_bytes:
+        The log is compacted at a checkpoint once it is larger than
+            both compact_bytes and the snapshot, so compacting costs
+            no more than writing the log did
+    """
+
+    def __init__(self, state, snapshot_fn, url_map_fn, log_fn='crawl_log', compact_bytes=2**20):
+        self.state = state
+        self.snapshot_fn = snapshot_fn
+        self.url_map_fn = url_map_fn
+        self.log_fn = log_fn
+        self.compact_bytes = compact_bytes
+        self.file = None
+
+    def __path(self, generation):
+        return f'{self.log_fn}_{generation}.dat'
+
+    def replay(self):
+        """
+        Applies the events logged after the snapshot and opens the log for appending
+
+        A record cut short by a crash ends the log and is discarded
+
+        Returns the number of events applied
+        """
+        path = self.__path(self.state.generation)
+        count = 0
+        end = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                while True:
+                    try:
+                        event = pickle.load(file)
+                    except (EOFError, pickle.UnpicklingError, ValueError, TypeError):
+                        break
+                    self.state.apply(event)
+                    count += 1
+                    end = file.tell()
+        self.file = open(path, 'ab')
+        self.file.truncate(end)
+        return count
+
+    def record(self, event):
+        """
+        Appends an event to the log and applies it to the state
+
+        Returns the result of applying the event
+        """
+        # Pickle first, so an interrupt can't leave half a record in the log
+        self.file.write(pickle.dumps(event))
+        return self.state.apply(event)
+
+    def checkpoint(self):
+        """
+        Makes every recorded event durable, compacting the log once it is larger than the snapshot
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        snapshot_size = os.path.getsize(self.snapshot_fn) if os.path.exists(self.snapshot_fn) else 0
+        if self.file.tell() > max(self.compact_bytes, snapshot_size):
+            self.compact()
+
+    def compact(self):
+        """
+        Writes the state as a new snapshot and starts a new, empty log
+        """
+        old_path = self.__path(self.state.generation)
+        self.file.close()
+        write_atomic(self.state.url_map, self.url_map_fn)
+        self.state.generation += 1
+        write_atomic(self.state, self.snapshot_fn)
+        self.file = open(self.__path(self.state.generation), 'wb')
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+        # Chunks read back since the old snapshot are no longer needed to replay it
+        self.state.frontier.collect()
+
+    def close(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
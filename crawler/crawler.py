@@ -7,32 +7,52 @@ Used Ultimate Sitemap Parser 0.5 to parse the myanimelist.net sitemap
 https://pypi.org/project/ultimate-sitemap-parser/
 """
 
-import requests
-from bs4 import BeautifulSoup
 from usp.tree import sitemap_tree_for_homepage
-from urllib.robotparser import RobotFileParser
-from urllib.parse import urlparse, urljoin
-from datetime import datetime, timedelta
-import pandas as pd
+from urllib.parse import urlparse
+from datetime import datetime
+from graph import build_graph, save_graph
+from fetcher import Fetcher
+from frontier import Frontier
+from seen import open_seen
+from crawl_log import CrawlLog, CrawlState
+from docstore import DocStore
+from page_record import parse_page, text_hash
+from freshness import FreshnessStore, DAY
+from near_dup import SimHashIndex, simhash
 import numpy as np
-import hashlib
 import pickle
-import time
 import sys 
-import re
 import os
 
 DEBUG = True
 USER_AGENT = '*'
-DOCS_RAW_FN = '_docs_raw' # folder name containing all raw HTML documents
-DOCS_CLEANED_FN = '_docs_cleaned' # folder name containing all documents with text extracted from HTML documents
-URL_MAP_FN = 'url_map.dat'
-METADATA_FN = 'metadata.dat'
+DOCS_FN = '_docs' # folder name of the document store holding the raw HTML and parsed record of every document
+URL_MAP_FN = 'url_map.dat' # maps urls to their document id in the document store
+METADATA_FN = 'metadata.dat' # snapshot of the crawl state
+LOG_FN = 'crawl_log' # prefix of the crawl event logs that follow the snapshot
+FRONTIER_FN = '_frontier' # folder name containing frontier chunks that do not fit in memory
+SEEN_STORE = 'bloom' # how seen urls are stored: 'set', 'bloom' (fixed-size Bloom filter) or 'sqlite' (exact, on disk)
+SEEN_FN = f'seen_{SEEN_STORE}.dat'
+SEEN_CAPACITY = 10000000 # how many urls the Bloom filter is sized for
+SEEN_ERROR_RATE = 0.001 # chance of the Bloom filter mistaking a new url for a seen one at capacity
 SITEMAPS_FN = 'domain_to_urls.dat'
-ADJ_MATRIX_FN = 'adjacency_matrix.dat'
-BACKUP_PERIOD = 100 # how many loops before backing up metadata
+FRESHNESS_FN = 'freshness.dat' # SQLite database of the validators, text hashes and revisit times of saved pages
+RECRAWL_MIN_INTERVAL = DAY # shortest time between two visits to a page
+RECRAWL_MAX_INTERVAL = 30 * DAY # longest time between two visits to a page
+RECRAWL_INITIAL_INTERVAL = 7 * DAY # time until the first revisit of a new page
+NEAR_DUP_FN = 'near_dup.dat' # SimHash fingerprints of saved pages
+NEAR_DUP_DISTANCE = 3 # pages whose fingerprints differ in at most this many of 64 bits are near-duplicates (None to save every page)
+NEAR_DUP_SHINGLE = 3 # words per shingle fingerprinted
+NEAR_DUP_MIN_WORDS = 20 # pages with fewer words are never near-duplicates
+ADJ_MATRIX_FN = 'adjacency_matrix.npz'
+BACKUP_PERIOD = 100 # how many pages before checkpointing the crawl log
 DOCS_COUNT = -1 # how many documents need to be collected (-1 for until stopped)
 DEFAULT_CRAWL_DELAY = 3
+ROBOTS_FN = 'robots.dat' # SQLite cache of the robots.txt of every host
+ROBOTS_TTL = DAY # how long a robots.txt is used before it is fetched again
+ROBOTS_FAILURE_TTL = 60 * 60 # how long a host whose robots.txt could not be fetched is treated as having none
+FETCH_WORKERS = 8 # how many pages are downloaded at once
+FETCH_BATCH = 16 # how many urls are taken off the frontier at a time
 DOMAINS = [
     'https://myanimelist.net/'
 ]
@@ -44,13 +64,17 @@ def dprint(s):
 def store_data(data, fn):
     """
     Stores data in a pickle file of filename fn in the cwd
+
+    Returns whether the data was stored
     """
     dprint(f'Saving data to: {fn}')
     try:
         with open(fn, 'wb') as file:
             pickle.dump(data, file)
+        return True
     except Exception as e:
         dprint(f'! Encountered error: {e}')
+    return False
 
 def load_data(fn, default=None):
     """
@@ -89,281 +113,313 @@ def filter_links(href):
         return True
     return False
 
-def new_domain(url, prev_domain, delay):
+def valid_port(url):
     """
-    Checks if a new domain has been entered
+    Validate Port (this resolves a niche error)
 
-    If so, returns a new RobotParser, domain, and delay
-    Otherwise, returns None
+    Returns whether the port of url is valid
     """
-    domain = urlparse(url).netloc
-    if domain != prev_domain:
-        rp = RobotFileParser()
-        # Get new robots.txt url
-        dprint(f'Switching from domain {prev_domain} to {domain}')
-        rp.set_url(f'https://{domain}/robots.txt')
-        rp.read()
-
-        # Determine delay
-        crawl_delay = rp.crawl_delay(USER_AGENT)
-        if not crawl_delay:
-            crawl_delay = DEFAULT_CRAWL_DELAY
-        request_rate = rp.request_rate(USER_AGENT)
-        interval = 0
-        if request_rate:
-            interval = request_rate.seconds / request_rate.requests
-        new_delay = max(crawl_delay, interval)
-        if new_delay != delay:
-            dprint(f'Delay updated to: {new_delay}')
-        return rp, domain, new_delay
-    return None
+    try:
+        port = urlparse(url).port
+    except Exception as e:
+        dprint(f'! Encountered error '
+                f'while checking port validity: {e}')
+        return False
+    if port is not None and (port < 0 or port > 65535):
+        dprint(f'Skipping invalid port URL: {url}')
+        return False
+    return True
 
 def build_adj_matrix(adj_dict):
     """
-    Creates an adjacency matrix for a list of URLs.
+    Creates a sparse adjacency matrix for a list of URLs
+        and saves it with the URL list to ADJ_MATRIX_FN.
     """
-    urls = adj_dict.keys()
-    n = len(urls)
-    adjacency_matrix = np.zeros((n, n), dtype=np.int8)
-
-    # Populate the adjacency matrix
-    for i, url in enumerate(urls):
-        links = adj_dict[url]
-        # Assume pages link to themselves (refresh button)
-        adjacency_matrix[i][i] = 1 
-        if len(links) > 0:
-            for j, target_url in enumerate(urls):
-                if target_url in links:
-                    adjacency_matrix[i][j] = 1
-
-    df = pd.DataFrame(adjacency_matrix, index=urls, columns=urls)
-    store_data(df, ADJ_MATRIX_FN)
+    # Assume pages link to themselves (refresh button)
+    adjacency_matrix, urls = build_graph(adj_dict, self_loops=True, binary=True, dtype=np.int8)
+    dprint(f'Saving data to: {ADJ_MATRIX_FN}')
+    try:
+        save_graph(adjacency_matrix, urls, ADJ_MATRIX_FN)
+    except Exception as e:
+        dprint(f'! Encountered error: {e}')
+        return
     dprint('Created adjaceny matrix successfully')
 
-def save_page(page, url, collisions, url_map):
+def save_page(record, html, url, doc_id, docs, url_map):
     """
-    Save raw HTML document and cleaned document to local folders.
-    Name HTML document by hashing the url using sha256.
-    Collisions produce the same path name, but increase a counter suffix.
+    Save raw HTML document and its parsed record (see page_record.py) to the document store under doc_id.
 
-    Returns whether the page was saved (1) or not (0)
+    Returns the 'save' event to record if the page was saved, otherwise None
     """
     if url in url_map:
         dprint(f'! URL already exists in URL map: {url}')
-        return 0
-
-    sha256_hash = hashlib.sha256()
-    sha256_hash.update((url.encode('utf-8')))
-    fn = sha256_hash.hexdigest()
-    dprint(f'Saving doc: {fn}')
-
-    # If there exists a raw HTML document with the same file name,
-    # then there also exists a cleaned text document with the same file name
-    if os.path.exists(f'./{DOCS_RAW_FN}/{fn}.html'):
-        # Hash collision
-        dprint(f'Hash collision')
-        if not fn in collisions:
-            collisions[fn] = 0
-        else:
-            collisions[fn] += 1
-        fn += f'_{collisions[fn]}'
-        dprint(f'Creating new file name: {fn}')
-
-    fn += '.html'
+        return None
 
-    # Write raw HTML and cleaned text document to disk
+    dprint(f'Saving doc: {doc_id}')
     try:
-        with open(f'./{DOCS_RAW_FN}/{fn}', 'w', encoding='UTF-8') as file:
-            file.write(str(page.prettify()))
-        with open(f'./{DOCS_CLEANED_FN}/{fn}', 'w', encoding='UTF-8') as file:
-            # content = page.get_text(separator=' ', strip=True).lower()
-            # content = content.translate(str.maketrans('','', string.punctuation))
-            file.write(page.get_text())
-        url_map[url] = fn
+        docs.put(doc_id, dict(record, url=url, html=html))
         dprint('Saved page successfully')
-        return 1
+        return ('save', url, doc_id, None, None)
     except Exception as e:
         dprint(f'! Encountered error while saving page: {e}')
-    return 0
+    return None
+
+def load_state(seed_urls):
+    """
+    Loads the crawl state snapshot, or creates a new crawl state starting from seed_urls
+
+    Returns the state and whether it must be written as a new snapshot
+    """
+    metadata = load_data(METADATA_FN)
+    if isinstance(metadata, CrawlState):
+        return metadata, False
+    if metadata is None:
+        # URLs seen so far, and URLs waiting to be crawled, each pushed once
+        touched = open_seen(SEEN_STORE, SEEN_FN, SEEN_CAPACITY, SEEN_ERROR_RATE)
+        frontier = Frontier(DOMAINS, seen=touched, spill_dir=FRONTIER_FN)
+        frontier.extend(seed_urls)
+        return CrawlState(frontier, touched), True
+
+    # Metadata saved by older versions is a tuple
+    frontier, touched, adj_dict, collisions, pages_visited, docs_saved, total_time = metadata
+    # Metadata saved before the seen-URL store existed holds a set of URLs
+    if isinstance(touched, set) and SEEN_STORE != 'set':
+        seen = open_seen(SEEN_STORE, SEEN_FN, SEEN_CAPACITY, SEEN_ERROR_RATE)
+        for url in touched:
+            seen.add(url)
+        touched = seen
+        if not isinstance(frontier, list):
+            frontier.seen = touched
+    # Metadata saved before the frontier existed holds a list used as a stack
+    if isinstance(frontier, list):
+        stack = frontier
+        frontier = Frontier(DOMAINS, seen=touched, spill_dir=FRONTIER_FN)
+        frontier.extend(stack)
+    return CrawlState(frontier, touched, adj_dict, collisions, pages_visited, docs_saved, total_time), True
 
 def crawl(seed_urls):
     """
     Crawls the web, specifically focusing on 
         the domains listed in the domains list.
 
+    Every change to the crawl state is recorded in an append-only log
+        (see crawl_log.py), which is made durable every BACKUP_PERIOD pages.
+
     Returns the adjacency matrix of the collected urls.
     """
 
     start_time = datetime.now()
 
     # Metadata
-    stack, touched, adj_dict, collisions, pages_visited, docs_saved, total_time = load_data(
-        METADATA_FN
-        , default=(
-            seed_urls
-            , set()
-            , dict()
-            , dict()
-            , 0
-            , 0
-            , timedelta(seconds=0)
-        )
-    )
+    state, new = load_state(seed_urls)
     # Mapping of urls to document names for easy query lookup
-    url_map = load_data(URL_MAP_FN, default=dict())
+    state.url_map = load_data(URL_MAP_FN, default=dict())
+    log = CrawlLog(state, METADATA_FN, URL_MAP_FN, LOG_FN)
+    replayed = log.replay()
+    dprint(f'Replayed {replayed} logged events')
+    if new:
+        log.compact()
+    frontier = state.frontier
+    total_time = state.total_time
 
     # If enough documents have already been collected
-    if DOCS_COUNT > 0 and docs_saved >= DOCS_COUNT:
+    if DOCS_COUNT > 0 and state.docs_saved >= DOCS_COUNT:
         print('! No more documents are required: '
-            f'docs_saved={docs_saved} DOCS_COUNT={DOCS_COUNT}')
+            f'docs_saved={state.docs_saved} DOCS_COUNT={DOCS_COUNT}')
+        log.close()
         return None, 0 # Do not need to create the adjacency matrix again
 
+    # Crawl URLs that were being fetched when the crawl stopped first
+    if frontier.in_flight:
+        log.record(('requeue',))
 
-    # Keeps track of the current domain in case the domain changes
-    #   and the RobotParser needs to be updated
-    current_domain = ''
-    delay = 1 # Sleep delay in seconds
-    rp = None # Robot Parser
-
-    create_folder(DOCS_RAW_FN)
-    create_folder(DOCS_CLEANED_FN)
+    # Downloads pages concurrently, spacing out requests to each domain
+    #   by the delay in its robots.txt
+    fetcher = open_fetcher()
 
+    # Raw HTML and parsed record of every saved page, keyed by document id
+    docs = DocStore(DOCS_FN)
+    # Validators and revisit times of saved pages, for recrawls
+    fresh = open_freshness()
+    # Fingerprints of saved pages, to skip near-duplicates of them
+    near = None
+    if NEAR_DUP_DISTANCE is not None:
+        near = SimHashIndex(NEAR_DUP_DISTANCE, NEAR_DUP_FN, limit=state.docs_saved)
 
     try:
-        while len(stack) > 0:
-            try:
-                # Pop top item of stack
-                url = stack.pop()
-
-                # Validate Port (this resolves a niche error)
-                parsed_url = urlparse(url)
+        stop = False
+        while len(frontier) > 0 and not stop:
+            # Take the next batch of URLs off the frontier
+            batch = []
+            for url in log.record(('take', FETCH_BATCH)):
+                if valid_port(url):
+                    batch.append(url)
+                else:
+                    log.record(('done', url))
+
+            for url, link, error in fetcher.fetch(batch):
                 try:
-                    port = parsed_url.port
+                    if link is None:
+                        dprint(f'Skipping URL ({error}): {url}')
+                        continue
+                    log.record(('touch', url))
+
+                    # Check if response is HTML
+                    if not 'text/html' in link.headers.get('Content-Type', ''):
+                        dprint(f'Skipping non-HTML content: {url}')
+                        continue
+
+                    dprint(f'Visited URL: {url}')
+                    log.record(('visit', url))
+
+                    # Parse the page once for its title, text and links, and save it
+                    html = link.text
+                    record = parse_page(html, url)
+                    duplicate = None
+                    if near is not None and url not in state.url_map:
+                        record['simhash'] = simhash(record['text'], NEAR_DUP_SHINGLE, NEAR_DUP_MIN_WORDS)
+                        if record['simhash'] is not None:
+                            duplicate = near.find(record['simhash'])
+                    if duplicate is None:
+                        saved = save_page(record, html, url, state.docs_saved, docs, state.url_map)
+                        if saved is None:
+                            dprint('Skipping URL')
+                            continue
+                        log.record(saved)
+                        fresh.add(url, saved[2], link.headers, record['hash'])
+                        if record.get('simhash') is not None:
+                            near.add(record['simhash'], saved[2])
+                    else:
+                        # Not saved or added to the link graph, but its links are still followed
+                        dprint(f'Near-duplicate of doc {duplicate[0]} ({duplicate[1]} bits apart): {url}')
+                        log.record(('duplicate', url, duplicate[0]))
+
+                    # New links (DFS)
+                    links = [full_url for full_url in record['links'] if filter_links(full_url)]
+                    # Queue urls that have not been seen yet
+                    pushed = [full_url for full_url in links if full_url not in state.touched]
+
+                    # Add current url to the adjacency dict and push its new links
+                    log.record(('links', url, links, pushed))
+
+                    # DEBUG Metadata
+                    dprint(f'Length of Frontier: {len(frontier)}')
+                    dprint(f'Pages visited: {state.pages_visited}')
+                    dprint(f'Docs saved: {state.docs_saved}')
+                    dprint('')
+
+                    # Checkpoint the log
+                    if state.pages_visited % BACKUP_PERIOD == 1:
+                        log.record(('time', total_time + (datetime.now() - start_time)))
+                        # Documents are made durable before the events that refer to them
+                        docs.flush()
+                        fresh.flush()
+                        if near is not None:
+                            near.flush()
+                        log.checkpoint()
+
+                    # Check if enough documents have been collected
+                    if DOCS_COUNT > 0 and state.docs_saved >= DOCS_COUNT:
+                        dprint(f'Collected required {DOCS_COUNT} documents')
+                        stop = True
+                        break
                 except Exception as e:
-                    dprint(f'! Encountered error '
-                            'while checking port validity: {e}')
-                    continue
-                if port is not None and (port < 0 or port > 65535):
-                    dprint(f'Skipping invalid port URL: {url}')
-                    continue
+                    print(f'! Encountered error: {e}')
+                    stop = True
+                    break
+                finally:
+                    log.record(('done', url))
+    except KeyboardInterrupt:
+        print(f'Received Kill Signal')
 
-                # Check if the domain changes and update RobotParser
-                result = new_domain(url, current_domain, delay)
-                if result:
-                    rp, current_domain, delay = result
+    fetcher.close()
+    docs.close()
+    fresh.close()
+    if near is not None:
+        near.close()
+        print(f'Near-duplicates skipped: {near.found} of {near.checked} pages checked '
+            f'({len(state.duplicates)} in all)')
 
-                # Make sure RobotParser is not None
-                if not rp:
-                    dprint('! RobotParser is None')
-                    continue
+    finish_time = datetime.now() - start_time
+    total_time += finish_time
+    log.record(('time', total_time))
+    dprint(f'Saving data to: {METADATA_FN}')
+    log.compact()
+    log.close()
+    print(f'Docs collected: {state.docs_saved}')
+    return state.adj_dict, total_time
 
-                # Do not open restricted URLs
-                if not rp.can_fetch(USER_AGENT, url):
-                    dprint(f'Skipping disallowed URL: {url}')
-                    continue
+def open_fetcher():
+    return Fetcher(FETCH_WORKERS, user_agent=USER_AGENT, default_delay=DEFAULT_CRAWL_DELAY, log=dprint,
+        robots_fn=ROBOTS_FN, robots_ttl=ROBOTS_TTL, robots_failure_ttl=ROBOTS_FAILURE_TTL)
 
-                link = requests.get(url)
-                touched.add(url)
+def open_freshness():
+    return FreshnessStore(FRESHNESS_FN, RECRAWL_MIN_INTERVAL, RECRAWL_MAX_INTERVAL, RECRAWL_INITIAL_INTERVAL)
 
-                # Check if response is HTML
-                if not 'text/html' in link.headers.get('Content-Type'):
-                    dprint(f'Skipping non-HTML content: {url}')
-                    continue
+def recrawl(limit=-1, now=None):
+    """
+    Refetches up to limit (all if negative) saved pages that are due for a visit at now (see freshness.py).
 
-                dprint(f'Visited URL: {url}')
-                pages_visited += 1
+    Requests are conditional on the ETag and Last-Modified the page was last sent with,
+        and a page is only rewritten to the document store if the hash of its text changed,
+        so the search index (anime_search_engine.py -u) only reindexes changed pages.
+    Pages saved before freshness was tracked are due on the first recrawl.
 
-                # Collect and save HTML document
-                page = BeautifulSoup(link.text, 'html.parser')
-                saved = save_page(page, url, collisions, url_map)
-                if saved == 0:
-                    dprint('Skipping URL')
+    Returns the number of pages that were unchanged (304 or same text), changed and failed,
+        and the bytes of page bodies received
+    """
+    url_map = load_data(URL_MAP_FN, default=dict())
+    fresh = open_freshness()
+    dprint(f'Tracking {fresh.track(url_map)} more pages')
+    due = fresh.due(limit, now)
+    print(f'{len(due)} pages due for a visit')
+
+    fetcher = open_fetcher()
+    docs = DocStore(DOCS_FN)
+    counts = {'unchanged': 0, 'changed': 0, 'failed': 0, 'bytes': 0}
+    try:
+        for i in range(0, len(due), FETCH_BATCH):
+            batch = due[i:i + FETCH_BATCH]
+            for url, link, error in fetcher.fetch(batch, {url: fresh.headers(url) for url in batch}):
+                if link is None or link.status_code not in (200, 304):
+                    dprint(f'! Failed to revisit {url}: {error or link.status_code}')
+                    fresh.postpone(url, now)
+                    counts['failed'] += 1
+                    continue
+                counts['bytes'] += len(link.content)
+                if link.status_code == 304:
+                    dprint(f'Not modified: {url}')
+                    fresh.visited(url, False, now=now)
+                    counts['unchanged'] += 1
                     continue
-                docs_saved += 1
-                
-                # Add current url to the adjacency dict
-                adj_dict[url] = set()
-
-                # Parse for new links (DFS)
-                if page:
-                    for link in page.find_all('a', href=filter_links):
-                        full_url = urljoin(url, link['href'])
-
-                        # Update adjacency dictionary
-                        adj_dict[url].add(full_url)
-
-                        # Skip already seen urls
-                        if full_url in touched:
-                            continue
-                        touched.add(full_url)
-
-                        # Promote domains with strings listed in domains list
-                        link_domain = urlparse(full_url).netloc
-                        contains_domain = False
-                        for domain in DOMAINS:
-                            if re.compile(domain).search(link_domain):
-                                contains_domain = True
-                                break
-                        # If it contains a desired domain, push to top of stack
-                        if contains_domain:
-                            stack.append(full_url)
-                        # Otherwise, insert at bottom of stack
-                        else:
-                            stack.insert(0, full_url)
-
-
-                # DEBUG Metadata
-                dprint(f'Length of Stack: {len(stack)}')
-                dprint(f'Pages visited: {pages_visited}')
-                dprint(f'Docs saved: {docs_saved}')
-                dprint('')
-
-                # Backup Metadata
-                if pages_visited % BACKUP_PERIOD == 1:
-                    finish_time = datetime.now() - start_time
-                    store_data(
-                        (
-                            stack 
-                            , touched 
-                            , adj_dict 
-                            , collisions
-                            , pages_visited 
-                            , docs_saved
-                            , total_time + finish_time
-                        ),
-                        METADATA_FN
-                    )
-                    store_data(url_map, URL_MAP_FN)
-
-                # Check if enough documents have been collected
-                if DOCS_COUNT > 0 and docs_saved >= DOCS_COUNT:
-                    dprint(f'Collected required {DOCS_COUNT} documents')
-                    break
 
-                time.sleep(delay)
-            except Exception as e:
-                print(f'! Encountered error: {e}')
-                break
+                doc_id, etag, last_modified, old_hash = fresh.get(url)
+                if old_hash is None:
+                    old_record = docs.get(doc_id, {})
+                    old_hash = old_record.get('hash') or text_hash(old_record.get('text', ''))
+                html = link.text
+                record = parse_page(html, url)
+                changed = record['hash'] != old_hash
+                if changed:
+                    dprint(f'Changed: {url}')
+                    docs.put(doc_id, dict(record, url=url, html=html))
+                    counts['changed'] += 1
+                else:
+                    dprint(f'Unchanged: {url}')
+                    counts['unchanged'] += 1
+                fresh.visited(url, changed, link.headers, record['hash'], now)
+            # Documents are made durable before the visits that refer to them
+            docs.flush()
+            fresh.flush()
     except KeyboardInterrupt:
         print(f'Received Kill Signal')
 
-    finish_time = datetime.now() - start_time
-    total_time += finish_time
-    store_data(
-        (
-            stack 
-            , touched 
-            , adj_dict 
-            , collisions
-            , pages_visited 
-            , docs_saved
-            , total_time
-        ),
-        METADATA_FN
-    )
-    store_data(url_map, URL_MAP_FN)
-    print(f'Docs collected: {docs_saved}')
-    return adj_dict, total_time
+    fetcher.close()
+    docs.close()
+    fresh.close()
+    print(f'Unchanged: {counts["unchanged"]} Changed: {counts["changed"]} Failed: {counts["failed"]} '
+          f'Received: {counts["bytes"]} bytes')
+    return counts
 
 def parse_sitemaps():
     """
@@ -402,6 +458,12 @@ def parse_sitemaps():
     return seed_urls
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '-r':
+        print('Starting recrawl')
+        recrawl(int(sys.argv[2]) if len(sys.argv) > 2 else -1)
+        print('Exiting...')
+        return
+
     seed_urls = parse_sitemaps()
 
     # Start crawling
@@ -0,0 +1,164 @@
+"""
+Packed store of crawled documents
+
+Documents are pickled, compressed with zlib and appended to segment files
+of about segment_bytes each, instead of being written as two files per
+page. An index file maps each document id to its segment, offset and
+length, so any document can be read with one positioned read, and all of
+them can be streamed segment by segment in the order they were written.
+
+Layout of the store directory:
+    segment_<n>.dat  Records: a (key, length) header followed by the compressed document
+    index.dat        One (key, segment, offset, length, time) entry per stored document,
+                     where a later entry for the same key replaces the earlier one
+"""
+
+import os
+import pickle
+import struct
+import time
+import zlib
+
+RECORD_HEADER = struct.Struct('<qI') # key, length
+INDEX_ENTRY = struct.Struct('<qIQId') # key, segment, offset, length, time
+
+class DocStore:
+    """
+    Documents keyed by integer ids, stored in compressed segment files in directory
+
+    segment_bytes: Size after which a new segment file is started
+    level:         zlib compression level
+    readonly:      Open an existing store without writing to it
+    """
+
+    def __init__(self, directory, segment_bytes=64*2**20, level=1, readonly=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.level = level
+        self.readonly = readonly
+        self.index = {} # key -> (segment, offset, length, time)
+        self.readers = {} # segment -> file descriptor
+        self.segment = None
+        self.file = None
+        self.index_file = None
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+        self.__load_index()
+
+    def __segment_path(self, segment):
+        return os.path.join(self.directory, f'segment_{segment}.dat')
+
+    def __load_index(self):
+        """
+        Reads the index, dropping entries that point past the end of their segment
+            (documents whose segment was not flushed before a crash)
+        """
+        path = os.path.join(self.directory, 'index.dat')
+        sizes = {}
+        end = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                data = file.read()
+            for entry in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+                key, segment, offset, length, mtime = entry
+                if segment not in sizes:
+                    segment_path = self.__segment_path(segment)
+                    sizes[segment] = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+                if offset + length > sizes[segment]:
+                    break
+                self.index[key] = (segment, offset, length, mtime)
+                end += INDEX_ENTRY.size
+        if self.readonly:
+            return
+        self.index_file = open(path, 'ab')
+        self.index_file.truncate(end)
+        segments = [int(name[len('segment_'):-len('.dat')]) for name in os.listdir(self.directory) if name.startswith('segment_')]
+        self.segment = max(segments, default=0)
+
+    def put(self, key, document):
+        """
+        Stores document (any picklable object) under key, replacing any document stored before
+        """
+        data = zlib.compress(pickle.dumps(document), self.level)
+        if self.file is None or self.file.tell() >= self.segment_bytes:
+            self.__next_segment()
+        self.file.write(RECORD_HEADER.pack(key, len(data)))
+        offset = self.file.tell()
+        self.file.write(data)
+        entry = (self.segment, offset, len(data), time.time())
+        self.index_file.write(INDEX_ENTRY.pack(key, *entry))
+        self.index[key] = entry
+
+    def __next_segment(self):
+        # A full segment is never written again
+        if self.file is not None:
+            self.file.close()
+            self.segment += 1
+        self.file = open(self.__segment_path(self.segment), 'ab')
+        if self.file.tell() >= self.segment_bytes:
+            self.file.close()
+            self.segment += 1
+            self.file = open(self.__segment_path(self.segment), 'ab')
+
+    def __read(self, segment, offset, length):
+        if self.file is not None and segment == self.segment:
+            self.file.flush()
+        fd = self.readers.get(segment)
+        if fd is None:
+            fd = os.open(self.__segment_path(segment), os.O_RDONLY)
+            self.readers[segment] = fd
+        return pickle.loads(zlib.decompress(os.pread(fd, length, offset)))
+
+    def get(self, key, default=None):
+        """
+        Returns the document stored under key, or default if there is none
+        """
+        entry = self.index.get(key)
+        if entry is None:
+            return default
+        return self.__read(*entry[:3])
+
+    def mtime(self, key):
+        """
+        Returns the time the document under key was stored
+        """
+        return self.index[key][3]
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def __iter__(self):
+        """
+        Yields (key, document) for every stored document, reading the segments sequentially
+        """
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1][:2]):
+            yield key, self.__read(*entry[:3])
+
+    def flush(self):
+        """
+        Makes every stored document durable, segments before the index
+        """
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        if self.index_file is not None:
+            self.index_file.flush()
+            os.fsync(self.index_file.fileno())
+
+    def close(self):
+        self.flush()
+        for fd in self.readers.values():
+            os.close(fd)
+        self.readers = {}
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
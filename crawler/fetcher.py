@@ -0,0 +1,254 @@
+"""
+Fetches pages concurrently while staying polite to every host
+
+Each host gets a token bucket refilled at the rate its robots.txt allows
+(the larger of its Crawl-delay and Request-rate), so pages of different
+hosts are downloaded in parallel while requests to the same host stay
+spaced out. Connections are pooled and reused by one requests.Session.
+
+robots.txt files are kept in memory per host until they expire, and with
+a RobotsCache also in an SQLite database, so a restarted crawl does not
+fetch them again. A robots.txt that could not be fetched is cached for a
+shorter time than one that was.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.robotparser import RobotFileParser
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+import requests
+import sqlite3
+import threading
+import time
+
+USER_AGENT = '*'
+DEFAULT_CRAWL_DELAY = 3
+ROBOTS_TTL = 24 * 60 * 60 # seconds a fetched robots.txt is used for
+ROBOTS_FAILURE_TTL = 60 * 60 # seconds a robots.txt that could not be fetched is treated as missing
+
+def robots_delay(rp, user_agent=USER_AGENT, default_delay=DEFAULT_CRAWL_DELAY):
+    """
+    Returns the number of seconds to wait between requests to a host
+        according to its RobotParser
+    """
+    crawl_delay = rp.crawl_delay(user_agent)
+    if not crawl_delay:
+        crawl_delay = default_delay
+    request_rate = rp.request_rate(user_agent)
+    interval = 0
+    if request_rate:
+        interval = request_rate.seconds / request_rate.requests
+    return max(crawl_delay, interval)
+
+class TokenBucket:
+    """
+    Hands out request slots at most one per interval seconds,
+        allowing bursts of up to burst requests after an idle period
+    """
+
+    def __init__(self, interval, burst=1):
+        self.interval = interval
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token and returns the time.monotonic() time at which
+            the request it pays for may be sent
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.interval > 0:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+            else:
+                self.tokens = self.burst
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return now
+            # The bucket is in debt, wait until it refills to zero
+            return now - self.tokens * self.interval
+
+class Host:
+    """
+    Politeness state of one host: its RobotParser, delay and token bucket,
+        valid until the time.time() time expires
+    """
+
+    def __init__(self, rp, delay, expires=float('inf')):
+        self.rp = rp
+        self.delay = delay
+        self.expires = expires
+        self.bucket = TokenBucket(delay)
+
+class RobotsCache:
+    """
+    robots.txt files of hosts, stored in an SQLite database at path
+
+    Each entry holds the HTTP status (None if the request failed) and body of a robots.txt
+        and the time.time() time it expires
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS robots (host TEXT PRIMARY KEY, status INTEGER, body TEXT, expires REAL)')
+
+    def get(self, host, now=None):
+        """
+        Returns (status, body, expires) of the robots.txt of host, or None if it is not cached or expired
+        """
+        now = time.time() if now is None else now
+        return self.db.execute('SELECT status, body, expires FROM robots WHERE host = ? AND expires > ?', (host, now)).fetchone()
+
+    def put(self, host, status, body, expires):
+        self.db.execute('INSERT OR REPLACE INTO robots VALUES (?, ?, ?, ?)', (host, status, body, expires))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+class Fetcher:
+    """
+    Downloads batches of URLs with a pool of worker threads
+
+    Requests to one host are spaced by its robots.txt delay,
+        while different hosts are fetched in parallel.
+    """
+
+    def __init__(self, workers=8, timeout=10, user_agent=USER_AGENT, default_delay=DEFAULT_CRAWL_DELAY, log=None,
+            robots_fn=None, robots_ttl=ROBOTS_TTL, robots_failure_ttl=ROBOTS_FAILURE_TTL):
+        self.workers = workers
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.default_delay = default_delay
+        self.log = log or (lambda s: None)
+        self.robots_ttl = robots_ttl
+        self.robots_failure_ttl = robots_failure_ttl
+        self.robots = RobotsCache(robots_fn) if robots_fn is not None else None
+        self.robots_fetched = 0 # robots.txt requests sent
+        self.hosts = {}
+        self.pool = ThreadPoolExecutor(workers)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=100, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def host(self, url):
+        """
+        Returns the Host of url, reading its robots.txt if it is new or expired
+        """
+        self.__refresh([url])
+        return self.hosts[urlparse(url).netloc]
+
+    def __refresh(self, urls):
+        """
+        Loads the robots.txt of the hosts of urls that are new or expired,
+            from the RobotsCache if it has them and otherwise by fetching them in parallel
+        """
+        now = time.time()
+        missing = {}
+        for url in urls:
+            key = urlparse(url).netloc
+            host = self.hosts.get(key)
+            if key in missing or (host is not None and host.expires > now):
+                continue
+            cached = self.robots.get(key, now) if self.robots is not None else None
+            if cached is not None:
+                self.__set_host(key, *cached)
+            else:
+                missing[key] = url
+        self.robots_fetched += len(missing)
+        for key, (status, body) in zip(missing, self.pool.map(self.__fetch_robots, missing.values())):
+            failed = status is None or status >= 500
+            expires = now + (self.robots_failure_ttl if failed else self.robots_ttl)
+            if self.robots is not None:
+                self.robots.put(key, status, body, expires)
+            self.__set_host(key, status, body, expires)
+
+    def __fetch_robots(self, url):
+        """
+        Fetches robots.txt through the pooled session
+
+        Returns its HTTP status (None if the request failed) and body
+        """
+        parsed_url = urlparse(url)
+        robots_url = f'{parsed_url.scheme}://{parsed_url.netloc}/robots.txt'
+        try:
+            response = self.session.get(robots_url, timeout=self.timeout)
+            return response.status_code, response.text
+        except Exception as e:
+            self.log(f'! Encountered error while reading {robots_url}: {e}')
+            return None, ''
+
+    def __set_host(self, key, status, body, expires):
+        """
+        Parses a robots.txt following the same rules as RobotFileParser.read,
+            keeping the token bucket of the host if its delay did not change
+        """
+        rp = RobotFileParser()
+        if status in (401, 403):
+            rp.disallow_all = True
+        elif status is None or status >= 400:
+            rp.allow_all = True
+        else:
+            rp.parse(body.splitlines())
+        delay = robots_delay(rp, self.user_agent, self.default_delay)
+        self.log(f'Delay for {key}: {delay}')
+        host = Host(rp, delay, expires)
+        old = self.hosts.get(key)
+        if old is not None and old.delay == delay:
+            host.bucket = old.bucket
+        self.hosts[key] = host
+
+    def __get(self, start, url, headers):
+        wait = start - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        return self.session.get(url, headers=headers, timeout=self.timeout)
+
+    def fetch(self, urls, headers=None):
+        """
+        Downloads urls concurrently, sending headers[url] (if any) with the request for url
+
+        Yields (url, response, error) for every url in the order the downloads finish,
+            where error describes why response is None
+        URLs disallowed by robots.txt are yielded first
+        """
+        headers = headers or {}
+        # Read the robots.txt of new hosts in parallel
+        self.__refresh(urls)
+
+        disallowed = []
+        jobs = []
+        for url in urls:
+            host = self.hosts[urlparse(url).netloc]
+            if host.rp.can_fetch(self.user_agent, url):
+                jobs.append((host.bucket.reserve(), url))
+            else:
+                disallowed.append(url)
+        # Earliest slots first, so no worker waits on a host while another host is ready
+        jobs.sort(key=lambda job: job[0])
+        futures = {self.pool.submit(self.__get, start, url, headers.get(url)): url for start, url in jobs}
+
+        try:
+            for url in disallowed:
+                yield url, None, 'disallowed by robots.txt'
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    yield url, future.result(), None
+                except Exception as e:
+                    yield url, None, str(e)
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+        if self.robots is not None:
+            self.robots.close()
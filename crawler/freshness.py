@@ -0,0 +1,125 @@
+"""
+Freshness of crawled pages, for recrawling them
+
+For every saved page the store keeps the validators its server sent (ETag
+and Last-Modified), the hash of its text and when it should be visited
+again. Recrawls send the validators back as a conditional request, so an
+unchanged page costs a 304 without a body, and compare the hash of pages
+that were sent again, so only pages whose text changed are rewritten.
+
+Each page is revisited after its own interval, which adapts to how often
+the page is seen to change: it is divided by backoff when the page
+changed since the last visit and multiplied by it when it did not, within
+[min_interval, max_interval].
+"""
+
+import sqlite3
+import time
+
+DAY = 24 * 60 * 60
+
+class FreshnessStore:
+    """
+    Validators, text hashes and revisit times of crawled pages, stored in an SQLite database at path
+
+    Changes are committed by flush()
+    """
+
+    def __init__(self, path, min_interval=DAY, max_interval=30*DAY, initial_interval=7*DAY, backoff=2):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.initial_interval = initial_interval
+        self.backoff = backoff
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS pages ('
+            'url TEXT PRIMARY KEY, doc_id INTEGER, etag TEXT, last_modified TEXT, hash TEXT, '
+            'fetched REAL, interval REAL, next_visit REAL, visits INTEGER, changes INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS pages_next_visit ON pages (next_visit)')
+
+    def add(self, url, doc_id, headers, content_hash, now=None):
+        """
+        Starts tracking a page saved under doc_id, fetched with response headers
+        """
+        now = time.time() if now is None else now
+        self.db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, 0)',
+            (url, doc_id, headers.get('ETag'), headers.get('Last-Modified'), content_hash,
+             now, self.initial_interval, now + self.initial_interval))
+
+    def track(self, url_map, now=None):
+        """
+        Starts tracking the pages of url_map saved before the store existed, due for a visit now
+
+        Returns the number of pages added
+        """
+        now = time.time() if now is None else now
+        before = len(self)
+        self.db.executemany('INSERT OR IGNORE INTO pages VALUES (?, ?, NULL, NULL, NULL, NULL, ?, ?, 0, 0)',
+            ((url, doc_id, self.initial_interval, now) for url, doc_id in url_map.items() if isinstance(doc_id, int)))
+        return len(self) - before
+
+    def get(self, url):
+        """
+        Returns (doc_id, etag, last_modified, hash) of a tracked page, or None
+        """
+        return self.db.execute('SELECT doc_id, etag, last_modified, hash FROM pages WHERE url = ?', (url,)).fetchone()
+
+    def headers(self, url):
+        """
+        Returns the conditional request headers that ask for url only if it changed
+        """
+        page = self.get(url)
+        headers = {}
+        if page is not None:
+            if page[1]:
+                headers['If-None-Match'] = page[1]
+            if page[2]:
+                headers['If-Modified-Since'] = page[2]
+        return headers
+
+    def due(self, limit=-1, now=None):
+        """
+        Returns up to limit (all if negative) urls due for a visit at now, the most overdue first
+        """
+        now = time.time() if now is None else now
+        rows = self.db.execute('SELECT url FROM pages WHERE next_visit <= ? ORDER BY next_visit LIMIT ?', (now, limit))
+        return [url for url, in rows]
+
+    def visited(self, url, changed, headers=None, content_hash=None, now=None):
+        """
+        Records a visit to url, and the validators and text hash it was sent if headers is given
+            (a 304 keeps the old ones)
+
+        Returns the number of seconds until the next visit
+        """
+        now = time.time() if now is None else now
+        interval, = self.db.execute('SELECT interval FROM pages WHERE url = ?', (url,)).fetchone()
+        if changed:
+            interval = max(self.min_interval, interval / self.backoff)
+        else:
+            interval = min(self.max_interval, interval * self.backoff)
+        if headers is not None:
+            self.db.execute('UPDATE pages SET etag = ?, last_modified = ?, hash = ? WHERE url = ?',
+                (headers.get('ETag'), headers.get('Last-Modified'), content_hash, url))
+        self.db.execute('UPDATE pages SET fetched = ?, interval = ?, next_visit = ?, '
+            'visits = visits + 1, changes = changes + ? WHERE url = ?',
+            (now, interval, now + interval, int(bool(changed)), url))
+        return interval
+
+    def postpone(self, url, now=None):
+        """
+        Schedules another visit to url after its current interval, when a visit failed
+        """
+        now = time.time() if now is None else now
+        self.db.execute('UPDATE pages SET next_visit = ? + interval WHERE url = ?', (now, url))
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def flush(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
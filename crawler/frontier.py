@@ -0,0 +1,274 @@
+"""
+The crawl frontier: URLs waiting to be fetched
+
+Links to a preferred domain are crawled depth first (last in, first out)
+and every other link breadth first (first in, first out), after all the
+preferred ones. Optionally, URLs are instead ordered by an integer
+priority such as their depth, preferred domains first within a priority.
+Every push and pop is O(1), or O(log p) for p distinct priorities.
+
+When a spill directory is given, each queue keeps at most two chunks of
+URLs in memory and writes the rest to immutable chunk files, so frontiers
+larger than RAM work.
+"""
+
+from collections import deque
+from urllib.parse import urlparse
+import heapq
+import os
+import re
+
+def domain_pattern(domains):
+    """
+    Compiles a pattern matching URLs whose host is one of domains
+        (e.g. 'https://myanimelist.net/') or one of their subdomains
+    """
+    hosts = [urlparse(domain).netloc or domain for domain in domains]
+    if not hosts:
+        return re.compile(r'(?!)')
+    return re.compile(
+        r'[^:/?#]+://(?:[^@/?#]*@)?(?:[^/?#@]*\.)?'
+        r'(?:' + '|'.join(re.escape(host) for host in hosts) + r')'
+        r'(?::\d*)?(?:[/?#]|$)'
+        , re.IGNORECASE
+    )
+
+class ChunkFiles:
+    """
+    Writes lists of URLs to numbered chunk files in a directory and reads them back
+    """
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        self.count = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, urls):
+        """
+        Writes urls to a new chunk file and returns its path
+        """
+        self.count += 1
+        path = os.path.join(self.directory, f'{self.name}_{self.count}.txt')
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            file.write('\n'.join(urls))
+        os.replace(path + '.tmp', path)
+        return path
+
+    def read(self, path):
+        """
+        Returns the urls in the chunk file at path
+        """
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                return file.read().split('\n')
+        except FileNotFoundError:
+            return []
+
+class SpillStack:
+    """
+    A last in, first out queue of URLs that keeps its oldest chunks on disk
+    """
+
+    def __init__(self, chunk_files=None, chunk_size=100000):
+        self.chunk_files = chunk_files
+        self.chunk_size = chunk_size
+        self.top = []
+        self.chunks = [] # Paths of spilled chunks, newest last
+        self.consumed = [] # Paths of chunks read back into memory
+        self.length = 0
+
+    def push(self, url):
+        self.top.append(url)
+        self.length += 1
+        if self.chunk_files and len(self.top) >= 2 * self.chunk_size:
+            self.chunks.append(self.chunk_files.write(self.top[:self.chunk_size]))
+            del self.top[:self.chunk_size]
+
+    def pop(self):
+        if not self.top and self.chunks:
+            path = self.chunks.pop()
+            self.top = self.chunk_files.read(path)
+            self.consumed.append(path)
+        url = self.top.pop()
+        self.length -= 1
+        return url
+
+    def __len__(self):
+        return self.length
+
+class SpillQueue:
+    """
+    A first in, first out queue of URLs that keeps the chunks between its head and tail on disk
+    """
+
+    def __init__(self, chunk_files=None, chunk_size=100000):
+        self.chunk_files = chunk_files
+        self.chunk_size = chunk_size
+        self.head = deque()
+        self.tail = []
+        self.chunks = deque() # Paths of spilled chunks, oldest first
+        self.consumed = []
+        self.length = 0
+
+    def push(self, url):
+        self.tail.append(url)
+        self.length += 1
+        if self.chunk_files and len(self.tail) >= self.chunk_size:
+            if self.head or self.chunks:
+                self.chunks.append(self.chunk_files.write(self.tail))
+            else:
+                self.head.extend(self.tail)
+            self.tail = []
+
+    def pop(self):
+        if not self.head:
+            if self.chunks:
+                path = self.chunks.popleft()
+                self.head.extend(self.chunk_files.read(path))
+                self.consumed.append(path)
+            else:
+                self.head.extend(self.tail)
+                self.tail = []
+        url = self.head.popleft()
+        self.length -= 1
+        return url
+
+    def __len__(self):
+        return self.length
+
+class Frontier:
+    """
+    URLs waiting to be fetched, each pushed at most once
+
+    domains:    Links whose host is one of (or a subdomain of) these domains are crawled first
+    seen:       Set-like container of every URL pushed so far (None to allow repeats)
+    spill_dir:  Directory for chunk files (None to keep everything in memory)
+    chunk_size: Number of URLs per chunk file
+    by_priority:
+        If set, push(url, priority) orders URLs by priority, lowest first,
+            and URLs of equal priority first in, first out
+        Otherwise, preferred URLs are last in, first out
+            and all other URLs first in, first out
+    """
+
+    def __init__(self, domains=(), seen=None, spill_dir=None, chunk_size=100000, by_priority=False):
+        self.pattern = domain_pattern(domains)
+        self.seen = seen
+        self.spill_dir = spill_dir
+        self.chunk_size = chunk_size
+        self.by_priority = by_priority
+        self.queues = {}
+        self.keys = [] # Heap of the keys of non-empty queues
+        self.length = 0
+        self.in_flight = [] # URLs taken but not yet marked done, oldest first
+
+    def is_preferred(self, url):
+        """
+        Returns whether the host of url is one of the preferred domains
+        """
+        return self.pattern.match(url) is not None
+
+    def __queue(self, key):
+        queue = self.queues.get(key)
+        if queue is None:
+            chunk_files = None
+            if self.spill_dir:
+                chunk_files = ChunkFiles(self.spill_dir, '_'.join(str(k) for k in key))
+            if key == (0, 0) and not self.by_priority:
+                queue = SpillStack(chunk_files, self.chunk_size)
+            else:
+                queue = SpillQueue(chunk_files, self.chunk_size)
+            self.queues[key] = queue
+        if len(queue) == 0:
+            heapq.heappush(self.keys, key)
+        return queue
+
+    def __push(self, url, preferred, priority):
+        key = (priority if self.by_priority else 0, 0 if preferred else 1)
+        self.__queue(key).push(url)
+        self.length += 1
+
+    def push(self, url, priority=0):
+        """
+        Adds url to the frontier unless it has been seen before
+
+        Returns whether url was added
+        """
+        if self.seen is not None and url in self.seen:
+            return False
+        self.append(url, priority)
+        return True
+
+    def append(self, url, priority=0):
+        """
+        Adds url to the frontier and to seen without checking whether it has been seen before
+        """
+        if self.seen is not None:
+            self.seen.add(url)
+        self.__push(url, self.is_preferred(url), priority)
+
+    def extend(self, urls):
+        """
+        Adds urls ahead of everything else (e.g. seed urls), popped from the end of urls first
+            These are not checked against or added to seen
+        """
+        if self.by_priority:
+            urls = reversed(urls)
+        for url in urls:
+            self.__push(url, True, 0)
+
+    def pop(self):
+        """
+        Removes and returns the next url to fetch
+
+        Raises IndexError if the frontier is empty
+        """
+        if not self.keys:
+            raise IndexError('pop from an empty frontier')
+        key = self.keys[0]
+        queue = self.queues[key]
+        url = queue.pop()
+        self.length -= 1
+        if len(queue) == 0:
+            heapq.heappop(self.keys)
+        return url
+
+    def take(self, n):
+        """
+        Pops up to n urls to fetch, which stay in flight until marked done
+        """
+        urls = []
+        while self.keys and len(urls) < n:
+            urls.append(self.pop())
+        self.in_flight += urls
+        return urls
+
+    def done(self, url):
+        """
+        Marks a url returned by take as processed
+        """
+        self.in_flight.remove(url)
+
+    def requeue(self):
+        """
+        Puts urls still in flight (e.g. when a crawl was interrupted) back at the front of the frontier
+        """
+        self.extend(self.in_flight[::-1])
+        self.in_flight = []
+
+    def collect(self):
+        """
+        Deletes chunk files that have been read back into memory
+            Call after the frontier has been saved, so a saved frontier never refers to a deleted chunk
+        """
+        for queue in self.queues.values():
+            for path in queue.consumed:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            queue.consumed = []
+
+    def __len__(self):
+        return self.length
@@ -0,0 +1,95 @@
+"""
+Builds the link graph of crawled pages as a sparse matrix
+
+URLs are numbered by their position in the adjacency dictionary and the
+links are collected as (source, destination) id pairs, so building the
+graph takes time proportional to the number of links instead of the
+square of the number of pages.
+"""
+
+from scipy import sparse
+import numpy as np
+
+def build_graph(adj_dict, self_loops=False, binary=False, dtype=np.int32):
+    """
+    Creates a CSR adjacency matrix from an adjacency dictionary
+        {url: {outgoing_link: count}} or {url: set of outgoing links}
+
+    Only links between urls in adj_dict are kept.
+    If self_loops is set, every page links to itself (refresh button),
+        otherwise links from a page to itself are dropped.
+    If binary is set, entries are 1 instead of the number of links.
+
+    Returns the matrix and the list of urls, where url i is row and column i
+    """
+    urls = list(adj_dict)
+    ids = {url: i for i, url in enumerate(urls)}
+    src = []
+    dst = []
+    counts = []
+    for i, url in enumerate(urls):
+        links = adj_dict[url]
+        for target_url in links:
+            j = ids.get(target_url)
+            if j is None or (j == i and not self_loops):
+                continue
+            src.append(i)
+            dst.append(j)
+            counts.append(1 if binary or not isinstance(links, dict) else links[target_url])
+        if self_loops:
+            src.append(i)
+            dst.append(i)
+            counts.append(1)
+
+    n = len(urls)
+    index_dtype = np.int32 if n < 2**31 else np.int64
+    matrix = sparse.coo_matrix(
+        (np.asarray(counts, dtype=dtype), (np.asarray(src, dtype=index_dtype), np.asarray(dst, dtype=index_dtype)))
+        , shape=(n, n)
+    ).tocsr()
+    matrix.sum_duplicates()
+    if binary:
+        matrix.data[:] = 1
+    return matrix, urls
+
+def save_graph(matrix, urls, fn):
+    """
+    Saves a CSR adjacency matrix and its url list to a compressed .npz file
+        holding the indptr, indices, data and shape arrays of the matrix and the urls
+
+    The urls are stored newline-joined as UTF-8 bytes, since a fixed-width string
+        array would pad every url to the length of the longest one
+    """
+    matrix = sparse.csr_matrix(matrix)
+    np.savez_compressed(
+        fn
+        , indptr=matrix.indptr
+        , indices=matrix.indices
+        , data=matrix.data
+        , shape=np.asarray(matrix.shape)
+        , urls=np.frombuffer('\n'.join(urls).encode('utf-8'), dtype=np.uint8)
+    )
+
+def load_graph(fn):
+    """
+    Loads a graph saved by save_graph
+
+    Returns the CSR adjacency matrix and the list of urls
+    """
+    with np.load(fn) as graph:
+        matrix = sparse.csr_matrix(
+            (graph['data'], graph['indices'], graph['indptr'])
+            , shape=tuple(graph['shape'])
+        )
+        urls = decode_urls(graph['urls'])
+    return matrix, urls
+
+def decode_urls(array):
+    """
+    Returns the url list of a graph file: newline-joined UTF-8 bytes, or a
+        string array in files saved before that
+    """
+    if array.dtype != np.uint8:
+        return array.tolist()
+    text = array.tobytes().decode('utf-8')
+    return text.split('\n') if text else []
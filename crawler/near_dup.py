@@ -0,0 +1,131 @@
+"""
+Near-duplicate detection of crawled pages
+
+Pages are fingerprinted with a 64-bit SimHash of the word shingles of
+their text: pages that share most of their shingles get fingerprints that
+differ in few bits. Two pages are near-duplicates if their fingerprints
+differ in at most `distance` bits.
+
+Fingerprints are indexed by locality-sensitive hashing: the 64 bits are
+split into distance + 1 bands, and every fingerprint is filed under the
+value of each of its bands. Fingerprints within `distance` bits of each
+other agree on at least one whole band, so a lookup only compares the
+fingerprints filed under its own band values instead of all of them.
+"""
+
+from array import array
+from collections import Counter
+import hashlib
+import numpy as np
+import os
+import re
+import struct
+
+WORD_RE = re.compile(r'\w+')
+ENTRY = struct.Struct('<Qq') # fingerprint, document id
+
+def simhash(text, shingle=3, min_words=0):
+    """
+    Returns the 64-bit SimHash of the shingle-word shingles of text, weighted by their counts,
+        or None if text has fewer than min_words words (short texts, and all empty ones,
+        would share fingerprints without being duplicates)
+    """
+    tokens = WORD_RE.findall(text.lower())
+    if len(tokens) < min_words:
+        return None
+    shingles = Counter(' '.join(tokens[i:i + shingle]) for i in range(max(1, len(tokens) - shingle + 1)))
+    digests = b''.join(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest() for s in shingles)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8), axis=1)
+    weights = np.fromiter(shingles.values(), dtype=np.float64, count=len(shingles))
+    # Each bit is set if the shingles that set it outweigh the ones that don't
+    votes = weights @ (bits * 2.0 - 1)
+    return int.from_bytes(np.packbits(votes > 0).tobytes(), 'little')
+
+class SimHashIndex:
+    """
+    Fingerprints of saved documents, searchable for fingerprints within distance bits
+
+    With a path, every fingerprint added is appended to that file, which is read back when the index is opened
+        limit: Ignore fingerprints of document ids from limit on
+            (added after the last checkpoint of a crawl that stopped)
+
+    checked and found count the lookups made and the near-duplicates they found
+    """
+
+    def __init__(self, distance=3, path=None, limit=None):
+        self.distance = distance
+        self.path = path
+        self.bands = distance + 1
+        # Band b covers bits [self.bounds[b], self.bounds[b + 1])
+        self.bounds = [64 * b // self.bands for b in range(self.bands + 1)]
+        self.fingerprints = array('Q')
+        self.doc_ids = array('q')
+        self.buckets = [dict() for _ in range(self.bands)] # band value -> array of positions in fingerprints
+        self.checked = 0
+        self.found = 0
+        self.file = None
+        if path is not None:
+            self.__load(limit)
+
+    def __load(self, limit):
+        end = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as file:
+                data = file.read()
+            for fingerprint, doc_id in ENTRY.iter_unpack(data[:len(data) - len(data) % ENTRY.size]):
+                if limit is not None and doc_id >= limit:
+                    break
+                self.__insert(fingerprint, doc_id)
+                end += ENTRY.size
+        self.file = open(self.path, 'ab')
+        self.file.truncate(end)
+
+    def __band_values(self, fingerprint):
+        bounds = self.bounds
+        return [(fingerprint >> bounds[b]) & ((1 << (bounds[b + 1] - bounds[b])) - 1) for b in range(self.bands)]
+
+    def __insert(self, fingerprint, doc_id):
+        position = len(self.fingerprints)
+        self.fingerprints.append(fingerprint)
+        self.doc_ids.append(doc_id)
+        for buckets, value in zip(self.buckets, self.__band_values(fingerprint)):
+            bucket = buckets.get(value)
+            if bucket is None:
+                buckets[value] = array('I', (position,))
+            else:
+                bucket.append(position)
+
+    def add(self, fingerprint, doc_id):
+        self.__insert(fingerprint, doc_id)
+        if self.file is not None:
+            self.file.write(ENTRY.pack(fingerprint, doc_id))
+
+    def find(self, fingerprint):
+        """
+        Returns (doc_id, distance) of the closest fingerprint within distance bits, or None
+        """
+        self.checked += 1
+        fingerprints = self.fingerprints
+        best = None
+        for buckets, value in zip(self.buckets, self.__band_values(fingerprint)):
+            for position in buckets.get(value, ()):
+                distance = (fingerprints[position] ^ fingerprint).bit_count()
+                if distance <= self.distance and (best is None or distance < best[1]):
+                    best = (self.doc_ids[position], distance)
+        if best is not None:
+            self.found += 1
+        return best
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
@@ -0,0 +1,67 @@
+"""
+Single-pass parsing of crawled pages
+
+A fetched page is parsed once, with lxml, into a record holding everything
+the rest of the pipeline needs from it, so neither the search index nor the
+link graph has to parse the raw HTML again:
+    title: Text of the <title> element ('' if there is none)
+    text:  Text of the whole document, without scripts and style sheets
+    links: {absolute url: count} of the <a href> links to other pages, in document order
+    hash:  sha256 hex digest of text, the same hash the search index keeps
+"""
+
+from urllib.parse import urljoin
+import hashlib
+import lxml.html
+from lxml import etree
+
+UTF8_PARSER = lxml.html.HTMLParser(encoding='utf-8')
+
+def parse_html(html):
+    """
+    Returns the lxml root element of html, or None if it has no elements
+    """
+    try:
+        return lxml.html.document_fromstring(html)
+    except ValueError:
+        # Strings that declare their own encoding are only parsed as bytes
+        try:
+            return lxml.html.document_fromstring(html.encode('utf-8'), parser=UTF8_PARSER)
+        except (ValueError, etree.ParserError):
+            return None
+    except etree.ParserError:
+        return None
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def parse_page(html, url):
+    """
+    Parses the raw HTML of the page at url into a record (see above)
+
+    Links that can't be joined with url are skipped
+    """
+    root = parse_html(html)
+    if root is None:
+        return {'title': '', 'text': '', 'links': {}, 'hash': text_hash('')}
+
+    title = root.find('.//title')
+    title = title.text_content().strip() if title is not None else ''
+    # Like BeautifulSoup's get_text, leave out scripts and style sheets
+    for element in list(root.iter('script', 'style', 'template')):
+        element.drop_tree()
+    text = root.text_content()
+
+    links = {}
+    for anchor in root.iter('a'):
+        href = anchor.get('href')
+        # Links within the page are not links to other pages
+        if not href or href.startswith('#'):
+            continue
+        try:
+            full_url = urljoin(url, href)
+        except ValueError:
+            continue
+        links[full_url] = links.get(full_url, 0) + 1
+
+    return {'title': title, 'text': text, 'links': links, 'hash': text_hash(text)}
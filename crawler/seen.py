@@ -0,0 +1,187 @@
+"""
+Stores of URLs the crawler has already seen
+
+Both stores keep 64-bit fingerprints of URLs instead of the URLs themselves
+and can stand in for a set (`url in seen`, `seen.add(url)`):
+    BloomFilter: fixed-size bit array with a configurable false-positive rate,
+        kept in memory or memory-mapped from a file
+    SqliteSeen: exact store of fingerprints in an on-disk SQLite table
+Pickling either one only saves where its file is (or, for an in-memory
+Bloom filter, its bit array), never the URLs.
+"""
+
+from math import ceil, log
+import hashlib
+import mmap
+import os
+import sqlite3
+import struct
+
+BLOOM_MAGIC = b'BLM1'
+BLOOM_HEADER = struct.Struct('<4sIQQ') # magic, hash count, bit count, item count
+
+def url_hash(url):
+    """
+    Returns two independent 64-bit hashes of url
+    """
+    digest = hashlib.blake2b(url.encode('utf-8'), digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+
+def url_fingerprint(url):
+    """
+    Returns a signed 64-bit fingerprint of url (fits an SQLite INTEGER)
+    """
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+class BloomFilter:
+    """
+    Approximate set of URLs: `url in bloom` may wrongly be True
+        with probability about error_rate once capacity URLs have been added,
+        but is never wrongly False
+
+    With a path, the bits live in that file (created if missing) and are memory-mapped,
+        so resuming does not read the filter into memory
+    """
+
+    def __init__(self, capacity=10000000, error_rate=0.001, path=None):
+        self.path = path
+        bits = ceil(-capacity * log(error_rate) / log(2) ** 2)
+        self.bit_count = (bits + 7) // 8 * 8
+        self.hash_count = max(1, round(self.bit_count / capacity * log(2)))
+        self.count = 0
+        self.__open()
+
+    def __open(self):
+        if self.path is None:
+            self.offset = 0
+            self.bits = bytearray(self.bit_count // 8)
+            return
+        self.offset = BLOOM_HEADER.size
+        if not os.path.exists(self.path):
+            with open(self.path, 'wb') as file:
+                file.write(BLOOM_HEADER.pack(BLOOM_MAGIC, self.hash_count, self.bit_count, 0))
+                file.truncate(self.offset + self.bit_count // 8)
+        self.file = open(self.path, 'r+b')
+        self.bits = mmap.mmap(self.file.fileno(), 0)
+        # An existing file keeps the size it was created with
+        magic, self.hash_count, self.bit_count, self.count = BLOOM_HEADER.unpack_from(self.bits, 0)
+        if magic != BLOOM_MAGIC:
+            raise ValueError(f'{self.path} is not a Bloom filter')
+
+    def __positions(self, url):
+        """
+        Yields the hash_count bit positions of url (double hashing)
+        """
+        h1, h2 = url_hash(url)
+        m = self.bit_count
+        position = h1 % m
+        step = h2 % m or 1
+        for _ in range(self.hash_count):
+            yield position
+            position += step
+            if position >= m:
+                position -= m
+
+    def __contains__(self, url):
+        bits = self.bits
+        offset = self.offset
+        for position in self.__positions(url):
+            if not bits[offset + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, url):
+        bits = self.bits
+        offset = self.offset
+        new = False
+        for position in self.__positions(url):
+            i = offset + (position >> 3)
+            mask = 1 << (position & 7)
+            if not bits[i] & mask:
+                bits[i] |= mask
+                new = True
+        if new:
+            self.count += 1
+
+    def __len__(self):
+        """
+        Number of URLs added (URLs mistaken for already seen ones are not counted)
+        """
+        return self.count
+
+    def flush(self):
+        if self.path is not None:
+            BLOOM_HEADER.pack_into(self.bits, 0, BLOOM_MAGIC, self.hash_count, self.bit_count, self.count)
+            self.bits.flush()
+
+    def close(self):
+        if self.path is not None:
+            self.flush()
+            self.bits.close()
+            self.file.close()
+
+    def __getstate__(self):
+        if self.path is None:
+            return self.__dict__
+        self.flush()
+        return {'path': self.path, 'bit_count': self.bit_count, 'hash_count': self.hash_count}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self.count = 0
+            self.__open()
+
+class SqliteSeen:
+    """
+    Exact set of URL fingerprints stored in an SQLite database at path
+
+    Additions are committed by flush(), which pickling also calls
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__open()
+
+    def __open(self):
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS seen (fingerprint INTEGER PRIMARY KEY) WITHOUT ROWID')
+
+    def __contains__(self, url):
+        return self.db.execute('SELECT 1 FROM seen WHERE fingerprint = ?', (url_fingerprint(url),)).fetchone() is not None
+
+    def add(self, url):
+        self.db.execute('INSERT OR IGNORE INTO seen VALUES (?)', (url_fingerprint(url),))
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+
+    def flush(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __getstate__(self):
+        self.flush()
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__open()
+
+def open_seen(kind, path=None, capacity=10000000, error_rate=0.001):
+    """
+    Returns an empty or existing seen-URL store
+        kind: 'set' (a Python set of URLs), 'bloom' or 'sqlite'
+        path: File of the 'bloom' (None to keep it in memory) or 'sqlite' store
+    """
+    if kind == 'set':
+        return set()
+    if kind == 'bloom':
+        return BloomFilter(capacity, error_rate, path)
+    if kind == 'sqlite':
+        return SqliteSeen(path)
+    raise ValueError(f'Unknown seen-URL store: {kind}')
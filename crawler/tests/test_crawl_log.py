@@ -0,0 +1,110 @@
+import os, pickle, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crawl_log import CrawlLog, CrawlState
+from frontier import Frontier
+
+SEED = "https://myanimelist.net/"
+
+# Returns a CrawlLog of a new crawl from SEED with its files in tmp_path
+def new_log(tmp_path, chunk_size = 100000, compact_bytes = 2**20):
+    frontier = Frontier([SEED], seen=set(), spill_dir=str(tmp_path / "frontier"), chunk_size=chunk_size)
+    frontier.extend([SEED])
+    log = CrawlLog(CrawlState(frontier, frontier.seen), str(tmp_path / "metadata.dat"), str(tmp_path / "url_map.dat"), str(tmp_path / "crawl_log"), compact_bytes)
+    log.replay()
+    log.compact()
+    return log
+
+# Returns the CrawlLog of tmp_path as a resumed crawl loads it, and the number of events replayed
+def resume(tmp_path, compact_bytes = 2**20):
+    with open(tmp_path / "metadata.dat", "rb") as f:
+        state = pickle.load(f)
+    with open(tmp_path / "url_map.dat", "rb") as f:
+        state.url_map = pickle.load(f)
+    log = CrawlLog(state, str(tmp_path / "metadata.dat"), str(tmp_path / "url_map.dat"), str(tmp_path / "crawl_log"), compact_bytes)
+    return log, log.replay()
+
+# Records fetching url and saving it as document doc_id, or as a near-duplicate of duplicate_of
+def visit(log, url, links, doc_id = None, duplicate_of = None):
+    log.record(('touch', url))
+    log.record(('visit', url))
+    if duplicate_of is None: log.record(('save', url, doc_id, None, None))
+    else: log.record(('duplicate', url, duplicate_of))
+    log.record(('links', url, links, [link for link in links if link not in log.state.touched]))
+
+def test_duplicate_saved_after_resume(tmp_path):
+    log = new_log(tmp_path)
+    [url] = log.record(('take', 1))
+    visit(log, url, [SEED + "a"], doc_id=0)
+    log.record(('done', url))
+    [url] = log.record(('take', 1))
+    # Recorded as a near-duplicate, but the crawl is killed before its done
+    visit(log, url, [], duplicate_of=0)
+    log.checkpoint()
+    log.file.close()
+    log, _ = resume(tmp_path)
+    assert log.state.frontier.in_flight == [url]
+    log.record(('requeue',))
+    [url] = log.record(('take', 1))
+    # Its page changed, so it is saved this time
+    visit(log, url, [SEED], doc_id=1)
+    log.record(('done', url))
+    assert url not in log.state.duplicates
+    assert set(log.state.url_map) == set(log.state.adj_dict) == {SEED, SEED + "a"}
+
+# Crawls n pages, page i linking to pages 2i + 1 and 2i + 2, recording 6 events
+# a page, and returns the urls saved
+def crawl(log, n, start = 0):
+    saved = []
+    for i in range(start, start + n):
+        [url] = log.record(('take', 1))
+        links = [f"{SEED}{2*i + 1}", f"{SEED}{2*i + 2}"]
+        visit(log, url, links, doc_id=i)
+        log.record(('done', url))
+        saved.append(url)
+    return saved
+
+# Returns the parts of a crawl state that resuming must restore
+def summary(state):
+    return (dict(state.url_map), {url: set(links) for url, links in state.adj_dict.items()}, state.pages_visited, state.docs_saved, len(state.frontier), list(state.frontier.in_flight))
+
+def test_replay_after_partial_record(tmp_path):
+    log = new_log(tmp_path)
+    crawl(log, 5)
+    log.checkpoint()
+    expected = summary(log.state)
+    # The crash cut the next record short
+    record = pickle.dumps(('visit', SEED + "x"))
+    log.file.write(record[:len(record) // 2])
+    log.file.close()
+    log, replayed = resume(tmp_path)
+    assert replayed == 5*6
+    assert summary(log.state) == expected
+    # The partial record is gone, so events recorded after it replay too
+    crawl(log, 1, 5)
+    expected = summary(log.state)
+    log.close()
+    log, _ = resume(tmp_path)
+    assert summary(log.state) == expected
+
+def test_replay_after_compaction(tmp_path):
+    # Small chunks, so the frontier spills and the snapshot refers to chunk files
+    log = new_log(tmp_path, chunk_size=2, compact_bytes=0)
+    crawl(log, 10)
+    log.checkpoint()
+    assert log.state.generation == 2
+    assert not os.path.exists(tmp_path / "crawl_log_1.dat")
+    crawl(log, 5, 10)
+    expected = summary(log.state)
+    log.close()
+    log, replayed = resume(tmp_path, compact_bytes=0)
+    assert replayed == 5*6
+    assert summary(log.state) == expected
+    assert any(name.endswith(".txt") for name in os.listdir(tmp_path / "frontier"))
+    # The frontier pops the urls it pops in the same crawl without a restart
+    (tmp_path / "uninterrupted").mkdir()
+    uninterrupted = new_log(tmp_path / "uninterrupted", chunk_size=2, compact_bytes=0)
+    crawl(uninterrupted, 15)
+    resumed, expected = ([frontier.pop() for _ in range(len(frontier))] for frontier in (log.state.frontier, uninterrupted.state.frontier))
+    assert len(resumed) == 16 and resumed == expected
@@ -0,0 +1,40 @@
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docstore import DocStore, INDEX_ENTRY
+
+def document(key):
+    return {'url': f'https://myanimelist.net/{key}', 'text': f'page {key} ' * 50}
+
+def test_reopen_after_torn_write(tmp_path):
+    directory = str(tmp_path / "docs")
+    # Small segments, so the documents span several
+    store = DocStore(directory, segment_bytes=256)
+    for key in range(10):
+        store.put(key, document(key))
+    store.flush()
+    segment_sizes = {name: os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.startswith('segment_')}
+    assert len(segment_sizes) > 1
+    store.put(10, document(10))
+    store.put(11, document(11))
+    store.close()
+    # The crash lost the end of the last segment and left half an index entry
+    last = max(segment_sizes, key=lambda name: int(name[len('segment_'):-len('.dat')]))
+    os.truncate(os.path.join(directory, last), segment_sizes[last])
+    for name in os.listdir(directory):
+        if name.startswith('segment_') and name not in segment_sizes:
+            os.remove(os.path.join(directory, name))
+    with open(os.path.join(directory, 'index.dat'), 'ab') as index:
+        index.write(INDEX_ENTRY.pack(12, 0, 0, 1, 0.0)[:INDEX_ENTRY.size // 2])
+
+    store = DocStore(directory, segment_bytes=256)
+    # Documents whose data was lost are dropped, along with every later index entry
+    assert sorted(store.keys()) == list(range(10))
+    assert all(store.get(key) == document(key) for key in range(10))
+    store.put(10, document(10))
+    store.close()
+    store = DocStore(directory, readonly=True)
+    assert sorted(store.keys()) == list(range(11))
+    assert dict(iter(store)) == {key: document(key) for key in range(11)}
+    store.close()
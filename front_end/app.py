@@ -1,6 +1,11 @@
 import os
 import sys
+import gzip
+import json
+import atexit
+import hashlib
 import inspect
+import zlib
 
 # Move CWD to parent dir to have access to search_engine
 # Code from https://stackoverflow.com/questions/714063/importing-modules-from-parent-folder
@@ -8,11 +13,18 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir) 
 
-from flask import Flask, render_template, request
-from search_engine.anime_search_engine import SearchEngine
+from flask import Flask, Response, jsonify, render_template, request, stream_with_context
+from search_engine.anime_search_engine import SearchEngine, decode_cursor
 
 
 app = Flask(__name__)
+mySearchEngine = None
+
+MAX_PAGELEN = 100 # Largest page /api/search returns
+MIN_GZIP_BYTES = 512 # Smaller responses are sent uncompressed
+# Seconds between the stack samples of the profiler served at /profile, which
+# only runs when this environment variable is set (e.g. SEARCH_PROFILE=0.005)
+PROFILE_ENV = 'SEARCH_PROFILE'
 
 @app.route('/')
 def index():
@@ -22,27 +34,198 @@ def index():
 @app.route('/search')
 def search():
     q = request.args.get('q')
-    print(q)
+    app.logger.debug('search %r', q)
     
     results = []
+    query = q
+    suggestion = None
     
     if q and mySearchEngine:
-        mySearchEngine.submit_query(q)
-        results = mySearchEngine.return_page(1)['docs']
+        # search() keeps no per-user state, so concurrent requests don't interfere
+        page = mySearchEngine.search(q)
+        results, query, suggestion = page['docs'], page['query'], page['suggestion']
        
-    return render_template("search_results.html", results=results)
+    if mySearchEngine is None:
+        return render_template("search_results.html", results=results, q=q, query=query, suggestion=suggestion)
+    with mySearchEngine.metrics.stage('render'):
+        return render_template("search_results.html", results=results, q=q, query=query, suggestion=suggestion)
+
+# Autocomplete: returns the completions of the prefix q as a JSON list
+@app.route('/suggest')
+def suggest():
+    q = request.args.get('q', '')
+    try:
+        limit = int_arg('limit', 10)
+    except ValueError as e:
+        return api_error(str(e))
+    if limit < 1:
+        return api_error('limit must be at least 1')
+
+    suggestions = []
+
+    if q and mySearchEngine:
+        suggestions = mySearchEngine.suggest(q, limit)
+
+    return jsonify(suggestions)
+
+def parse_conj(value):
+    """
+    Returns the conj argument of search() for an "and"/"or" (or true/false) request argument
+    """
+    if value is None:
+        return None
+    value = value.lower()
+    if value in ('and', 'true', '1'):
+        return True
+    if value in ('or', 'false', '0'):
+        return False
+    raise ValueError(f"conj must be and or or, not {value!r}")
+
+def int_arg(name, default=None):
+    """
+    Returns the integer request argument name, or default if it is absent
+
+    Raises ValueError if it isn't an integer, where request.args.get(type=int)
+    would quietly return the default
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, not {value!r}")
+
+def api_error(message, status=400):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+def accepts_gzip():
+    return 'gzip' in request.accept_encodings
+
+def gzip_stream(chunks):
+    """
+    Compresses the chunks of a streamed response, flushing after each one so clients read rows as they come
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # 31: gzip container
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def ndjson_rows(rows):
+    for row in rows:
+        yield (json.dumps(row, ensure_ascii=False) + '\n').encode('utf-8')
+
+# JSON search API, for clients that page through results themselves:
+#   q, page, pagelen (at most MAX_PAGELEN), conj (and | or)
+#   cursor: the "next" or "prev" cursor of an earlier response, which replaces the above
+#   format=ndjson: streams every result (the first limit if given) as one JSON object
+#       per line, ranked once however deep the export goes
+# Responses carry an ETag made from the request and the version of the index, so a
+# repeated request with If-None-Match gets a 304 without searching, and they are
+# gzip-compressed for clients that accept it. Invalid arguments get a 400 with a
+# JSON {"error"}, before anything is searched.
+@app.route('/api/search')
+def api_search():
+    if mySearchEngine is None:
+        return api_error('search engine not loaded', 503)
+    args = request.args
+    q, cursor = args.get('q'), args.get('cursor')
+    export = args.get('format') == 'ndjson'
+    try:
+        page = int_arg('page', 1)
+        pagelen = int_arg('pagelen', mySearchEngine.limit)
+        limit = int_arg('limit')
+        conj = parse_conj(args.get('conj'))
+        if cursor:
+            q, page, pagelen, conj = decode_cursor(cursor)
+    except ValueError as e:
+        return api_error(str(e))
+    if not q:
+        return api_error('q or cursor is required')
+    if page < 1 or not 1 <= pagelen <= MAX_PAGELEN:
+        return api_error(f'page must be at least 1 and pagelen between 1 and {MAX_PAGELEN}')
+    # Checked here, since a streamed export can't turn into an error once it has started
+    if limit is not None and limit < 1:
+        return api_error('limit must be at least 1')
+
+    # Weak, since the gzipped and plain bodies are the same results. version()
+    # brings the engine up to date, so the search below needn't check again.
+    key = json.dumps([mySearchEngine.version(), sorted(args.items(multi=True))])
+    etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    elif export:
+        rows = ndjson_rows(mySearchEngine.iter_results(q, conj, limit, snippets=args.get('snippets') == '1', refresh=False))
+        if accepts_gzip():
+            rows = gzip_stream(rows)
+        response = Response(stream_with_context(rows), mimetype='application/x-ndjson')
+        if accepts_gzip():
+            response.headers['Content-Encoding'] = 'gzip'
+    else:
+        # A cursor holds an already rewritten query, which must not be rewritten again
+        if cursor:
+            results = mySearchEngine.search(cursor=cursor, refresh=False)
+        else:
+            results = mySearchEngine.search(q, page, pagelen, conj, refresh=False)
+        with mySearchEngine.metrics.stage('serialize'):
+            response = jsonify(results)
+            if accepts_gzip() and response.content_length >= MIN_GZIP_BYTES:
+                response.set_data(gzip.compress(response.get_data(), 6))
+                response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag, weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Clients may keep responses but must revalidate them, which costs only a 304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# Stage timings and counters of this process in the Prometheus text format
+@app.route('/metrics')
+def metrics():
+    text = mySearchEngine.metrics.render() if mySearchEngine else ''
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+# Stacks sampled by the profiler since the process started, in the collapsed
+# "frame;frame;frame count" format of flamegraph.pl and speedscope
+@app.route('/profile')
+def profile():
+    if mySearchEngine is None or mySearchEngine.metrics.sampler is None:
+        return Response(f'profiler is off, set {PROFILE_ENV} to turn it on\n', status=404, mimetype='text/plain')
+    try:
+        limit = int_arg('limit')
+    except ValueError as e:
+        return Response(f'{e}\n', status=400, mimetype='text/plain')
+    if limit is not None and limit < 1:
+        return Response('limit must be at least 1\n', status=400, mimetype='text/plain')
+    return Response(mySearchEngine.metrics.profile(limit), mimetype='text/plain')
+
+def create_app():
+    """
+    Opens the search engine and returns the Flask app.
+
+    Every worker process of a multi-worker server calls this once, opening its
+    own read-only view of the index on disk, e.g.
+        gunicorn -w 4 'app:create_app()'
+    """
+    global mySearchEngine
+    if mySearchEngine is None:
+        dir = os.path.join(parentdir, 'search_engine')
+        mySearchEngine = SearchEngine(
+            index_dir=f'{dir}/indexdir/'
+            , page_rank_file=f'{dir}/page_rank.dat'
+            , url_map_file=f'{dir}/sample/url_map.dat'
+            , docs_raw_dir=f'{dir}/sample/_docs_raw/'
+            , docs_cleaned_dir=f'{dir}/sample/_docs_cleaned/'
+            , metrics=True)
+        if os.environ.get(PROFILE_ENV):
+            mySearchEngine.metrics.start_profiler(float(os.environ[PROFILE_ENV]))
+        atexit.register(mySearchEngine.close_searcher)
+    return app
     
 def start_app():
-    global mySearchEngine
-    dir = 'search_engine'
-    mySearchEngine = SearchEngine(
-        index_dir=f'../{dir}/indexdir/'
-        , page_rank_file=f'../{dir}/page_rank.dat'
-        , url_map_file=f'../{dir}/sample/url_map.dat'
-        , docs_raw_dir=f'../{dir}/sample/_docs_raw/'
-        , docs_cleaned_dir=f'../{dir}/sample/_docs_cleaned/')
-    app.run(debug=True)
-    mySearchEngine.close_searcher()
+    create_app()
+    app.run(debug=True, threaded=True)
 
 if __name__ == '__main__':
     start_app()
\ No newline at end of file
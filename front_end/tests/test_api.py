@@ -0,0 +1,78 @@
+import json
+import os
+import pickle
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as front_end
+from search_engine.anime_search_engine import SearchEngine
+
+SAMPLE_DIR = os.path.join(front_end.parentdir, 'search_engine', 'sample')
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    """
+    A test client of the app over an index of the sample documents
+    """
+    tmp_path = tmp_path_factory.mktemp('api')
+    with open(os.path.join(SAMPLE_DIR, 'url_map.dat'), 'rb') as file:
+        urls = pickle.load(file)
+    page_rank_file = str(tmp_path / 'page_rank.dat')
+    with open(page_rank_file, 'wb') as file:
+        pickle.dump({url: (i + 1) / len(urls) for i, url in enumerate(urls)}, file)
+    engine = SearchEngine(
+        index_dir=str(tmp_path / 'indexdir')
+        , page_rank_file=page_rank_file
+        , url_map_file=os.path.join(SAMPLE_DIR, 'url_map.dat')
+        , docs_raw_dir=os.path.join(SAMPLE_DIR, '_docs_raw') + '/'
+        , docs_cleaned_dir=os.path.join(SAMPLE_DIR, '_docs_cleaned') + '/'
+        , doc_store_dir=str(tmp_path / '_docs') + '/'
+        , index_procs=1
+        , metrics=True)
+    front_end.mySearchEngine = engine
+    yield front_end.app.test_client()
+    front_end.mySearchEngine = None
+    engine.close_searcher()
+
+def test_cursor_paging(client):
+    first = client.get('/api/search?q=studio&pagelen=7').get_json()
+    assert first['total'] > 7 and first['prev'] is None
+    pages = [first]
+    while pages[-1]['next']:
+        pages.append(client.get('/api/search', query_string={'cursor': pages[-1]['next']}).get_json())
+    urls = [doc['url'] for page in pages for doc in page['docs']]
+    assert len(urls) == len(set(urls)) == first['total']
+    assert [page['page'] for page in pages] == list(range(1, first['pagecount'] + 1))
+    assert client.get('/api/search', query_string={'cursor': pages[1]['prev']}).get_json()['docs'] == first['docs']
+
+def test_etag(client):
+    response = client.get('/api/search?q=studio')
+    etag = response.headers['ETag']
+    assert response.status_code == 200 and etag.startswith('W/')
+    assert client.get('/api/search?q=studio', headers={'If-None-Match': etag}).status_code == 304
+    # Another request has another tag
+    assert client.get('/api/search?q=studio&page=2', headers={'If-None-Match': etag}).status_code == 200
+
+def test_ndjson_limit(client):
+    response = client.get('/api/search?q=studio&format=ndjson&limit=3')
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert response.status_code == 200 and [row['rank'] for row in rows] == [1, 2, 3]
+    for limit in ('0', '-1', 'abc'):
+        response = client.get('/api/search', query_string={'q': 'studio', 'format': 'ndjson', 'limit': limit})
+        assert response.status_code == 400 and 'limit' in response.get_json()['error']
+
+@pytest.mark.parametrize('query_string', [
+    {'page': 'abc', 'q': 'studio'}
+    , {'page': '0', 'q': 'studio'}
+    , {'pagelen': '1.5', 'q': 'studio'}
+    , {'pagelen': str(front_end.MAX_PAGELEN + 1), 'q': 'studio'}
+    , {'conj': 'maybe', 'q': 'studio'}
+    , {'cursor': 'not a cursor'}
+    , {}
+])
+def test_bad_parameters(client, query_string):
+    response = client.get('/api/search', query_string=query_string)
+    assert response.status_code == 400 and response.get_json()['error']
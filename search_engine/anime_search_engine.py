@@ -3,39 +3,115 @@ from whoosh.fields import *
 from whoosh.analysis import StemmingAnalyzer
 from whoosh.qparser import QueryParser, OrGroup, AndGroup
 from whoosh.searching import ResultsPage
-from whoosh import scoring
+from whoosh import scoring, columns
+from math import ceil
 
-from bs4 import BeautifulSoup
+import numpy as np
+import base64, json, os, pickle, sys, threading
 
-import os, pickle
+try:
+	from .weighting import PageRankBM25F, CountingBM25F
+	from .searcher_pool import SearcherPool
+	from .lru_cache import LRUCache
+	from .ingest import iter_documents, open_store, Progress
+	from .suggest import Suggester
+	from .spelling import Lexicon, correct_query
+	from .snippets import SnippetMaker, make_excerpt
+	from .metrics import Metrics
+except ImportError:
+	from weighting import PageRankBM25F, CountingBM25F
+	from searcher_pool import SearcherPool
+	from lru_cache import LRUCache
+	from ingest import iter_documents, open_store, Progress
+	from suggest import Suggester
+	from spelling import Lexicon, correct_query
+	from snippets import SnippetMaker, make_excerpt
+	from metrics import Metrics
 
 # This function is needed because the scoring.FunctionWeighting.FunctionScorer
 # needs a max_quality function.
 def max_quality(self):
 	return 9999
 
+# Returns an opaque token that search() turns back into the same query and page
+def encode_cursor(query_string, page, pagelen, conj):
+	return base64.urlsafe_b64encode(json.dumps([query_string, page, pagelen, conj]).encode()).decode()
+
+# Returns (query_string, page, pagelen, conj) for a token made by encode_cursor
+def decode_cursor(cursor):
+	try:
+		query_string, page, pagelen, conj = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+	except Exception:
+		raise ValueError(f"invalid cursor: {cursor!r}")
+	return query_string, int(page), int(pagelen), bool(conj)
+
+# page_rank is a column of doubles rather than a float NUMERIC because Whoosh 2.7
+# packs sortable float NUMERIC columns with an integer typecode and can't write them
+# content_hash lets update_index() tell which documents changed
+# excerpt holds the compressed start of the content, which is not stored, for snippets
+SCHEMA = Schema(title=TEXT(stored=True), url = ID(stored=True, unique=True), content=TEXT(analyzer=StemmingAnalyzer()), page_rank=COLUMN(columns.NumericColumn("d", default=0.0)), content_hash=ID(stored=True), excerpt=STORED())
+
 class SearchEngine(object):
 
-	def __init__(self, index_dir = "./indexdir", page_rank_file = "./page_rank.dat", url_map_file = "./sample/url_map.dat", docs_raw_dir = "./sample/_docs_raw/", docs_cleaned_dir = "./sample/_docs_cleaned/", debug = False):
+	# scoring_mode selects how PageRank and BM25F are combined:
+	#	"pagerank" - PageRankBM25F weighting over a per-docnum PageRank array
+	#	"function" - the original FunctionWeighting callback (kept for comparison)
+	#	"rerank"   - BM25F top candidate_depth documents, reranked with PageRank
+	#	"static"   - the first candidate_depth matches of each segment in PageRank
+	#	             order (documents are indexed by descending PageRank), reranked
+	# spelling selects what happens to a query that matches nothing:
+	#	"auto"    - misspelled words are corrected and the corrected query is run
+	#	"suggest" - the corrected query is only returned as a suggestion
+	#	"off"     - no correction
+	# and with or_fallback an AND query that still matches nothing is run as an OR query
+	# With snippets, every result has a highlighted "snippet" of its content, and
+	# the last snippet_cache_size snippets made are cached
+	# With metrics, the stages of every query are timed and counted in self.metrics
+	def __init__(self, index_dir = "./indexdir", page_rank_file = "./page_rank.dat", url_map_file = "./sample/url_map.dat", docs_raw_dir = "./sample/_docs_raw/", docs_cleaned_dir = "./sample/_docs_cleaned/", doc_store_dir = "./sample/_docs/", debug = False, scoring_mode = "pagerank", pr_weight = 100000, bm25_weight = 1.5, candidate_depth = 200, pool_size = 8, cache_size = 256, cache_pages = 5, index_procs = None, index_memory_mb = 1024, spelling = "auto", or_fallback = True, snippets = True, snippet_cache_size = 1024, metrics = False):
 		# File and directory attributes
 		self.index_dir = index_dir
 		self.page_rank_file = page_rank_file
 		self.url_map_file = url_map_file
 		self.docs_raw_dir = docs_raw_dir
 		self.docs_cleaned_dir = docs_cleaned_dir
+		self.doc_store_dir = doc_store_dir # Document store of url maps that hold document ids
+		self.index_procs = index_procs or os.cpu_count() or 1 # Processes used to build the index
+		self.index_memory_mb = index_memory_mb # Memory the index writers may use, in total, before spilling to disk
 		# Whoosh index/scoring attributes
-		self.schema = Schema(title=TEXT(stored=True), url = ID(stored=True), content=TEXT(analyzer=StemmingAnalyzer()))
+		self.schema = SCHEMA
+		self.page_rank = None # url -> PageRank dictionary, only unpickled when needed
 		self.ix = self.__get_indexer()
 		self.limit = 10 # Number of results displayed
 		self.conj = True
-		self.size = self.ix.doc_count()
-		self.page_rank = self.__unpickle(page_rank_file)
-		assert self.size == len(self.page_rank), "the index and page rank don't match"
-		# Whoosh Paging Attributes
-		custom_weighting = scoring.FunctionWeighting(self.__custom_scorer)
-		custom_weighting.FunctionScorer.max_quality = max_quality
-		self.searcher = self.ix.searcher(weighting=custom_weighting)
-		self.document_list = list(self.searcher.documents())
+		self.pr_weight = pr_weight
+		self.bm25_weight = bm25_weight
+		self.scoring_mode = scoring_mode
+		self.candidate_depth = candidate_depth # Documents reranked by the "rerank" and "static" modes
+		self.pr_generation = None
+		self.pr_array = None
+		self.suggester = None # Loaded on the first suggest()
+		if spelling not in ("auto", "suggest", "off"): raise ValueError(f"unknown spelling mode: {spelling}")
+		self.spelling = spelling
+		self.or_fallback = or_fallback
+		self.lexicon = None # Loaded on the first query that needs correcting
+		# Searchers are borrowed from the pool per query so one SearchEngine
+		# can serve many threads at once
+		self.weighting = self.__get_weighting()
+		self.pool = SearcherPool(lambda: self.ix.searcher(weighting=self.weighting), pool_size)
+		with self.pool.searcher() as searcher:
+			self.size = searcher.doc_count()
+		# Ranked docnums of the first cache_pages pages of recent queries
+		self.cache = LRUCache(cache_size)
+		self.cache_pages = cache_pages
+		self.snippets = snippets
+		self.snippet_maker = SnippetMaker(self.schema["content"].analyzer)
+		# Keyed by content_hash, so entries of changed documents are never hit again
+		self.snippet_cache = LRUCache(snippet_cache_size)
+		self.metrics = Metrics(metrics)
+		self.__register_metrics()
+		self.stamp = self.__stamp()
+		self.refresh_lock = threading.Lock()
+		# Paging attributes of the single-user submit_query/print_page interface
 		self.current_query = None
 		self.current_page = 1
 		self.debug = debug
@@ -56,34 +132,496 @@ class SearchEngine(object):
 	# Returns a new indexer with a Whoosh Index
 	def __create_index(self):
 		ix = create_in(self.index_dir, self.schema)
-		writer = ix.writer(limitmb=1024, procs=4, multisegment=True)
+		# Each of the index_procs writers gets its share of the memory budget
+		writer = ix.writer(limitmb=max(1, self.index_memory_mb // self.index_procs), procs=self.index_procs, multisegment=self.index_procs > 1)
 		urls = self.__unpickle(self.url_map_file)
-		_title = ""
-		_content = ""
-		count = 1
-		# For each url mapped to a file name
-		for u in urls:
-			file_name = urls[u]
-			# Get the title for the file name
-			with open(self.docs_raw_dir+file_name, "r") as html:
-				_title = BeautifulSoup(html.read(), "lxml").title.string.strip()
-			# Get the text content for the file name
-			with open(self.docs_cleaned_dir+file_name, "r") as text:
-				_content = text.read()
-			print(f"({count}) Indexing {file_name}")
-			writer.add_document(title=_title, url=u, content=_content)
-			count += 1
+		# For each url mapped to a file name, highest PageRank first so that
+		# docnum order within a segment is static rank order
+		page_rank = self.__get_page_rank()
+		order = sorted(urls, key=lambda u: page_rank[u], reverse=True)
+		progress = Progress(len(order))
+		# Titles and contents are read by a process pool while this process feeds the writer
+		for u, _title, _content, _hash in iter_documents(((u, urls[u]) for u in order), self.docs_raw_dir, self.docs_cleaned_dir, self.index_procs, doc_store_dir=self.doc_store_dir):
+			writer.add_document(**self.__document(ix.schema, u, _title, _content, _hash, page_rank[u]))
+			progress.update()
 		writer.commit()
+		self.__write_page_rank_array(ix)
+		self.__write_suggester(ix)
+		self.__write_lexicon(ix)
 		return ix
 
+	# Brings the index up to date with url_map_file and page_rank_file: adds new
+	# urls, reindexes urls whose cleaned document changed and deletes urls that are
+	# no longer mapped. Only files modified since the last commit are reread and
+	# hashed, so the cost follows the size of the change rather than of the corpus.
+	# The index is optimized into one segment once it has more than max_segments.
+	# Returns the number of documents added, updated, deleted and left unchanged.
+	def update_index(self, max_segments = 8):
+		urls = self.__unpickle(self.url_map_file)
+		self.page_rank = None # Reload in case page_rank_file changed
+		page_rank = self.__get_page_rank()
+		last_commit = os.stat(self.__toc_path(self.ix)).st_mtime
+		if os.path.isdir(self.doc_store_dir): open_store(self.doc_store_dir, reload=True) # Pick up documents written since it was opened
+		with self.ix.reader() as reader:
+			indexed = {fields["url"]: fields.get("content_hash") for _, fields in reader.iter_docs()}
+		added = [u for u in urls if u not in indexed]
+		deleted = [u for u in indexed if u not in urls]
+		# Files untouched since the last commit can't have changed, and documents
+		# indexed before content_hash existed are always reread
+		candidates = [u for u in urls if u in indexed and (indexed[u] is None or self.__doc_mtime(urls[u]) >= last_commit)]
+		counts = {'added': 0, 'updated': 0, 'deleted': len(deleted), 'unchanged': len(urls) - len(added) - len(candidates)}
+		writer = self.ix.writer(limitmb=self.index_memory_mb)
+		for u in deleted: writer.delete_by_term("url", u)
+		progress = Progress(len(added) + len(candidates))
+		for u, _title, _content, _hash in iter_documents(((u, urls[u]) for u in added + candidates), self.docs_raw_dir, self.docs_cleaned_dir, self.index_procs, doc_store_dir=self.doc_store_dir):
+			progress.update()
+			if u in indexed:
+				if indexed[u] == _hash:
+					counts['unchanged'] += 1
+					continue
+				writer.delete_by_term("url", u)
+				counts['updated'] += 1
+			else:
+				counts['added'] += 1
+			writer.add_document(**self.__document(self.ix.schema, u, _title, _content, _hash, page_rank.get(u, 0.0)))
+		if counts['added'] + counts['updated'] + counts['deleted'] == 0:
+			writer.cancel()
+		else:
+			with self.ix.reader() as reader:
+				segments = len(reader.leaf_readers()) if not reader.is_atomic() else 1
+			writer.commit(optimize=segments >= max_segments)
+		# page_rank_file is the source of truth for every document, not only the ones written
+		self.__write_page_rank_array(self.ix, page_rank)
+		self.__write_suggester(self.ix)
+		if not os.path.exists(self.__lexicon_path(self.ix.latest_generation())): self.__write_lexicon(self.ix)
+		return counts
+
+	# Returns the fields of a document to index with schema. Indexes written before
+	# the page_rank, content_hash or excerpt fields existed keep their schema, so
+	# their documents only get the fields it has.
+	def __document(self, schema, url, title, content, content_hash, page_rank):
+		fields = {'title': title, 'url': url, 'content': content, 'page_rank': page_rank, 'content_hash': content_hash}
+		if "excerpt" in schema: fields['excerpt'] = make_excerpt(content)
+		return {name: value for name, value in fields.items() if name in schema}
+
+	# Returns when the document doc of the url map was last written
+	def __doc_mtime(self, doc):
+		if isinstance(doc, int): return open_store(self.doc_store_dir).mtime(doc)
+		return os.stat(self.docs_cleaned_dir+doc).st_mtime
+
+	# Swaps in new PageRank scores without touching any postings: rebuilds the
+	# PageRank array from page_rank_file for the current index generation. Queries
+	# pick up a changed page_rank_file by themselves, this just does it eagerly.
+	def reload_page_rank(self):
+		self.page_rank = None
+		self.__write_page_rank_array(self.ix, self.__get_page_rank())
+		self.__write_suggester(self.ix)
+		self.__refresh()
+
+	# Returns the path of the table of contents file of the latest generation of ix
+	def __toc_path(self, ix):
+		return os.path.join(self.index_dir, f"_{ix.indexname}_{ix.latest_generation()}.toc")
+
+	# Returns the weighting model for self.scoring_mode
+	def __get_weighting(self):
+		if self.scoring_mode == "pagerank":
+			return PageRankBM25F(self.__get_page_rank_array(), a=self.pr_weight, b=self.bm25_weight)
+		if self.scoring_mode in ("rerank", "static"):
+			self.__get_page_rank_array()
+			return CountingBM25F()
+		if self.scoring_mode == "function":
+			with self.ix.searcher() as searcher:
+				self.document_list = list(searcher.documents())
+			custom_weighting = scoring.FunctionWeighting(self.__custom_scorer)
+			custom_weighting.FunctionScorer.max_quality = max_quality
+			return custom_weighting
+		raise ValueError(f"unknown scoring mode: {self.scoring_mode}")
+
+	# Returns the url -> PageRank dictionary, unpickling it the first time
+	def __get_page_rank(self):
+		if self.page_rank is None: self.page_rank = self.__unpickle(self.page_rank_file)
+		return self.page_rank
+
+	# Returns a read-only array of PageRank scores indexed by docnum. The array is
+	# memory-mapped from a sidecar file in the index directory, which is written
+	# once per index generation and again whenever page_rank_file is replaced.
+	def __get_page_rank_array(self):
+		generation = self.ix.latest_generation()
+		path = self.__page_rank_array_path(generation)
+		pr_mtime = self.__page_rank_file_mtime()
+		if not os.path.exists(path) or (pr_mtime is not None and pr_mtime > os.stat(path).st_mtime_ns):
+			self.__write_page_rank_array(self.ix)
+		self.pr_array = np.load(path, mmap_mode="r")
+		self.pr_generation = generation
+		return self.pr_array
+
+	def __page_rank_file_mtime(self):
+		try:
+			return os.stat(self.page_rank_file).st_mtime_ns
+		except OSError:
+			return None
+
+	def __page_rank_array_path(self, generation):
+		return os.path.join(self.index_dir, f"page_rank_{generation}.npy")
+
+	# Writes the sidecar PageRank array for the latest generation of ix and removes
+	# the arrays of older generations. Scores come from the page_rank dictionary if
+	# given, from page_rank_file if it changed after the index was written (or the
+	# index has no page_rank column), and otherwise straight from the column.
+	def __write_page_rank_array(self, ix, page_rank = None):
+		generation = ix.latest_generation()
+		pr_mtime = self.__page_rank_file_mtime()
+		with ix.reader() as reader:
+			if page_rank is None and "page_rank" in reader.schema and reader.has_column("page_rank") and (pr_mtime is None or pr_mtime <= os.stat(self.__toc_path(ix)).st_mtime_ns):
+				pr_array = np.fromiter(reader.column_reader("page_rank"), dtype=np.float64, count=reader.doc_count_all())
+			else:
+				if page_rank is None:
+					self.page_rank = None
+					page_rank = self.__get_page_rank()
+				pr_array = np.zeros(reader.doc_count_all(), dtype=np.float64)
+				for docnum, fields in reader.iter_docs():
+					pr_array[docnum] = page_rank.get(fields["url"], 0.0)
+		path = self.__page_rank_array_path(generation)
+		# Write then rename so other processes never map a half written file
+		tmp_path = f"{path}.{os.getpid()}.tmp"
+		with open(tmp_path, "wb") as f:
+			np.save(f, pr_array)
+		os.replace(tmp_path, path)
+		for name in os.listdir(self.index_dir):
+			if name.startswith("page_rank_") and name.endswith(".npy") and name != os.path.basename(path):
+				os.remove(os.path.join(self.index_dir, name))
+
+	def __suggester_path(self, generation):
+		return os.path.join(self.index_dir, f"suggest_{generation}.pkl")
+
+	# Writes the suggestions of the latest generation of ix, weighted by its sidecar
+	# PageRank array, and removes the suggestions of older generations
+	def __write_suggester(self, ix):
+		generation = ix.latest_generation()
+		pr_array = np.load(self.__page_rank_array_path(generation), mmap_mode="r")
+		with ix.reader() as reader:
+			suggester = Suggester.from_reader(reader, pr_array)
+		path = self.__suggester_path(generation)
+		suggester.save(path)
+		for name in os.listdir(self.index_dir):
+			if name.startswith("suggest_") and name.endswith(".pkl") and name != os.path.basename(path):
+				os.remove(os.path.join(self.index_dir, name))
+
+	# Returns the Suggester of the latest index generation, loading it from its file
+	# in the index directory and rebuilding the file if it is missing or older than
+	# page_rank_file
+	def __get_suggester(self):
+		suggester = self.suggester
+		if suggester is not None: return suggester
+		path = self.__suggester_path(self.ix.latest_generation())
+		pr_mtime = self.__page_rank_file_mtime()
+		if not os.path.exists(path) or (pr_mtime is not None and pr_mtime > os.stat(path).st_mtime_ns):
+			self.__get_page_rank_array()
+			self.__write_suggester(self.ix)
+		self.suggester = Suggester.load(path)
+		return self.suggester
+
+	# Returns up to limit query completions of prefix: titles and title words of
+	# indexed documents, highest PageRank first
+	def suggest(self, prefix, limit = 10):
+		self.__refresh()
+		with self.metrics.stage("suggest"):
+			return self.__get_suggester().suggest(prefix, limit)
+
+	def __lexicon_path(self, generation):
+		return os.path.join(self.index_dir, f"lexicon_{generation}.pkl")
+
+	# Writes the spelling Lexicon of the latest generation of ix and removes the
+	# lexicons of older generations
+	def __write_lexicon(self, ix):
+		with ix.reader() as reader:
+			lexicon = Lexicon.from_reader(reader)
+		path = self.__lexicon_path(ix.latest_generation())
+		lexicon.save(path)
+		for name in os.listdir(self.index_dir):
+			if name.startswith("lexicon_") and name.endswith(".pkl") and name != os.path.basename(path):
+				os.remove(os.path.join(self.index_dir, name))
+
+	# Returns the Lexicon of the latest index generation, loading it from its file in
+	# the index directory and writing the file if it is missing or outdated
+	def __get_lexicon(self):
+		lexicon = self.lexicon
+		if lexicon is not None: return lexicon
+		path = self.__lexicon_path(self.ix.latest_generation())
+		lexicon = Lexicon.load(path) if os.path.exists(path) else None
+		if lexicon is None:
+			self.__write_lexicon(self.ix)
+			lexicon = Lexicon.load(path)
+		self.lexicon = lexicon
+		return self.lexicon
+
+	# Returns query_string with the words whose content term is in no document
+	# replaced by the closest, most frequent word of the index (words are left as
+	# they are when nothing is close enough)
+	def correct_query(self, query_string):
+		self.__refresh()
+		return self.__correct_query(query_string)
+
+	def __correct_query(self, query_string):
+		lexicon = self.__get_lexicon()
+		analyzer = self.schema["content"].analyzer
+		with self.pool.searcher() as searcher:
+			reader = searcher.reader()
+			def is_known(word):
+				# Words the analyzer drops, like stop words, are never searched for
+				stems = [token.text for token in analyzer(word)]
+				return all(reader.doc_frequency("content", stem) > 0 for stem in stems)
+			return correct_query(query_string, lexicon, is_known)
+
+	# Returns whether query_string matches any document. Nothing is scored and the
+	# query cache is left alone, so the ranking that follows is the query's only one.
+	def __matches(self, query_string, conj):
+		query = self.parse_query(query_string, conj)
+		with self.pool.searcher() as searcher:
+			return next(searcher.docs_for_query(query), None) is not None
+
+	# Returns (query_string, conj, suggestion) to run for a query: the query itself
+	# if it matches anything, otherwise (following self.spelling and
+	# self.or_fallback) its spelling correction, then the correction or the query
+	# ORing its terms. suggestion is the corrected query if it differs, else None.
+	def rewrite_query(self, query_string, conj):
+		self.__refresh()
+		return self.__rewrite_query(query_string, conj)
+
+	def __rewrite_query(self, query_string, conj):
+		if self.spelling == "off" and not (conj and self.or_fallback): return query_string, conj, None
+		if self.__matches(query_string, conj): return query_string, conj, None
+		with self.metrics.stage("correct"):
+			suggestion = self.__correct_query(query_string) if self.spelling != "off" else query_string
+		if suggestion == query_string: suggestion = None
+		run = suggestion if suggestion and self.spelling == "auto" else query_string
+		if run != query_string and self.__matches(run, conj):
+			self.metrics.count("spelling_corrections")
+			return run, conj, suggestion
+		if conj and self.or_fallback and self.__matches(run, False):
+			self.metrics.count("or_fallbacks")
+			if run != query_string: self.metrics.count("spelling_corrections")
+			return run, False, suggestion
+		return query_string, conj, suggestion
+
 	# Combines page rank and bm25 to be used with scoring.FunctionWeighting
 	def __custom_scorer(self, searcher, fieldname, text, matcher):
 		url = self.document_list[matcher.id()]["url"]
-		pr = self.page_rank[url]
+		pr = self.__get_page_rank().get(url, 0.0)
 		bm25 = scoring.BM25F().scorer(searcher, fieldname, text).score(matcher)
-		a = 100000 # Most PageRank is 1E-6 place
-		b = 1.5
-		return a*pr + b*bm25
+		return self.pr_weight*pr + self.bm25_weight*bm25
+
+	# Returns (total, docnums) for the best limit documents matching query
+	def __rank(self, searcher, query, limit):
+		with self.metrics.stage("rank"):
+			if not self.metrics.enabled: return self.__rank_with(searcher, query, limit)
+			# PageRankBM25F and CountingBM25F count the postings it scores on this thread while asked to
+			tally = getattr(searcher.weighting, "tally", None)
+			postings = [0]
+			if tally is not None: tally.postings = postings
+			try:
+				return self.__rank_with(searcher, query, limit)
+			finally:
+				if tally is not None: del tally.postings
+				self.metrics.count("postings_scored", postings[0])
+
+	# In the "rerank" and "static" modes only the candidates are ranked, so total
+	# counts them rather than every match and paging stops after the last one
+	def __rank_with(self, searcher, query, limit):
+		if self.scoring_mode == "rerank":
+			results = searcher.search(query, limit=self.candidate_depth, terms=True)
+			candidates = [(bm25, docnum, len(results.docterms.get(docnum, ()))) for bm25, docnum in results.top_n]
+			return len(candidates), self.__rerank(candidates)[:limit]
+		if self.scoring_mode == "static":
+			return self.__static_rank(searcher, query, limit)
+		results = searcher.search(query, limit=limit)
+		return len(results), [docnum for _, docnum in results.top_n]
+
+	# Returns __rank(searcher, query, limit), answered from the cache while limit
+	# falls within the first self.cache_pages pages
+	def __cached_rank(self, searcher, query, limit, conj):
+		depth = self.cache_pages*self.limit
+		if limit > depth: return self.__rank(searcher, query, limit)
+		# Parsed queries are normalized, so equivalent query strings share a key. The
+		# generation is that of the searcher, so a query still running on an old
+		# generation after __refresh() never caches docnums for the new one.
+		key = (repr(query), conj, searcher.reader().generation())
+		ranked = self.cache.get(key)
+		if ranked is None:
+			ranked = self.__rank(searcher, query, depth)
+			self.cache.put(key, ranked)
+		total, docnums = ranked
+		return total, docnums[:limit]
+
+	# Returns what searchers, the PageRank array and cached rankings depend on:
+	# the index generation and page_rank_file
+	def __stamp(self):
+		return (self.ix.latest_generation(), self.__page_rank_file_mtime())
+
+	# Picks up a new index generation or page_rank_file before a query: reloads the
+	# PageRank array and weighting, opens new searchers and empties the query cache.
+	# Listing the index directory costs a system call, so every public method calls
+	# this once and the private methods it uses don't.
+	def __refresh(self):
+		stamp = self.__stamp()
+		if stamp == self.stamp: return
+		with self.refresh_lock:
+			if stamp == self.stamp: return
+			if stamp[1] != self.stamp[1]: self.page_rank = None
+			old_pool = self.pool
+			self.weighting = self.__get_weighting()
+			self.pool = SearcherPool(lambda: self.ix.searcher(weighting=self.weighting), old_pool.size)
+			with self.pool.searcher() as searcher:
+				self.size = searcher.doc_count()
+			self.cache.clear()
+			self.suggester = None
+			if stamp[0] != self.stamp[0]: self.lexicon = None
+			self.stamp = stamp
+			# Searchers still in use by other queries are left to the garbage collector
+			old_pool.close()
+
+	# Returns a string that changes whenever search results may change (a new index
+	# generation or page_rank_file), for HTTP caching. The engine is brought up to
+	# date first, so a search(refresh=False) that follows returns results of this version.
+	def version(self):
+		self.__refresh()
+		generation, pr_mtime = self.stamp
+		return f"{generation}-{pr_mtime}"
+
+	# Returns the query cache's hit/miss counters and size
+	def cache_info(self):
+		return self.cache.info()
+
+	# Returns the snippet cache's hit/miss counters and size
+	def snippet_cache_info(self):
+		return self.snippet_cache.info()
+
+	# Adds the values the engine keeps anyway, like the cache counters, to
+	# self.metrics; they are only read when the metrics are rendered
+	def __register_metrics(self):
+		register = self.metrics.register
+		register("query_cache_hits_total", "counter", "Queries ranked from the query cache", lambda: self.cache.hits)
+		register("query_cache_misses_total", "counter", "Queries ranked from the index", lambda: self.cache.misses)
+		register("snippet_cache_hits_total", "counter", "Snippets served from the snippet cache", lambda: self.snippet_cache.hits)
+		register("snippet_cache_misses_total", "counter", "Snippets rendered from stored excerpts", lambda: self.snippet_cache.misses)
+		register("index_documents", "gauge", "Documents in the index", lambda: self.size)
+
+	# Returns the frozenset of content terms of a parsed query, the words snippets highlight
+	def __query_terms(self, query):
+		return frozenset(text for fieldname, text in query.all_terms() if fieldname == "content")
+
+	# Returns the HTML snippet of a result with stored fields for the query terms,
+	# or "" if its document has no stored excerpt
+	def __snippet(self, fields, terms):
+		excerpt = fields.get("excerpt")
+		if excerpt is None: return ""
+		key = (fields["url"], fields.get("content_hash"), terms)
+		snippet = self.snippet_cache.get(key)
+		if snippet is None:
+			snippet = self.snippet_maker.snippet(excerpt, terms)
+			self.snippet_cache.put(key, snippet)
+		return snippet
+
+	# Orders (bm25, docnum, matched terms) candidates by a*pr*terms + b*bm25, the
+	# score PageRankBM25F gives them: it adds a*pr for every query term a document matches
+	def __rerank(self, candidates):
+		pr = self.pr_array
+		scored = [(self.pr_weight*pr[docnum]*terms + self.bm25_weight*bm25, docnum) for bm25, docnum, terms in candidates]
+		scored.sort(key=lambda x: x[0], reverse=True)
+		return [docnum for _, docnum in scored]
+
+	# Reads only the first self.candidate_depth matches of each segment. Because
+	# documents are indexed in descending PageRank order these are the matches with
+	# the highest static rank, and the rest of the postings are never touched.
+	def __static_rank(self, searcher, query, limit):
+		candidates = []
+		for subsearcher, offset in searcher.leaf_searchers():
+			matcher = query.matcher(subsearcher, subsearcher.context())
+			count = 0
+			while matcher.is_active() and count < self.candidate_depth:
+				candidates.append((matcher.score(), offset + matcher.id(), sum(1 for _ in matcher.matching_terms())))
+				matcher.next()
+				count += 1
+		return len(candidates), self.__rerank(candidates)[:limit]
+
+	# Returns the page_num page of query as {'total', 'pagenum', 'pagecount', 'docnums'}
+	# following the paging rules of whoosh.searching.ResultsPage
+	def __search_page(self, searcher, query, page_num, pagelen, conj):
+		total, docnums = self.__cached_rank(searcher, query, page_num*pagelen, conj)
+		pagecount = int(ceil(total / pagelen))
+		page_num = min(pagecount, page_num)
+		offset = (page_num - 1) * pagelen
+		return {'total': total, 'pagenum': page_num, 'pagecount': pagecount, 'docnums': docnums[max(offset, 0):offset + pagelen]}
+
+	# Returns a parsed query for query_string, ANDing terms if conj else ORing them
+	def parse_query(self, query_string, conj = True):
+		group = AndGroup if conj else OrGroup
+		with self.metrics.stage("parse"):
+			return QueryParser("content", self.ix.schema, group=group).parse(query_string)
+
+	# Returns the page of parsed query as {'total', 'page', 'pagecount', 'docs'}
+	def __results(self, query, page, pagelen, conj):
+		terms = self.__query_terms(query) if self.snippets else None
+		with self.pool.searcher() as searcher:
+			page_result = self.__search_page(searcher, query, max(page, 1), pagelen, conj)
+			with self.metrics.stage("fetch"):
+				stored = [searcher.stored_fields(docnum) for docnum in page_result['docnums']]
+			self.metrics.count("docs_fetched", len(stored))
+		docs = [{'title': result['title'], 'url': result['url']} for result in stored]
+		if self.snippets:
+			with self.metrics.stage("snippets"):
+				for doc, result in zip(docs, stored): doc['snippet'] = self.__snippet(result, terms)
+		return {'total': page_result['total'], 'page': page_result['pagenum'], 'pagecount': page_result['pagecount'], 'docs': docs}
+
+	# Stateless search that is safe to call from many threads at once.
+	# Returns {'total', 'page', 'pagecount', 'docs', 'next', 'prev', 'query', 'conj',
+	# 'suggestion'} where 'next' and 'prev' are cursors for the neighbouring pages
+	# (None at either end). 'query' and 'conj' are the query that was run, which
+	# differ from the ones given when a query that matched nothing was rewritten (see
+	# rewrite_query), and 'suggestion' is its spelling correction, if any. Passing a
+	# cursor instead of the other arguments fetches the page it points to. With
+	# refresh=False the index directory isn't checked for a new generation, for
+	# callers that just did (see version()).
+	def search(self, query_string = None, page = 1, pagelen = None, conj = None, cursor = None, refresh = True):
+		self.metrics.count("queries")
+		with self.metrics.stage("search"):
+			if refresh: self.__refresh()
+			suggestion = None
+			if cursor: query_string, page, pagelen, conj = decode_cursor(cursor)
+			if pagelen is None: pagelen = self.limit
+			if conj is None: conj = self.conj
+			# Cursors already hold the rewritten query
+			if not cursor: query_string, conj, suggestion = self.__rewrite_query(query_string, conj)
+			results = self.__results(self.parse_query(query_string, conj), page, pagelen, conj)
+			results['query'] = query_string
+			results['conj'] = conj
+			results['suggestion'] = suggestion
+			page = results['page']
+			results['next'] = encode_cursor(query_string, page + 1, pagelen, conj) if page < results['pagecount'] else None
+			results['prev'] = encode_cursor(query_string, page - 1, pagelen, conj) if page > 1 else None
+			return results
+
+	# Yields the results of query_string best first (the first limit if given) as
+	# {'rank', 'title', 'url'}, with a 'snippet' if snippets, for exports deeper than
+	# paging through search() would go. The query is rewritten like in search() and
+	# ranked once, on a searcher of its own so the docnums being read stay valid
+	# if the index changes meanwhile. refresh is as in search().
+	def iter_results(self, query_string, conj = None, limit = None, snippets = False, refresh = True):
+		if conj is None: conj = self.conj
+		if refresh: self.__refresh()
+		query_string, conj, _ = self.__rewrite_query(query_string, conj)
+		query = self.parse_query(query_string, conj)
+		terms = self.__query_terms(query) if snippets else None
+		searcher = self.ix.searcher(weighting=self.weighting)
+		try:
+			_, docnums = self.__rank(searcher, query, limit or max(searcher.doc_count_all(), 1))
+			for rank, docnum in enumerate(docnums, 1):
+				fields = searcher.stored_fields(docnum)
+				doc = {'rank': rank, 'title': fields['title'], 'url': fields['url']}
+				if snippets: doc['snippet'] = self.__snippet(fields, terms)
+				yield doc
+		finally:
+			searcher.close()
 
 	def return_page(self, page_num):
 		results = {}
@@ -91,16 +629,12 @@ class SearchEngine(object):
 			print("Submit a query first")
 			return results
 
-		if page_num < 1: page_num = 1
-		
-		page_result = self.searcher.search_page(self.current_query, page_num)
-		self.current_page = page_result.pagenum
-		
-		results['total'] = page_result.total
-		results['docs'] = []
+		self.__refresh()
+		page_result = self.__results(self.current_query, page_num, self.limit, self.conj)
+		self.current_page = page_result['page']
 		
-		for result in page_result:
-			results['docs'].append({'title': result['title'], 'url': result['url']}) 
+		results['total'] = page_result['total']
+		results['docs'] = page_result['docs']
 		
 		return results
 
@@ -108,22 +642,25 @@ class SearchEngine(object):
 	def print_page(self, page_num):
 		if not self.current_query: print("Submit a query first")
 		else:
-			if page_num < 1: page_num = 1
-			page_result = self.searcher.search_page(self.current_query, page_num)
-			self.current_page = page_result.pagenum
-			print(f"--------------------\n{page_result.total} RESULTS")
-			if page_result.total == 0: print("No results found")
-			for result in page_result: print(f'{result["title"]}\n\t\033[94m{result["url"]}\033[0m\n')
-			print(f"PAGE {page_result.pagenum} of {page_result.pagecount}")
+			self.__refresh()
+			page_result = self.__results(self.current_query, page_num, self.limit, self.conj)
+			self.current_page = page_result['page']
+			print(f"--------------------\n{page_result['total']} RESULTS")
+			if page_result['total'] == 0: print("No results found")
+			for result in page_result['docs']: print(f'{result["title"]}\n\t\033[94m{result["url"]}\033[0m\n')
+			print(f"PAGE {page_result['page']} of {page_result['pagecount']}")
 			print("--------------------")
 
 	# Perform search for a query in the index and print the result
 	def submit_query(self, query_string):
 		self.current_page = 1
 		print(f"\"{query_string}\" WAS SUBMITTED")
-		# Construct query based on self.conj
-		if self.conj: self.current_query = QueryParser("content", self.ix.schema, group=AndGroup).parse(query_string)
-		else: self.current_query = QueryParser("content", self.ix.schema, group=OrGroup).parse(query_string)
+		# Construct query based on self.conj, rewritten if it matches nothing
+		run, conj, suggestion = self.rewrite_query(query_string, self.conj)
+		if suggestion: print(f"DID YOU MEAN \"{suggestion}\"?")
+		if run != query_string: print(f"SHOWING RESULTS FOR \"{run}\"")
+		if conj != self.conj: print("NO RESULTS CONTAIN EVERY WORD, SHOWING RESULTS CONTAINING ANY")
+		self.current_query = self.parse_query(run, conj)
 
 	# Returns an object with page result information for a page one higher than self.current_page for self.current_query
 	def get_next_page(self):
@@ -149,12 +686,18 @@ class SearchEngine(object):
 			if self.debug: self.print_page(self.current_page)
 			return self.return_page(self.current_page)
 
-	# Closes the searcher that is opened during initialization
+	# Closes the pooled searchers
 	def close_searcher(self):
-		self.searcher.close()
+		self.pool.close()
 
 
 def main():
+	# python3 anime_search_engine.py -u updates the index after a new crawl
+	if len(sys.argv) > 1 and sys.argv[1] == "-u":
+		mySearchEngine = SearchEngine()
+		print(mySearchEngine.update_index())
+		mySearchEngine.close_searcher()
+		return
 	string = '"tokyo ghoul"'
 	mySearchEngine = SearchEngine(
 		debug=True,
@@ -0,0 +1,159 @@
+from anime_search_engine import SearchEngine
+from weighting import PageRankBM25F
+from whoosh.searching import Searcher
+from multiprocessing import Pool
+
+import numpy as np
+import json, os, sys, time
+
+INDEX_DIR = "./indexdir"
+PAGE_RANK_FILE = "./page_rank.dat"
+DEPTH = 100 # Results written per query
+CONJ = True # AND the terms of every query, else OR them
+REWRITE = False # Rewrite queries that match nothing like SearchEngine.search does
+CHUNK_SIZE = 16 # Queries sent to a worker at a time
+
+# Per worker process: its own SearchEngine and two searchers over one reader of the
+# index, scoring with only the PageRank and only the BM25F half of PageRankBM25F
+engine = None
+pr_searcher = None
+bm25_searcher = None
+
+# Returns [(query id, query string)] read from path: JSON lines with a "query" (or
+# "q") and optionally an "id" (or "qid", "query_id", "request_id"), or else one
+# query string per line numbered from 1
+def read_queries(path):
+	queries = []
+	with open(path, encoding="utf-8") as f:
+		for number, line in enumerate(f, 1):
+			line = line.strip()
+			if not line: continue
+			if line.startswith("{"):
+				record = json.loads(line)
+				text = record.get("query", record.get("q"))
+				qid = next((record[k] for k in ("id", "qid", "query_id", "request_id") if k in record), number)
+			else:
+				text, qid = line, number
+			if text: queries.append((str(qid).replace(" ", "_"), text))
+	return queries
+
+def open_worker(index_dir, page_rank_file):
+	global engine, pr_searcher, bm25_searcher
+	engine = SearchEngine(index_dir=index_dir, page_rank_file=page_rank_file, pool_size=1, cache_size=0, snippets=False)
+	reader = engine.ix.reader()
+	pr = engine.pr_array
+	pr_searcher = Searcher(reader, weighting=PageRankBM25F(pr, a=1, b=0), closereader=False)
+	bm25_searcher = Searcher(reader, weighting=PageRankBM25F(pr, a=0, b=1))
+
+# Returns the docnums matching query with the PageRank and BM25F parts of their
+# score. PageRankBM25F adds a*pr + b*bm25 for every term a document matches, so
+# the score of any (a, b) is a*pr_part + b*bm25_part and a whole sweep of weights
+# is ranked from these two searches.
+def score_parts(query):
+	parts = []
+	for searcher in (pr_searcher, bm25_searcher):
+		top_n = searcher.search(query, limit=None).top_n
+		parts.append(dict((docnum, score) for score, docnum in top_n))
+	docnums = np.fromiter(parts[1], dtype=np.int64, count=len(parts[1]))
+	pr_part = np.array([parts[0].get(d, 0.0) for d in docnums.tolist()])
+	bm25_part = np.array([parts[1][d] for d in docnums.tolist()])
+	return docnums, pr_part, bm25_part
+
+# Returns (docnums, scores) of the best depth documents by a*pr_part + b*bm25_part,
+# ties broken by docnum like Whoosh does
+def rank(docnums, pr_part, bm25_part, a, b, depth):
+	scores = a*pr_part + b*bm25_part
+	if len(scores) > depth:
+		best = np.argpartition(-scores, depth - 1)[:depth]
+		docnums, scores = docnums[best], scores[best]
+	order = np.lexsort((docnums, -scores))
+	return docnums[order], scores[order]
+
+# Worker: ranks one query for every (a, b) of settings. Returns (qid, total,
+# [[(url, score)] per setting], seconds, error).
+def run_query(job):
+	qid, query_string, settings, depth, conj, rewrite = job
+	start = time.perf_counter()
+	try:
+		if rewrite: query_string, conj, _ = engine.rewrite_query(query_string, conj)
+		docnums, pr_part, bm25_part = score_parts(engine.parse_query(query_string, conj))
+		ranked = [rank(docnums, pr_part, bm25_part, a, b, depth) for a, b in settings]
+		urls = {}
+		for top, _ in ranked:
+			for docnum in top.tolist():
+				if docnum not in urls: urls[docnum] = bm25_searcher.stored_fields(docnum)["url"]
+		runs = [[(urls[d], s) for d, s in zip(top.tolist(), scores.tolist())] for top, scores in ranked]
+		return qid, len(docnums), runs, time.perf_counter() - start, None
+	except Exception as e:
+		return qid, 0, [[] for _ in settings], time.perf_counter() - start, f"{type(e).__name__}: {e}"
+
+# Returns the run file of setting (a, b): run_file itself for a single setting,
+# else run_file with the weights appended
+def run_path(run_file, setting, sweep):
+	if not sweep: return run_file
+	return f"{run_file}.a{setting[0]:g}_b{setting[1]:g}"
+
+# Runs every query of queries_file for each (a, b) of settings (the engine's
+# weights by default) on procs worker processes (all CPUs by default), each with
+# its own read-only searchers, and writes the best depth results of each setting
+# in TREC run format, "qid Q0 url rank score tag", to run_path(run_file, ...).
+# Prints and returns the throughput and the per-query latency distribution.
+def evaluate(queries_file, run_file, settings = None, procs = None, depth = DEPTH, conj = CONJ, rewrite = REWRITE, index_dir = INDEX_DIR, page_rank_file = PAGE_RANK_FILE):
+	# Built here first, so workers never race to create the index or its sidecars
+	parent = SearchEngine(index_dir=index_dir, page_rank_file=page_rank_file, pool_size=1)
+	if settings is None: settings = [(parent.pr_weight, parent.bm25_weight)]
+	parent.close_searcher()
+	procs = procs or os.cpu_count() or 1
+	queries = read_queries(queries_file)
+	jobs = [(qid, q, settings, depth, conj, rewrite) for qid, q in queries]
+	sweep = len(settings) > 1
+	files = [open(run_path(run_file, s, sweep), "w", encoding="utf-8") for s in settings]
+	latencies, errors = [], []
+	start = time.perf_counter()
+	try:
+		if procs == 1:
+			open_worker(index_dir, page_rank_file)
+			results = map(run_query, jobs)
+			pool = None
+		else:
+			pool = Pool(procs, initializer=open_worker, initargs=(index_dir, page_rank_file))
+			results = pool.imap(run_query, jobs, CHUNK_SIZE)
+		for qid, total, runs, seconds, error in results:
+			latencies.append(seconds * 1000)
+			if error: errors.append((qid, error))
+			for f, (a, b), run in zip(files, settings, runs):
+				tag = f"a{a:g}_b{b:g}"
+				f.writelines(f"{qid} Q0 {url} {i} {score:.10g} {tag}\n" for i, (url, score) in enumerate(run, 1))
+		if pool is not None: pool.close(); pool.join()
+	finally:
+		for f in files: f.close()
+	seconds = time.perf_counter() - start
+	latencies.sort()
+	pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] if latencies else 0.0
+	stats = {'queries': len(latencies), 'settings': len(settings), 'procs': procs, 'seconds': seconds, 'qps': len(latencies) / seconds if seconds else 0.0,
+		'p50_ms': pct(50), 'p90_ms': pct(90), 'p99_ms': pct(99), 'max_ms': latencies[-1] if latencies else 0.0, 'errors': len(errors)}
+	print(f"{stats['queries']} queries x {stats['settings']} settings on {procs} processes in {seconds:.2f}s: {stats['qps']:.1f} queries/sec")
+	print(f"latency per query p50 {stats['p50_ms']:.2f} ms  p90 {stats['p90_ms']:.2f} ms  p99 {stats['p99_ms']:.2f} ms  max {stats['max_ms']:.2f} ms")
+	for qid, error in errors[:10]: print(f"query {qid} failed: {error}")
+	return stats
+
+# Returns [(a, b)] for "a:b,a:b,..." or a grid for "a,a,...:b,b,..."
+def parse_settings(text):
+	if text.count(":") == 1 and "," in text:
+		a_values, b_values = text.split(":")
+		return [(float(a), float(b)) for a in a_values.split(",") for b in b_values.split(",")]
+	return [tuple(map(float, pair.split(":"))) for pair in text.split(",")]
+
+def main():
+	# python3 batch_eval.py queries_file run_file [procs] [weights]
+	#	weights: "a:b" settings separated by commas, e.g. 100000:1.5,50000:1.5, or a
+	#	grid of every a with every b, e.g. 0,50000,100000:1,1.5,2
+	if len(sys.argv) < 3:
+		print("usage: python3 batch_eval.py <queries_file> <run_file> [procs] [a:b,a:b,... | a,a,...:b,b,...]")
+		return
+	procs = int(sys.argv[3]) if len(sys.argv) > 3 else None
+	settings = parse_settings(sys.argv[4]) if len(sys.argv) > 4 else None
+	evaluate(sys.argv[1], sys.argv[2], settings, procs)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,396 @@
+from anime_search_engine import SearchEngine, SCHEMA
+from whoosh.index import create_in
+
+import numpy as np
+import batch_eval
+import page_rank
+import snippets
+import spelling
+import suggest
+
+import contextlib, io, os, pickle, random, resource, shutil, subprocess, sys, tempfile, threading, time
+
+QUERIES = ["anime", "tokyo ghoul", "studio", "producer", "companies", "animation studio", "entertainment", "one piece", "naruto", "media"]
+
+# Returns the mean and worst latency in milliseconds of running every query in queries
+def time_queries(engine, queries, conj = False, repeat = 20):
+	engine.conj = conj
+	times = []
+	with contextlib.redirect_stdout(io.StringIO()):
+		for _ in range(repeat):
+			for q in queries:
+				start = time.perf_counter()
+				engine.submit_query(q)
+				engine.return_page(1)
+				times.append((time.perf_counter() - start) * 1000)
+	times.sort()
+	return sum(times) / len(times), times[-1]
+
+# Compares query latency of each scoring mode against the FunctionWeighting path
+def bench_scoring_modes(index_dir = "./indexdir", page_rank_file = "./page_rank.dat", depth = 200):
+	print(f"{'mode':<10}{'conj':<6}{'mean ms':>10}{'max ms':>10}")
+	for mode in ("function", "pagerank", "rerank", "static"):
+		engine = SearchEngine(index_dir=index_dir, page_rank_file=page_rank_file, scoring_mode=mode, candidate_depth=depth)
+		for conj in (True, False):
+			mean, worst = time_queries(engine, QUERIES, conj)
+			print(f"{mode:<10}{str(conj):<6}{mean:>10.3f}{worst:>10.3f}")
+		engine.close_searcher()
+
+# Run in a fresh interpreter by bench_startup, prints "<seconds> <peak RSS in MB>"
+STARTUP_SCRIPT = """
+import resource, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {here!r})
+from anime_search_engine import SearchEngine
+engine = SearchEngine(index_dir={index_dir!r}, page_rank_file={page_rank_file!r}, scoring_mode={mode!r})
+seconds = time.perf_counter() - start
+print(seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+"""
+
+# Reports cold-start time and peak resident memory of a new process constructing
+# a SearchEngine, with the lazy startup path and with the "function" mode that
+# still materialises every stored document
+def bench_startup(index_dir = "./indexdir", page_rank_file = "./page_rank.dat"):
+	here = os.path.dirname(os.path.abspath(__file__))
+	print(f"{'mode':<10}{'seconds':>10}{'RSS MB':>10}")
+	for mode in ("pagerank", "function"):
+		script = STARTUP_SCRIPT.format(here=here, index_dir=index_dir, page_rank_file=page_rank_file, mode=mode)
+		# The first run writes the sidecar PageRank array if it is missing
+		subprocess.run([sys.executable, "-c", script], check=True, capture_output=True)
+		seconds, rss = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True).stdout.split()
+		print(f"{mode:<10}{float(seconds):>10.3f}{float(rss):>10.1f}")
+
+# Writes a synthetic index of n documents and its page_rank.dat for bench_startup
+def make_synthetic_index(index_dir = "./synthetic_indexdir", page_rank_file = "./synthetic_page_rank.dat", n = 1000000):
+	n = int(n)
+	rng = random.Random(0)
+	vocabulary = [f"term{i}" for i in range(50000)]
+	page_rank = {}
+	if not os.path.exists(index_dir): os.mkdir(index_dir)
+	ix = create_in(index_dir, SCHEMA)
+	writer = ix.writer(limitmb=1024, procs=4, multisegment=True)
+	for i in range(n):
+		url = f"https://example.com/page/{i}"
+		page_rank[url] = rng.random() / n
+		writer.add_document(title=f"Page {i}", url=url, content=" ".join(rng.choices(vocabulary, k=30)), page_rank=page_rank[url])
+	writer.commit()
+	with open(page_rank_file, "wb") as f:
+		pickle.dump(page_rank, f)
+
+# Returns the pth percentile of sorted values
+def percentile(values, p):
+	return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Load test: threads clients send QUERIES back to back for seconds and the QPS
+# and p50/p99 latency are reported. Queries go straight to SearchEngine.search,
+# or to a running front end when url (e.g. http://127.0.0.1:5000) is given.
+def bench_load(index_dir = "./indexdir", page_rank_file = "./page_rank.dat", threads = 8, seconds = 10, url = None):
+	threads, seconds = int(threads), float(seconds)
+	if url:
+		import requests
+		session = requests.Session()
+		run = lambda q: session.get(f"{url}/search", params={"q": q}).raise_for_status()
+		engine = None
+	else:
+		engine = SearchEngine(index_dir=index_dir, page_rank_file=page_rank_file, pool_size=threads)
+		run = lambda q: engine.search(q)
+	latencies = [[] for _ in range(threads)]
+	deadline = time.perf_counter() + seconds
+
+	def client(times):
+		i = random.randrange(len(QUERIES))
+		while time.perf_counter() < deadline:
+			start = time.perf_counter()
+			run(QUERIES[i % len(QUERIES)])
+			times.append((time.perf_counter() - start) * 1000)
+			i += 1
+
+	workers = [threading.Thread(target=client, args=(times,)) for times in latencies]
+	for w in workers: w.start()
+	for w in workers: w.join()
+	if engine: engine.close_searcher()
+	times = sorted(t for ts in latencies for t in ts)
+	print(f"{threads} threads, {len(times)} queries in {seconds:.0f}s")
+	print(f"QPS {len(times) / seconds:.1f}  p50 {percentile(times, 50):.2f} ms  p99 {percentile(times, 99):.2f} ms")
+
+# Times building an index from the sample documents, each indexed copies times
+# under different URLs, with an increasing number of processes
+def bench_indexing(copies = 50, url_map_file = "./sample/url_map.dat", docs_raw_dir = "./sample/_docs_raw/", docs_cleaned_dir = "./sample/_docs_cleaned/"):
+	with open(url_map_file, "rb") as f:
+		url_map = pickle.load(f)
+	work_dir = tempfile.mkdtemp()
+	try:
+		urls = {f"{url}?copy={i}": file_name for i in range(int(copies)) for url, file_name in url_map.items()}
+		page_rank = {url: 1 / len(urls) for url in urls}
+		for name, data in (("url_map.dat", urls), ("page_rank.dat", page_rank)):
+			with open(os.path.join(work_dir, name), "wb") as f:
+				pickle.dump(data, f)
+		print(f"{'procs':<8}{'seconds':>10}{'docs/sec':>10}")
+		for procs in sorted({1, 2, 4, os.cpu_count() or 1}):
+			index_dir = os.path.join(work_dir, f"indexdir_{procs}")
+			start = time.perf_counter()
+			with contextlib.redirect_stdout(io.StringIO()):
+				SearchEngine(index_dir=index_dir, page_rank_file=os.path.join(work_dir, "page_rank.dat"), url_map_file=os.path.join(work_dir, "url_map.dat"), docs_raw_dir=docs_raw_dir, docs_cleaned_dir=docs_cleaned_dir, index_procs=procs).close_searcher()
+			seconds = time.perf_counter() - start
+			print(f"{procs:<8}{seconds:>10.2f}{len(urls) / seconds:>10.0f}")
+	finally:
+		shutil.rmtree(work_dir)
+
+# Runs PageRank on a random graph of nodes pages and edges links (about 1% of the
+# pages are dangling) and reports the iterations, wall time and peak memory
+def bench_page_rank(nodes = 1000000, edges = 10000000, dtype = "float64"):
+	nodes, edges = int(nodes), int(edges)
+	rng = np.random.default_rng(0)
+	src = rng.integers(0, int(nodes * 0.99), edges, dtype=np.int32)
+	dst = rng.integers(0, nodes, edges, dtype=np.int32)
+	start = time.perf_counter()
+	adj = page_rank.from_edges(src, dst, nodes, dtype=dtype)
+	del src, dst
+	build = time.perf_counter() - start
+	scores, stats = page_rank.page_rank(adj, dtype=dtype)
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+	print(f"{nodes} pages, {adj.nnz} links, {dtype}: built in {build:.2f}s, {stats['iterations']} iterations in {stats['seconds']:.2f}s, residual {stats['residual']:.2e}, peak RSS {rss:.0f} MB")
+
+# Returns the prefixes typed on the way to each query, one keystroke at a time
+def keystrokes(queries):
+	return [q[:i] for q in queries for i in range(1, len(q) + 1)]
+
+# Returns the load time in ms of the suggestions saved at path and the p50/p99
+# latency in ms of replaying prefixes through them
+def time_suggester(path, prefixes, repeat = 5):
+	start = time.perf_counter()
+	suggester = suggest.Suggester.load(path)
+	load = (time.perf_counter() - start) * 1000
+	times = []
+	for _ in range(repeat):
+		for prefix in prefixes:
+			start = time.perf_counter()
+			suggester.suggest(prefix)
+			times.append((time.perf_counter() - start) * 1000)
+	times.sort()
+	return load, len(suggester), percentile(times, 50), percentile(times, 99)
+
+# Replays keystroke streams (QUERIES and the indexed titles typed a character at a
+# time) through the suggestions of the index, then through synthetic suggestions of
+# keys titles drawn from a Zipf-like vocabulary, and reports load time and p50/p99
+# latency per keystroke
+def bench_suggest(index_dir = "./indexdir", page_rank_file = "./page_rank.dat", keys = 1000000):
+	print(f"{'suggestions':<12}{'keys':>10}{'load ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+	engine = SearchEngine(index_dir=index_dir, page_rank_file=page_rank_file)
+	engine.suggest("a")
+	with engine.ix.searcher() as searcher:
+		titles = [fields["title"] for fields in searcher.all_stored_fields() if fields.get("title")]
+	engine.close_searcher()
+	path = os.path.join(index_dir, f"suggest_{engine.ix.latest_generation()}.pkl")
+	load, n, p50, p99 = time_suggester(path, keystrokes(QUERIES + titles))
+	print(f"{'index':<12}{n:>10}{load:>10.1f}{p50:>10.4f}{p99:>10.4f}")
+
+	keys = int(keys)
+	rng = np.random.default_rng(0)
+	vocabulary = ["".join(rng.choice(list("abcdefghijklmnopqrstuvwxyz"), rng.integers(3, 10))) for _ in range(20000)]
+	ranks = np.minimum(rng.zipf(1.3, (keys, 3)), len(vocabulary)) - 1
+	synthetic = list({" ".join(vocabulary[r] for r in row) for row in ranks.tolist()})
+	start = time.perf_counter()
+	suggester = suggest.Suggester(synthetic, synthetic, rng.random(len(synthetic)))
+	build = time.perf_counter() - start
+	with tempfile.TemporaryDirectory() as work_dir:
+		path = os.path.join(work_dir, "suggest.pkl")
+		suggester.save(path)
+		del suggester
+		streams = [synthetic[i] for i in rng.integers(0, len(synthetic), 2000)]
+		load, n, p50, p99 = time_suggester(path, keystrokes(streams), repeat = 1)
+	print(f"{'synthetic':<12}{n:>10}{load:>10.1f}{p50:>10.4f}{p99:>10.4f}  (built in {build:.1f}s)")
+
+# Reports the p50/p99 latency of SearchEngine.search over the first pages of
+# QUERIES without snippets, with snippets rendered every time and with snippets
+# cached, and the size of the stored excerpts. The query cache is off, so every
+# search ranks the query again.
+def bench_snippets(index_dir = "./indexdir", page_rank_file = "./page_rank.dat", pages = 3, repeat = 20):
+	pages, repeat = int(pages), int(repeat)
+	print(f"{'snippets':<10}{'p50 ms':>10}{'p99 ms':>10}")
+	for name, enabled, snippet_cache_size in (("off", False, 0), ("uncached", True, 0), ("cached", True, 1024)):
+		engine = SearchEngine(index_dir=index_dir, page_rank_file=page_rank_file, cache_size=0, snippets=enabled, snippet_cache_size=snippet_cache_size)
+		times = []
+		for _ in range(repeat):
+			for q in QUERIES:
+				for page in range(1, pages + 1):
+					start = time.perf_counter()
+					engine.search(q, page=page)
+					times.append((time.perf_counter() - start) * 1000)
+		times.sort()
+		print(f"{name:<10}{percentile(times, 50):>10.3f}{percentile(times, 99):>10.3f}")
+		engine.close_searcher()
+	with engine.ix.searcher() as searcher:
+		excerpts = [fields["excerpt"] for fields in searcher.all_stored_fields() if fields.get("excerpt")]
+	if excerpts:
+		text = sum(len(excerpt) for excerpt in map(snippets.read_excerpt, excerpts))
+		stored = sum(map(len, excerpts))
+		print(f"{len(excerpts)} excerpts: {stored / len(excerpts):.0f} bytes each stored, {text / len(excerpts):.0f} characters each")
+
+# Calls the front end's /api/search through Flask's test client and reports the
+# p50/p99 latency of a JSON page, of revalidating it with its ETag (a 304) and of
+# paging with cursors, the gzip ratio, and the rows per second of an NDJSON export
+def bench_api(index_dir = "./indexdir", page_rank_file = "./page_rank.dat", repeat = 50):
+	repeat = int(repeat)
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	from front_end import app
+	app.mySearchEngine = app.SearchEngine(index_dir=index_dir, page_rank_file=page_rank_file)
+	client = app.app.test_client()
+
+	def timed(requests):
+		times = []
+		for _ in range(repeat):
+			for path, headers in requests:
+				start = time.perf_counter()
+				response = client.get(path, headers=headers)
+				times.append((time.perf_counter() - start) * 1000)
+		times.sort()
+		return f"p50 {percentile(times, 50):.3f} ms  p99 {percentile(times, 99):.3f} ms"
+
+	pages = [(f"/api/search?q={q}", {"Accept-Encoding": "gzip"}) for q in QUERIES]
+	print(f"{'page':<10}{timed(pages)}")
+	etags = [(path, dict(headers, **{"If-None-Match": client.get(path, headers=headers).headers["ETag"]})) for path, headers in pages]
+	print(f"{'304':<10}{timed(etags)}")
+	cursors = []
+	for q in QUERIES:
+		cursor = client.get(f"/api/search?q={q}").get_json()["next"]
+		if cursor: cursors.append((f"/api/search?cursor={cursor}", {}))
+	print(f"{'cursor':<10}{timed(cursors)}")
+	plain = sum(len(client.get(path).data) for path, _ in pages)
+	compressed = sum(len(client.get(path, headers=headers).data) for path, headers in pages)
+	print(f"gzip: {plain} -> {compressed} bytes")
+	rows, start = 0, time.perf_counter()
+	for q in QUERIES:
+		rows += client.get(f"/api/search?q={q}&conj=or&format=ndjson").data.count(b"\n")
+	print(f"ndjson: {rows} rows at {rows / (time.perf_counter() - start):.0f} rows/sec")
+	app.mySearchEngine.close_searcher()
+
+# Runs queries random one and two word queries, made of the title words of the
+# index, through batch_eval with settings PageRank weights from 0 to twice the
+# default, and times the same sweep done by opening a SearchEngine per setting and
+# searching every query
+def bench_batch(index_dir = "./indexdir", page_rank_file = "./page_rank.dat", queries = 2000, settings = 9):
+	queries, settings = int(queries), int(settings)
+	rng = random.Random(0)
+	engine = SearchEngine(index_dir=index_dir, page_rank_file=page_rank_file)
+	with engine.ix.reader() as reader:
+		words = [w for w in reader.field_terms("title") if w.isalpha()]
+	engine.close_searcher()
+	grid = [(a, engine.bm25_weight) for a in np.linspace(0, 2*engine.pr_weight, settings)]
+	work_dir = tempfile.mkdtemp()
+	try:
+		queries_file = os.path.join(work_dir, "queries.txt")
+		with open(queries_file, "w") as f:
+			for _ in range(queries): f.write(" ".join(rng.sample(words, rng.randint(1, 2))) + "\n")
+		for procs in sorted({1, os.cpu_count() or 1}):
+			for sweep in ([grid[0]], grid):
+				print(f"batch_eval, {procs} processes, {len(sweep)} settings")
+				batch_eval.evaluate(queries_file, os.path.join(work_dir, "run"), sweep, procs, index_dir=index_dir, page_rank_file=page_rank_file)
+		lines = [line.strip() for line in open(queries_file)]
+		start = time.perf_counter()
+		for a, b in grid:
+			engine = SearchEngine(index_dir=index_dir, page_rank_file=page_rank_file, pr_weight=a, bm25_weight=b, cache_size=0, snippets=False, spelling="off", or_fallback=False)
+			for q in lines: engine.search(q, pagelen=batch_eval.DEPTH)
+			engine.close_searcher()
+		seconds = time.perf_counter() - start
+		print(f"SearchEngine per setting, {len(grid)} settings: {seconds:.2f}s, {len(lines) / seconds:.1f} queries/sec")
+	finally:
+		shutil.rmtree(work_dir)
+
+# Reports the mean latency of SearchEngine.search over QUERIES with metrics off,
+# on, and on with the sampling profiler running, with the query and snippet
+# caches off so every stage runs, and the cost of one stage() call while disabled
+def bench_metrics(index_dir = "./indexdir", page_rank_file = "./page_rank.dat", repeat = 50):
+	repeat = int(repeat)
+	print(f"{'metrics':<10}{'mean ms':>10}{'p99 ms':>10}")
+	for name, enabled, profiler in (("off", False, False), ("on", True, False), ("profiler", True, True)):
+		engine = SearchEngine(index_dir=index_dir, page_rank_file=page_rank_file, cache_size=0, snippet_cache_size=0, metrics=enabled)
+		if profiler: engine.metrics.start_profiler()
+		times = []
+		for _ in range(repeat):
+			for q in QUERIES:
+				start = time.perf_counter()
+				engine.search(q)
+				times.append((time.perf_counter() - start) * 1000)
+		engine.metrics.stop_profiler()
+		engine.close_searcher()
+		times.sort()
+		print(f"{name:<10}{sum(times) / len(times):>10.3f}{percentile(times, 99):>10.3f}")
+	disabled = engine.metrics
+	disabled.enabled = False
+	n = 1000000
+	start = time.perf_counter()
+	for _ in range(n):
+		with disabled.stage("parse"): pass
+	print(f"disabled stage: {(time.perf_counter() - start) / n * 1e9:.0f} ns")
+
+# Returns word with edits random single character insertions, deletions or substitutions
+def misspell(word, rng, edits = 1):
+	letters = "abcdefghijklmnopqrstuvwxyz"
+	for _ in range(edits):
+		i = rng.randrange(len(word))
+		edit = rng.randrange(3)
+		if edit == 0: word = word[:i] + rng.choice(letters) + word[i:]
+		elif edit == 1 and len(word) > 1: word = word[:i] + word[i + 1:]
+		else: word = word[:i] + rng.choice(letters) + word[i + 1:]
+	return word
+
+# Corrects misspelled words of a synthetic vocabulary of terms words with Zipf-like
+# frequencies. Reports the time and memory to build and load the Lexicon, the
+# p50/p99 latency of correcting a word and a three word query, how often the
+# misspelled word was corrected back, and the latency of a naive scan of the
+# whole vocabulary with Levenshtein.distance for comparison.
+def bench_spelling(terms = 1000000, lookups = 2000):
+	terms, lookups = int(terms), int(lookups)
+	rng = random.Random(0)
+	letters = "abcdefghijklmnopqrstuvwxyz"
+	words = sorted({"".join(rng.choices(letters, k=rng.randint(3, 12))) for _ in range(terms)})
+	frequencies = np.random.default_rng(0).zipf(1.5, len(words)).clip(max=10**6)
+	start = time.perf_counter()
+	lexicon = spelling.Lexicon(words, frequencies)
+	build = time.perf_counter() - start
+	size = lexicon.hashes.nbytes + lexicon.ids.nbytes
+	with tempfile.TemporaryDirectory() as work_dir:
+		path = os.path.join(work_dir, "lexicon.pkl")
+		lexicon.save(path)
+		del lexicon
+		start = time.perf_counter()
+		lexicon = spelling.Lexicon.load(path)
+		load = time.perf_counter() - start
+	print(f"{len(words)} words: built in {build:.1f}s, loaded in {load:.2f}s, deletion index {size / 2**20:.0f} MB")
+
+	targets = [w for w in rng.sample(words, lookups) if len(w) > 5]
+	typos = [misspell(w, rng, 1 if len(w) <= 5 else 2) for w in targets]
+	times, correct = [], 0
+	for target, typo in zip(targets, typos):
+		start = time.perf_counter()
+		fixed = lexicon.correct(typo)
+		times.append((time.perf_counter() - start) * 1000)
+		correct += fixed == target
+	times.sort()
+	print(f"{'word':<8}p50 {percentile(times, 50):.3f} ms  p99 {percentile(times, 99):.3f} ms  corrected back {correct / len(targets):.0%}")
+
+	times = []
+	for i in range(0, len(typos) - 2, 3):
+		query = " ".join(typos[i:i + 3])
+		start = time.perf_counter()
+		spelling.correct_query(query, lexicon, lambda word: word in lexicon)
+		times.append((time.perf_counter() - start) * 1000)
+	times.sort()
+	print(f"{'query':<8}p50 {percentile(times, 50):.3f} ms  p99 {percentile(times, 99):.3f} ms")
+
+	import Levenshtein
+	start = time.perf_counter()
+	for typo in typos[:20]:
+		min(words, key=lambda w: Levenshtein.distance(typo, w, score_cutoff=3))
+	print(f"{'scan':<8}mean {(time.perf_counter() - start) * 1000 / 20:.1f} ms per word")
+
+def main():
+	benchmarks = {"scoring": bench_scoring_modes, "startup": bench_startup, "synthetic": make_synthetic_index, "load": bench_load, "indexing": bench_indexing, "pagerank": bench_page_rank, "suggest": bench_suggest, "spelling": bench_spelling, "snippets": bench_snippets, "api": bench_api, "batch": bench_batch, "metrics": bench_metrics}
+	if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+		print(f"usage: python3 benchmarks.py <{' | '.join(benchmarks)}> [index_dir] [page_rank_file]")
+		return
+	benchmarks[sys.argv[1]](*sys.argv[2:])
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,85 @@
+from bs4 import BeautifulSoup
+from html import unescape
+from multiprocessing import Pool
+
+import hashlib, os, re, sys, time
+
+# The document store module is shared with the crawler
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "crawler"))
+from docstore import DocStore
+
+TITLE_RE = re.compile(r"<title[^>]*>(.*?)</title\s*>", re.S | re.I)
+TITLE_SCAN_CHUNK = 16384 # Characters of raw HTML read at a time while looking for the title
+
+# Returns the title of the raw HTML file at path. Only the start of the file is
+# read and scanned for <title>; the whole document is parsed only if that fails.
+def read_title(path):
+	with open(path, "r") as html:
+		head = ""
+		while True:
+			chunk = html.read(TITLE_SCAN_CHUNK)
+			head += chunk
+			match = TITLE_RE.search(head)
+			if match: return unescape(match.group(1)).strip()
+			if not chunk or "</head" in head.lower(): break
+		html.seek(0)
+		return BeautifulSoup(html.read(), "lxml").title.string.strip()
+
+# Returns the title of a raw HTML string, found like read_title does
+def html_title(html):
+	match = TITLE_RE.search(html, 0, html.lower().find("</head") + 1 or len(html))
+	if match: return unescape(match.group(1)).strip()
+	return BeautifulSoup(html, "lxml").title.string.strip()
+
+stores = {} # Document stores opened by this process, by directory
+
+# Returns the document store in doc_store_dir, opened once per process unless reload is set
+def open_store(doc_store_dir, reload = False):
+	if reload or doc_store_dir not in stores: stores[doc_store_dir] = DocStore(doc_store_dir, readonly=True)
+	return stores[doc_store_dir]
+
+# Returns (url, title, content, content_hash) for a (url, doc, docs_raw_dir, docs_cleaned_dir, doc_store_dir) job.
+# doc is a document id in the document store, or the file name of a document saved by older crawls.
+def read_document(job):
+	url, doc, docs_raw_dir, docs_cleaned_dir, doc_store_dir = job
+	if isinstance(doc, int):
+		record = open_store(doc_store_dir).get(doc)
+		content = record["text"]
+		# Records parsed by the crawler already hold the title and content hash
+		if "hash" in record: return url, record["title"], content, record["hash"]
+		title = html_title(record["html"])
+	else:
+		title = read_title(docs_raw_dir+doc)
+		with open(docs_cleaned_dir+doc, "r") as text:
+			content = text.read()
+	return url, title, content, hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+# Yields (url, title, content, content_hash) for each (url, doc) in files, in order.
+# With more than one process the documents are read and their titles extracted by a
+# process pool, chunksize documents at a time.
+def iter_documents(files, docs_raw_dir, docs_cleaned_dir, procs = None, chunksize = 64, doc_store_dir = None):
+	procs = procs or os.cpu_count() or 1
+	jobs = ((url, doc, docs_raw_dir, docs_cleaned_dir, doc_store_dir) for url, doc in files)
+	if procs == 1:
+		yield from map(read_document, jobs)
+		return
+	with Pool(procs) as pool:
+		yield from pool.imap(read_document, jobs, chunksize)
+
+# Prints indexing progress and throughput every `every` documents
+class Progress(object):
+
+	def __init__(self, total, every = 1000):
+		self.total = total
+		self.every = every
+		self.count = 0
+		self.start = time.perf_counter()
+
+	def update(self, n = 1):
+		self.count += n
+		if self.count % self.every == 0 or self.count == self.total: self.report()
+
+	def report(self):
+		seconds = time.perf_counter() - self.start
+		rate = self.count / seconds if seconds > 0 else 0
+		print(f"Indexed {self.count}/{self.total} documents ({rate:.0f} docs/sec)")
@@ -0,0 +1,41 @@
+from collections import OrderedDict
+
+import threading
+
+# A thread-safe, bounded mapping that evicts the least recently used entry
+# once it holds max_entries. A max_entries of 0 disables caching.
+class LRUCache(object):
+
+	def __init__(self, max_entries = 256):
+		self.max_entries = max_entries
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	# Returns the value cached for key, or default if there is none
+	def get(self, key, default = None):
+		with self.lock:
+			if key in self.entries:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return self.entries[key]
+			self.misses += 1
+			return default
+
+	def put(self, key, value):
+		if self.max_entries <= 0: return
+		with self.lock:
+			self.entries[key] = value
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	# Returns the hit/miss counters and current size
+	def info(self):
+		with self.lock:
+			return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'max_entries': self.max_entries}
@@ -0,0 +1,152 @@
+from bisect import bisect_left
+from collections import Counter
+from contextlib import nullcontext
+
+import os, sys, threading, time
+
+# Upper bounds in seconds of the stage latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Returned by Metrics.stage while disabled: entering it does nothing
+NULL_STAGE = nullcontext()
+
+# Times one stage of a query into its histogram
+class Stage(object):
+
+	__slots__ = ("metrics", "name", "start")
+
+	def __init__(self, metrics, name):
+		self.metrics = metrics
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		self.metrics.observe(self.name, time.perf_counter() - self.start)
+		return False
+
+# Per-stage latency histograms and event counters of the query path, rendered in
+# the Prometheus text format. While disabled, stage() returns NULL_STAGE and
+# count() returns at once, so the instrumentation can stay in place.
+class Metrics(object):
+
+	def __init__(self, enabled = True, prefix = "search"):
+		self.enabled = enabled
+		self.prefix = prefix
+		self.lock = threading.Lock()
+		self.stages = {} # stage -> [bucket counts..., +Inf count, sum of seconds]
+		self.counters = {} # name -> total
+		self.callbacks = [] # (name, type, help, function) evaluated when rendered
+		self.sampler = None
+
+	# Returns a context manager that times a stage of the query path, e.g.
+	#	with metrics.stage("parse"): ...
+	def stage(self, name):
+		if not self.enabled: return NULL_STAGE
+		return Stage(self, name)
+
+	# Records that a stage took seconds
+	def observe(self, name, seconds):
+		with self.lock:
+			histogram = self.stages.get(name)
+			if histogram is None: histogram = self.stages[name] = [0]*(len(BUCKETS) + 1) + [0.0]
+			histogram[bisect_left(BUCKETS, seconds)] += 1
+			histogram[-1] += seconds
+
+	def count(self, name, n = 1):
+		if not self.enabled: return
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	# Adds a metric whose value function() returns when the metrics are rendered,
+	# for values kept elsewhere (like cache counters) that cost nothing to record
+	def register(self, name, type, help, function):
+		self.callbacks.append((name, type, help, function))
+
+	# Returns {stage: (count, seconds)} and {counter: total}
+	def snapshot(self):
+		with self.lock:
+			stages = {name: (sum(h[:-1]), h[-1]) for name, h in self.stages.items()}
+			return stages, dict(self.counters)
+
+	def reset(self):
+		with self.lock:
+			self.stages.clear()
+			self.counters.clear()
+
+	# Returns the metrics in the Prometheus text exposition format
+	def render(self):
+		p = self.prefix
+		with self.lock:
+			stages = {name: list(h) for name, h in self.stages.items()}
+			counters = dict(self.counters)
+		lines = [f"# HELP {p}_stage_seconds Time spent in each stage of the query path", f"# TYPE {p}_stage_seconds histogram"]
+		for name in sorted(stages):
+			histogram = stages[name]
+			total = 0
+			for bound, n in zip(BUCKETS + (float("inf"),), histogram[:-1]):
+				total += n
+				le = "+Inf" if bound == float("inf") else repr(bound)
+				lines.append(f'{p}_stage_seconds_bucket{{stage="{name}",le="{le}"}} {total}')
+			lines.append(f'{p}_stage_seconds_sum{{stage="{name}"}} {histogram[-1]!r}')
+			lines.append(f'{p}_stage_seconds_count{{stage="{name}"}} {total}')
+		for name in sorted(counters):
+			lines += [f"# TYPE {p}_{name}_total counter", f"{p}_{name}_total {counters[name]}"]
+		for name, type, help, function in self.callbacks:
+			lines += [f"# HELP {p}_{name} {help}", f"# TYPE {p}_{name} {type}", f"{p}_{name} {function()}"]
+		return "\n".join(lines) + "\n"
+
+	# Starts sampling the stacks of every thread every interval seconds
+	def start_profiler(self, interval = 0.005):
+		if self.sampler is None:
+			self.sampler = StackSampler(interval)
+			self.sampler.start()
+
+	def stop_profiler(self):
+		if self.sampler is not None:
+			self.sampler.stop()
+			self.sampler = None
+
+	# Returns the profile sampled so far (see StackSampler.collapsed), or "" if the
+	# profiler is not running
+	def profile(self, limit = None):
+		return self.sampler.collapsed(limit) if self.sampler is not None else ""
+
+# Sampling profiler: a daemon thread that records the stack of every other thread
+# every interval seconds. Queries are not slowed down while it sleeps, and the
+# cost of a sample does not depend on what the sampled threads are doing.
+class StackSampler(threading.Thread):
+
+	def __init__(self, interval = 0.005):
+		super().__init__(name="StackSampler", daemon=True)
+		self.interval = interval
+		self.samples = Counter() # "outer;...;inner" stack -> times seen
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+
+	def run(self):
+		me = threading.get_ident()
+		while not self.stopped.wait(self.interval):
+			stacks = []
+			for thread_id, frame in sys._current_frames().items():
+				if thread_id == me: continue
+				stack = []
+				while frame is not None:
+					code = frame.f_code
+					stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+					frame = frame.f_back
+				stacks.append(";".join(reversed(stack)))
+			with self.lock:
+				self.samples.update(stacks)
+
+	def stop(self):
+		self.stopped.set()
+		self.join()
+
+	# Returns the samples as "stack count" lines, most frequent first: the collapsed
+	# format that flamegraph.pl and speedscope read
+	def collapsed(self, limit = None):
+		with self.lock:
+			return "".join(f"{stack} {n}\n" for stack, n in self.samples.most_common(limit))
@@ -2,41 +2,110 @@ import numpy as np
 import pickle
 import pandas as pd
 from scipy import sparse
-import gc
+import sys
+import time
 
-# Returns a page rank vector for a given SciPy transition matrix
-# (no added leap probability),number of links, damping factor, and epsilon threshold
-def __page_rank(L, n, d=0.85, epsilon = 0.0001):
-	p_new = np.full(n, 1/n)
-	while True:
-		p_old = p_new
-		p_new = L.dot(p_new) + ((1-d)/n)
-		if not np.any(abs(p_old-p_new) >= epsilon): return p_new
+# Returns a SciPy CSR adjacency matrix with n nodes from arrays of edge sources and
+# destinations (and optional weights, 1 by default). Repeated edges are summed.
+def from_edges(src, dst, n, weights=None, dtype=np.float64):
+	index_dtype = np.int32 if n < 2**31 else np.int64
+	src = np.asarray(src, dtype=index_dtype)
+	dst = np.asarray(dst, dtype=index_dtype)
+	if weights is None: weights = np.ones(len(src), dtype=dtype)
+	matrix = sparse.coo_matrix((np.asarray(weights, dtype=dtype), (src, dst)), shape=(n, n)).tocsr()
+	matrix.sum_duplicates()
+	return matrix
 
-# Returns a SciPy transition matrix of a SciPy adjacency matrix
-def __adjacency_to_transition_matrix(adjMatrix, d=0.85):
-	s = adjMatrix.sum(axis=1)
-	return (d*(adjMatrix/s)).T
+# Returns (CSR adjacency matrix, url list) for an edge list file with one
+# "source_url destination_url" pair per line
+def load_edge_list(path, dtype=np.float64):
+	ids = {}
+	src, dst = [], []
+	with open(path, "r", encoding="utf-8") as f:
+		for line in f:
+			parts = line.split()
+			if len(parts) != 2: continue
+			src.append(ids.setdefault(parts[0], len(ids)))
+			dst.append(ids.setdefault(parts[1], len(ids)))
+	urls = list(ids)
+	return from_edges(src, dst, len(urls), dtype=dtype), urls
 
-# Pickles a dictionary mapping url to PageRank score for a Pandas DataFrame
-def __pickle_page_rank(df_path, d=0.85, epsilon = 0.0001):
-	df = pd.read_pickle(df_path)
-	url_to_pr = {}
-	url_array = list(df.columns)
-	matrix = sparse.csr_matrix(df.values)
+# Returns (CSR adjacency matrix, url list) for an adjacency matrix csv where the first
+# line lists the URLs and each following line starts with a URL followed by its row
+def load_adjacency_csv(path, dtype=np.float64):
+	df = pd.read_csv(path, index_col=0)
+	return sparse.csr_matrix(df.values, dtype=dtype), list(df.columns)
 
-	df = None # Python can garbage collect the DataFrame
+# Returns (CSR adjacency matrix, url list) for a pickled Pandas DataFrame adjacency matrix
+def load_adjacency_dataframe(path, dtype=np.float64):
+	df = pd.read_pickle(path)
+	return sparse.csr_matrix(df.values, dtype=dtype), list(df.columns)
 
-	matrix = __adjacency_to_transition_matrix(matrix, d)
+# Returns (CSR adjacency matrix, url list) for a graph saved by the crawler as an .npz
+# file of the CSR indptr, indices, data and shape arrays and the url list. The urls
+# are newline-joined UTF-8 bytes, or a string array in older files.
+def load_npz(path, dtype=np.float64):
+	with np.load(path) as graph:
+		matrix = sparse.csr_matrix((graph["data"].astype(dtype), graph["indices"], graph["indptr"]), shape=tuple(graph["shape"]))
+		urls = graph["urls"]
+		if urls.dtype != np.uint8: return matrix, urls.tolist()
+		text = urls.tobytes().decode("utf-8")
+		return matrix, text.split("\n") if text else []
 
-	page_rank = __page_rank(matrix, matrix.shape[0], d, epsilon)
+# Returns (CSR adjacency matrix, url list) for any of the supported formats
+def load_graph(path, dtype=np.float64):
+	if path.endswith(".npz"): return load_npz(path, dtype)
+	if path.endswith(".csv"): return load_adjacency_csv(path, dtype)
+	if path.endswith(".txt"): return load_edge_list(path, dtype)
+	return load_adjacency_dataframe(path, dtype)
 
-	for i in range(matrix.shape[0]):
-		url_to_pr[url_array[i]] = float(page_rank[i])
+# Returns the transposed, row-normalized transition matrix of an adjacency matrix
+# and a mask of its dangling nodes (nodes with no outgoing links). Rows are scaled
+# in place on one copy of the matrix and the transpose is a CSC view of it.
+def transition_matrix(adj, dtype=np.float64):
+	adj = sparse.csr_matrix(adj, dtype=dtype, copy=True)
+	out_degree = np.asarray(adj.sum(axis=1)).ravel()
+	dangling = out_degree == 0
+	inverse = np.zeros_like(out_degree)
+	inverse[~dangling] = 1 / out_degree[~dangling]
+	adj.data *= np.repeat(inverse, np.diff(adj.indptr))
+	return adj.T, dangling
 
-	with open("page_rank.dat","wb") as f:
-		pickle.dump(url_to_pr,f)
+# Returns (page rank vector, stats) for a SciPy adjacency matrix, computed by power
+# iteration on the sparse transition matrix with damping factor d. The rank held by
+# dangling nodes is spread evenly over every node, so the vector always sums to 1.
+# Iteration stops once the L1 distance between iterations drops below epsilon;
+# stats holds the iteration count, the final residual and the wall time in seconds.
+def page_rank(adj, d=0.85, epsilon=1e-8, max_iter=200, dtype=np.float64, debug=False):
+	start = time.perf_counter()
+	L, dangling = transition_matrix(adj, dtype)
+	n = L.shape[0]
+	p = np.full(n, 1/n, dtype=dtype)
+	residual = float("inf")
+	iterations = 0
+	while iterations < max_iter and residual >= epsilon:
+		p_new = d*L.dot(p)
+		p_new += (d*p[dangling].sum() + (1-d)) / n
+		residual = float(np.abs(p_new - p).sum())
+		p = p_new
+		iterations += 1
+		if debug: print(f"iteration {iterations}: residual {residual:.3e}")
+	stats = {"iterations": iterations, "residual": residual, "seconds": time.perf_counter() - start}
+	return p, stats
 
-__pickle_page_rank("./sample/adjacency_matrix.dat")
+# Pickles a dictionary mapping url to PageRank score for the graph at graph_path
+def pickle_page_rank(graph_path, out_path="page_rank.dat", d=0.85, epsilon=1e-8):
+	adj, urls = load_graph(graph_path)
+	scores, stats = page_rank(adj, d, epsilon)
+	print(f"PageRank of {len(urls)} pages and {adj.nnz} links: {stats['iterations']} iterations, residual {stats['residual']:.3e}, {stats['seconds']:.3f}s")
+	url_to_pr = {url: float(score) for url, score in zip(urls, scores)}
+	with open(out_path, "wb") as f:
+		pickle.dump(url_to_pr, f)
 
+def main():
+	graph_path = sys.argv[1] if len(sys.argv) > 1 else "./sample/adjacency_matrix.csv"
+	out_path = sys.argv[2] if len(sys.argv) > 2 else "page_rank.dat"
+	pickle_page_rank(graph_path, out_path)
 
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,52 @@
+from contextlib import contextmanager
+
+import queue, threading
+
+# A bounded pool of reusable Whoosh searchers.
+# A Whoosh searcher must only be used by one thread at a time, so each query
+# borrows a searcher for its duration and hands it back afterwards. Searchers
+# are opened on demand up to size; once size are in use, callers wait.
+class SearcherPool(object):
+
+	# new_searcher is called with no arguments to open a searcher
+	def __init__(self, new_searcher, size = 8):
+		self.new_searcher = new_searcher
+		self.size = size
+		self.idle = queue.LifoQueue()
+		self.opened = 0
+		self.lock = threading.Lock()
+
+	# Borrows a searcher for a with block
+	@contextmanager
+	def searcher(self):
+		searcher = self.__acquire()
+		try:
+			yield searcher
+		finally:
+			self.idle.put(searcher)
+
+	def __acquire(self):
+		try:
+			return self.idle.get_nowait()
+		except queue.Empty:
+			pass
+		with self.lock:
+			can_open = self.opened < self.size
+			if can_open: self.opened += 1
+		if can_open:
+			try:
+				return self.new_searcher()
+			except Exception:
+				with self.lock: self.opened -= 1
+				raise
+		return self.idle.get()
+
+	# Closes every idle searcher
+	def close(self):
+		while True:
+			try:
+				searcher = self.idle.get_nowait()
+			except queue.Empty:
+				return
+			with self.lock: self.opened -= 1
+			searcher.close()
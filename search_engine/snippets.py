@@ -0,0 +1,87 @@
+from functools import lru_cache
+
+import html, re, zlib
+
+SPACE_RE = re.compile(r"\s+")
+EXCERPT_CHARS = 8192 # Characters of each document kept for its snippet
+
+# Returns the first max_chars characters of content, whitespace collapsed,
+# compressed for the stored excerpt field
+def make_excerpt(content, max_chars = EXCERPT_CHARS, level = 6):
+	return zlib.compress(SPACE_RE.sub(" ", content).strip()[:max_chars].encode("utf-8"), level)
+
+def read_excerpt(excerpt):
+	return zlib.decompress(excerpt).decode("utf-8")
+
+# Renders result snippets: the window of about max_chars characters of a
+# document's excerpt holding the most query terms, escaped for HTML, with the
+# words that match a term in <b> tags.
+#
+# Words are matched through analyzer (the content field's), so "animation" and
+# "animated" both match the term "anim". Only the words starting with a prefix of
+# a term are analyzed, since stemming never changes the start of a word (the
+# last letter of a stem can be a changed "y", so that letter is left out), and
+# analyzed words are cached across snippets.
+class SnippetMaker(object):
+
+	def __init__(self, analyzer, max_chars = 240, cache_size = 65536):
+		self.max_chars = max_chars
+		self.analyze = lru_cache(maxsize=cache_size)(lambda word: frozenset(token.text for token in analyzer(word)))
+		self.patterns = lru_cache(maxsize=1024)(self.__pattern)
+
+	# Returns a regex matching the words that may analyze to one of terms
+	@staticmethod
+	def __pattern(terms):
+		prefixes = sorted({term[:-1] if len(term) > 2 else term for term in terms}, key=len, reverse=True)
+		return re.compile(r"\b(?:" + "|".join(map(re.escape, prefixes)) + r")\w*", re.IGNORECASE)
+
+	# Returns [(start, end, term)] of the words of text that analyze to one of terms
+	def __matches(self, text, terms):
+		matches = []
+		for match in self.patterns(terms).finditer(text):
+			found = self.analyze(match.group()) & terms
+			if found: matches.append((match.start(), match.end(), min(found)))
+		return matches
+
+	# Returns (start, end) of the window of at most max_chars characters starting at
+	# a match that holds the most distinct terms, then the most matches
+	def __best_window(self, matches):
+		best, best_score = (0, 0), None
+		hi = 0
+		for lo in range(len(matches)):
+			hi = max(hi, lo)
+			while hi + 1 < len(matches) and matches[hi + 1][1] - matches[lo][0] <= self.max_chars: hi += 1
+			window = matches[lo:hi + 1]
+			score = (len({term for _, _, term in window}), len(window))
+			if best_score is None or score > best_score: best, best_score = (lo, hi), score
+		return best
+
+	# Returns the HTML snippet of the document whose stored excerpt is excerpt for
+	# the frozenset of analyzed query terms, the start of the excerpt if no term
+	# occurs in it
+	def snippet(self, excerpt, terms):
+		text = read_excerpt(excerpt)
+		matches = self.__matches(text, terms) if terms else []
+		if matches:
+			lo, hi = self.__best_window(matches)
+			matches = matches[lo:hi + 1]
+			# Center the matches in the window, on word boundaries
+			slack = max(0, self.max_chars - (matches[-1][1] - matches[0][0]))
+			start = max(0, matches[0][0] - slack // 2)
+			if start > 0: start = text.find(" ", start, matches[0][0]) + 1 or start
+		else:
+			start = 0
+		end = min(len(text), start + self.max_chars)
+		if end < len(text):
+			cut = text.rfind(" ", matches[-1][1] if matches else start, end)
+			if cut > start: end = cut
+		parts = ["... "] if start > 0 else []
+		position = start
+		for match_start, match_end, _ in matches:
+			if match_end > end: break
+			parts.append(html.escape(text[position:match_start]))
+			parts.append(f"<b>{html.escape(text[match_start:match_end])}</b>")
+			position = match_end
+		parts.append(html.escape(text[position:end]))
+		if end < len(text): parts.append(" ...")
+		return "".join(parts)
@@ -0,0 +1,151 @@
+from array import array
+from collections import Counter
+
+import Levenshtein
+import numpy as np
+import os, pickle, re, zlib
+
+try:
+	from .snippets import read_excerpt
+except ImportError:
+	from snippets import read_excerpt
+
+WORD_RE = re.compile(r"\w+")
+# Query syntax that is not a search word
+OPERATORS = {"AND", "OR", "NOT", "ANDNOT", "ANDMAYBE", "TO"}
+# Saved with every Lexicon, and changed whenever the words it holds change meaning
+LEXICON_VERSION = 2
+
+# Returns the strings made of word by deleting up to distance characters
+def deletes(word, distance):
+	found = {word}
+	edge = {word}
+	for _ in range(distance):
+		edge = {w[:i] + w[i + 1:] for w in edge for i in range(len(w))}
+		found |= edge
+	return found
+
+# Returns how many edits away a correction of word may be: one for words of up to
+# five characters, two for longer ones
+def max_distance(word):
+	return 1 if len(word) <= 5 else 2
+
+# Spelling correction against the words of the index, each with a frequency.
+#
+# Lookups use a symmetric deletion index (as in SymSpell): every word is filed
+# under the strings made by deleting up to distance characters from its first
+# prefix_length characters, and a misspelled word only needs to be compared with
+# the words filed under its own deletions. Deletion strings are kept as their
+# CRC-32 in one sorted array, so the index is two flat arrays however large the
+# vocabulary; hash collisions only add candidates, which are all checked with
+# Levenshtein.distance.
+class Lexicon(object):
+
+	def __init__(self, words, frequencies, distance = 2, prefix_length = 7):
+		self.words = list(words)
+		self.index = {word: i for i, word in enumerate(self.words)}
+		self.frequencies = np.asarray(frequencies, dtype=np.int64)
+		self.distance = distance
+		self.prefix_length = prefix_length
+		self.version = LEXICON_VERSION
+		hashes, ids = array("I"), array("i")
+		for i, word in enumerate(self.words):
+			for d in deletes(word[:prefix_length], distance):
+				hashes.append(zlib.crc32(d.encode()))
+				ids.append(i)
+		hashes = np.frombuffer(hashes, dtype=np.uint32)
+		order = np.argsort(hashes, kind="stable")
+		self.hashes = hashes[order]
+		self.ids = np.frombuffer(ids, dtype=np.int32)[order]
+
+	# Returns [(word, distance, frequency)] of the words within distance edits of
+	# word (max_distance(word) by default), closest and then most frequent first
+	def candidates(self, word, distance = None):
+		word = word.lower()
+		if distance is None: distance = min(self.distance, max_distance(word))
+		keys = np.fromiter((zlib.crc32(d.encode()) for d in deletes(word[:self.prefix_length], distance)), dtype=np.uint32)
+		starts = np.searchsorted(self.hashes, keys, "left")
+		ends = np.searchsorted(self.hashes, keys, "right")
+		ids = np.unique(np.concatenate([self.ids[s:e] for s, e in zip(starts.tolist(), ends.tolist())]))
+		found = []
+		for i in ids.tolist():
+			d = Levenshtein.distance(word, self.words[i], score_cutoff=distance)
+			if d <= distance: found.append((self.words[i], d, int(self.frequencies[i])))
+		found.sort(key=lambda c: (c[1], -c[2]))
+		return found
+
+	# Returns the best correction of word, word itself if it is in the lexicon, or
+	# None if nothing is close enough
+	def correct(self, word):
+		word = word.lower()
+		if word in self.index: return word
+		found = self.candidates(word)
+		return found[0][0] if found else None
+
+	def __contains__(self, word):
+		return word.lower() in self.index
+
+	def __len__(self):
+		return len(self.words)
+
+	# Saves the fields as plain data, so the file loads whether this module was
+	# imported as spelling or search_engine.spelling
+	def save(self, path):
+		# Write then rename so other processes never load a half written file
+		tmp_path = f"{path}.{os.getpid()}.tmp"
+		state = dict(vars(self))
+		del state["index"]
+		with open(tmp_path, "wb") as f:
+			pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, path)
+
+	# Returns the Lexicon saved at path, or None if it was saved by an older version
+	@staticmethod
+	def load(path):
+		with open(path, "rb") as f:
+			state = pickle.load(f)
+		if state.get("version") != LEXICON_VERSION: return None
+		lexicon = Lexicon.__new__(Lexicon)
+		vars(lexicon).update(state)
+		lexicon.index = {word: i for i, word in enumerate(lexicon.words)}
+		return lexicon
+
+	# Builds the Lexicon of the searchable words of reader. The content field is
+	# stemmed, so its terms ("produc") are not offered as corrections: the words are
+	# the unstemmed words of the stored titles and excerpts whose content term is in
+	# the index. A word's frequency is the document frequency of its content term
+	# plus the number of documents it is written in, so of the words sharing a stem
+	# the most common spelling wins ties ("producer" rather than "producers").
+	@staticmethod
+	def from_reader(reader, distance = 2, prefix_length = 7):
+		content = {}
+		field = reader.schema["content"]
+		for term, info in reader.iter_field("content"):
+			term = field.from_bytes(term)
+			if not term.isdigit(): content[term] = info.doc_frequency()
+		# Documents each word is written in; indexes older than the excerpt field only have titles
+		written = Counter()
+		for _, fields in reader.iter_docs():
+			text = fields.get("title") or ""
+			if fields.get("excerpt"): text += " " + read_excerpt(fields["excerpt"])
+			written.update(set(WORD_RE.findall(text.lower())))
+		frequencies = {}
+		for word, count in written.items():
+			if word.isdigit(): continue
+			stems = [token.text for token in field.analyzer(word)]
+			if len(stems) == 1 and stems[0] in content:
+				frequencies[word] = content[stems[0]] + count
+		words = sorted(frequencies)
+		return Lexicon(words, [frequencies[w] for w in words], distance, prefix_length)
+
+# Returns query_string with each word whose content term occurs in no document
+# replaced by its correction in lexicon, keeping the query syntax (phrases,
+# operators, field names) as it is. is_known(word) tells if word needs no
+# correction (stop words, for instance, are never searched for).
+def correct_query(query_string, lexicon, is_known):
+	def replace(match):
+		word = match.group()
+		if word in OPERATORS or query_string[match.end():match.end() + 1] == ":": return word
+		if word.isdigit() or is_known(word): return word
+		return lexicon.correct(word) or word
+	return WORD_RE.sub(replace, query_string)
@@ -0,0 +1,130 @@
+from bisect import bisect_left
+from whoosh.analysis import RegexTokenizer, LowercaseFilter
+
+import numpy as np
+import os, pickle, re
+
+SPACE_RE = re.compile(r"\s+")
+WORDS = RegexTokenizer() | LowercaseFilter()
+
+# Returns text lowercased with runs of whitespace collapsed, the form suggestions are matched in
+def normalize(text):
+	return SPACE_RE.sub(" ", text.lower()).strip()
+
+# Returns titles without the trailing " - ..." segments (e.g. the site name) that
+# at least a common fraction of them end with
+def strip_common_suffixes(titles, common = 0.5):
+	titles = [title.strip() for title in titles]
+	while titles:
+		counts = {}
+		for title in titles:
+			if " - " in title:
+				suffix = title[title.rindex(" - "):]
+				counts[suffix] = counts.get(suffix, 0) + 1
+		suffix, count = max(counts.items(), key=lambda item: item[1], default=(None, 0))
+		if count < common*len(titles): break
+		titles = [title[:-len(suffix)] if title.endswith(suffix) else title for title in titles]
+	return titles
+
+# Prefix completions of query strings, each with a weight:
+#	titles of indexed documents, weighted by the PageRank of the document
+#	words of the titles, weighted by the total PageRank of the documents whose
+#	content contains them (titles are unstemmed, so they spell the content terms)
+#
+# Keys are kept sorted, so the keys starting with a prefix are one bisected range.
+# Prefixes shared by more than scan_limit keys have their top suggestions stored,
+# so a lookup never ranks more than scan_limit weights.
+class Suggester(object):
+
+	def __init__(self, keys, displays, weights, top_k = 10, scan_limit = 256):
+		order = sorted(range(len(keys)), key=keys.__getitem__)
+		self.keys = [keys[i] for i in order]
+		self.displays = [displays[i] for i in order]
+		self.weights = np.asarray(weights, dtype=np.float64)[order]
+		self.top_k = top_k
+		self.scan_limit = scan_limit
+		self.top = {} # prefix -> indexes of its top_k keys by weight
+		self.__build_top()
+
+	# Stores the top suggestions of every prefix of more than scan_limit keys.
+	# Such a prefix is a prefix of every scan_limit-th key, so only those are walked.
+	def __build_top(self):
+		for i in range(0, len(self.keys), self.scan_limit):
+			key = self.keys[i]
+			for length in range(1, len(key) + 1):
+				prefix = key[:length]
+				if prefix in self.top: continue
+				lo, hi = self.__range(prefix)
+				if hi - lo <= self.scan_limit: break
+				self.top[prefix] = self.__best(lo, hi)
+
+	def __range(self, prefix):
+		return bisect_left(self.keys, prefix), bisect_left(self.keys, prefix + "\uffff")
+
+	# Returns the indexes of the top_k weights in [lo, hi), best first
+	def __best(self, lo, hi):
+		weights = self.weights[lo:hi]
+		if hi - lo > self.top_k:
+			best = np.argpartition(-weights, self.top_k)[:self.top_k]
+		else:
+			best = np.arange(hi - lo)
+		best = best[np.argsort(-weights[best], kind="stable")]
+		return (best + lo).tolist()
+
+	# Returns up to limit (from 1 to top_k) suggestions for prefix, best first
+	def suggest(self, prefix, limit = 10):
+		prefix = normalize(prefix)
+		if not prefix: return []
+		limit = min(max(limit, 1), self.top_k)
+		best = self.top.get(prefix)
+		if best is None: best = self.__best(*self.__range(prefix))
+		return [self.displays[i] for i in best[:limit]]
+
+	def __len__(self):
+		return len(self.keys)
+
+	# Saves the fields as plain data, so the file loads whether this module was
+	# imported as suggest or search_engine.suggest
+	def save(self, path):
+		# Write then rename so other processes never load a half written file
+		tmp_path = f"{path}.{os.getpid()}.tmp"
+		with open(tmp_path, "wb") as f:
+			pickle.dump(vars(self), f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, path)
+
+	@staticmethod
+	def load(path):
+		suggester = Suggester.__new__(Suggester)
+		with open(path, "rb") as f:
+			vars(suggester).update(pickle.load(f))
+		return suggester
+
+	# Builds a Suggester from the stored titles and content terms of reader, where
+	# pr_array holds the PageRank of every docnum. The " - ..." suffixes most titles
+	# share (like the site name) are left out. Titles of at most max_title_chars
+	# characters are suggested whole, and title words whose content term occurs in
+	# fewer than min_df documents are left out.
+	@staticmethod
+	def from_reader(reader, pr_array, top_k = 10, scan_limit = 256, min_df = 2, max_title_chars = 80):
+		entries = {} # key -> [weight, display]
+		words = set()
+		docs = [(docnum, fields["title"]) for docnum, fields in reader.iter_docs() if fields.get("title")]
+		for (docnum, _), title in zip(docs, strip_common_suffixes(title for _, title in docs)):
+			pr = float(pr_array[docnum])
+			key = normalize(title)
+			if len(key) <= max_title_chars:
+				entry = entries.get(key)
+				if entry is None: entries[key] = [pr, title]
+				elif pr > entry[0]: entry[0] = pr
+			words.update(token.text for token in WORDS(title) if len(token.text) > 1)
+		analyzer = reader.schema["content"].analyzer
+		for word in words:
+			stems = [token.text for token in analyzer(word)]
+			if not stems or reader.doc_frequency("content", stems[0]) < min_df: continue
+			docnums = np.fromiter(reader.postings("content", stems[0]).all_ids(), dtype=np.int64)
+			weight = float(pr_array[docnums].sum())
+			entry = entries.get(word)
+			if entry is None: entries[word] = [weight, word]
+			else: entry[0] = max(entry[0], weight)
+		keys = list(entries)
+		return Suggester(keys, [entries[k][1] for k in keys], [entries[k][0] for k in keys], top_k, scan_limit)
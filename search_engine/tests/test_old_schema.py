@@ -0,0 +1,67 @@
+from whoosh.index import create_in
+from whoosh.fields import Schema, TEXT, ID
+from whoosh.analysis import StemmingAnalyzer
+
+import os, pickle, sys
+
+SEARCH_ENGINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SEARCH_ENGINE_DIR)
+
+from anime_search_engine import SearchEngine
+from ingest import read_document
+
+SAMPLE_DIR = os.path.join(SEARCH_ENGINE_DIR, "sample")
+DOCS_RAW_DIR = os.path.join(SAMPLE_DIR, "_docs_raw") + "/"
+DOCS_CLEANED_DIR = os.path.join(SAMPLE_DIR, "_docs_cleaned") + "/"
+# The schema indexes were built with before page_rank, content_hash and excerpt were added
+OLD_SCHEMA = Schema(title=TEXT(stored=True), url = ID(stored=True), content=TEXT(analyzer=StemmingAnalyzer()))
+
+# Writes an index of the first n sample documents with OLD_SCHEMA, their url map
+# and a PageRank file into tmp_path, and returns the SearchEngine arguments for them
+def old_index(tmp_path, n = 20):
+	with open(os.path.join(SAMPLE_DIR, "url_map.dat"), "rb") as f:
+		urls = dict(list(pickle.load(f).items())[:n])
+	index_dir = str(tmp_path / "indexdir")
+	os.mkdir(index_dir)
+	writer = create_in(index_dir, OLD_SCHEMA).writer()
+	for u, doc in urls.items():
+		_, title, content, _ = read_document((u, doc, DOCS_RAW_DIR, DOCS_CLEANED_DIR, None))
+		writer.add_document(title=title, url=u, content=content)
+	writer.commit()
+	url_map_file = str(tmp_path / "url_map.dat")
+	page_rank_file = str(tmp_path / "page_rank.dat")
+	with open(url_map_file, "wb") as f:
+		pickle.dump(urls, f)
+	with open(page_rank_file, "wb") as f:
+		pickle.dump({u: (i + 1) / len(urls) for i, u in enumerate(urls)}, f)
+	return {'index_dir': index_dir, 'page_rank_file': page_rank_file, 'url_map_file': url_map_file,
+		'docs_raw_dir': DOCS_RAW_DIR, 'docs_cleaned_dir': DOCS_CLEANED_DIR, 'doc_store_dir': str(tmp_path / "_docs") + "/", 'index_procs': 1}
+
+def test_search_old_schema(tmp_path):
+	engine = SearchEngine(**old_index(tmp_path))
+	try:
+		assert engine.size == 20
+		results = engine.search("anime")
+		assert results['total'] > 0
+		# Without a stored excerpt there is nothing to make a snippet from
+		assert all(doc['snippet'] == "" for doc in results['docs'])
+	finally:
+		engine.close_searcher()
+
+def test_update_old_schema(tmp_path):
+	args = old_index(tmp_path)
+	with open(args['url_map_file'], "rb") as f:
+		urls = pickle.load(f)
+	# Drop one url so the update has a deletion to commit
+	del urls[next(iter(urls))]
+	with open(args['url_map_file'], "wb") as f:
+		pickle.dump(urls, f)
+	engine = SearchEngine(**args)
+	try:
+		counts = engine.update_index()
+		assert counts['deleted'] == 1 and counts['added'] == 0
+		# Documents indexed without a content_hash are always reindexed
+		assert counts['updated'] == 19
+		assert engine.search("anime")['total'] > 0
+	finally:
+		engine.close_searcher()
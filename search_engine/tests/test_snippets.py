@@ -0,0 +1,29 @@
+import html, os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from whoosh.analysis import StemmingAnalyzer
+from snippets import SnippetMaker, make_excerpt, read_excerpt
+
+ANALYZER = StemmingAnalyzer()
+
+# Returns the frozenset of analyzed terms of a query string
+def terms(query):
+	return frozenset(token.text for token in ANALYZER(query))
+
+def test_excerpt():
+	content = "Tokyo   Ghoul\n\tis an  anime " * 1000
+	excerpt = read_excerpt(make_excerpt(content, max_chars=100))
+	assert excerpt == ("Tokyo Ghoul is an anime " * 5)[:100]
+
+def test_snippet():
+	maker = SnippetMaker(ANALYZER, max_chars=60)
+	text = "Filler words come first. " * 20 + "The studio animated <Tokyo Ghoul> & other series. " + "More filler at the end. " * 20
+	snippet = maker.snippet(make_excerpt(text), terms("animated studios"))
+	# The window holding both terms, with words matching their stems in bold, escaped for HTML
+	assert snippet.startswith("... ") and snippet.endswith(" ...")
+	assert "The <b>studio</b> <b>animated</b> &lt;Tokyo Ghoul&gt; &amp;" in snippet
+	text_shown = html.unescape(snippet.replace("<b>", "").replace("</b>", ""))
+	assert len(text_shown[len("... "):-len(" ...")]) <= 60
+	# Without a match the snippet is the start of the document
+	assert maker.snippet(make_excerpt(text), terms("naruto")) == "Filler words come first. Filler words come first. Filler ..."
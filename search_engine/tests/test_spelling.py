@@ -0,0 +1,36 @@
+import os, pickle, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from spelling import Lexicon, correct_query
+
+LEXICON = Lexicon(["animation", "animated", "producer", "produce", "studio", "studios", "ghoul", "goal"], [40, 30, 20, 5, 50, 10, 8, 2])
+
+def test_correct():
+	assert LEXICON.correct("Producr") == "producer"
+	assert LEXICON.correct("animaton") == "animation"
+	# Equally close, so the more frequent word wins
+	assert LEXICON.correct("studi") == "studio"
+	# Words of up to five characters are corrected one edit away at most
+	assert LEXICON.correct("ghuol") is None and LEXICON.correct("ghol") == "ghoul"
+	assert LEXICON.correct("studio") == "studio" and LEXICON.correct("xyzzy") is None
+
+def test_correct_query():
+	known = lambda word: word.lower() in LEXICON
+	# Operators and field names are kept as they are
+	assert correct_query('"animaton studo" OR title:producr', LEXICON, known) == '"animation studio" OR title:producer'
+	assert correct_query("studo AND NOT ghol", LEXICON, known) == "studio AND NOT ghoul"
+	assert correct_query("studio 2024 xyzzy", LEXICON, known) == "studio 2024 xyzzy"
+
+def test_save_load(tmp_path):
+	path = str(tmp_path / "lexicon.pkl")
+	LEXICON.save(path)
+	lexicon = Lexicon.load(path)
+	assert lexicon.correct("producr") == "producer" and len(lexicon) == len(LEXICON)
+	# Lexicons saved by an older version are rebuilt rather than used
+	with open(path, "rb") as f:
+		state = pickle.load(f)
+	del state["version"]
+	with open(path, "wb") as f:
+		pickle.dump(state, f)
+	assert Lexicon.load(path) is None
@@ -0,0 +1,30 @@
+import os, random, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from suggest import Suggester, strip_common_suffixes
+
+def test_suggest():
+	rng = random.Random(0)
+	keys = [f"{a}{b}{c}" for a in "abc" for b in "abcdefgh" for c in "abcdefgh"]
+	weights = [rng.random() for _ in keys]
+	# Small enough that the prefixes of one letter have their suggestions stored
+	suggester = Suggester(keys, [key.upper() for key in keys], weights, top_k=5, scan_limit=16)
+	assert "a" in suggester.top
+	for prefix in ("a", "ab", "abc", "c"):
+		best = sorted((k for k in keys if k.startswith(prefix)), key=lambda k: -weights[keys.index(k)])[:5]
+		assert suggester.suggest(prefix) == [key.upper() for key in best]
+	assert suggester.suggest(" AB ", 2) == suggester.suggest("ab")[:2]
+	# Limits are clamped to 1..top_k
+	assert len(suggester.suggest("a", -1)) == 1 and len(suggester.suggest("a", 50)) == 5
+	assert suggester.suggest("z") == [] and suggester.suggest("  ") == []
+
+def test_save_load(tmp_path):
+	suggester = Suggester(["tokyo ghoul", "tokyo", "toradora"], ["Tokyo Ghoul", "tokyo", "Toradora!"], [0.5, 0.9, 0.1])
+	path = str(tmp_path / "suggest.pkl")
+	suggester.save(path)
+	assert Suggester.load(path).suggest("to") == ["tokyo", "Tokyo Ghoul", "Toradora!"]
+
+def test_strip_common_suffixes():
+	titles = ["Naruto - Anime - MyAnimeList.net", "Madhouse - Companies - MyAnimeList.net", "Top Anime"]
+	assert strip_common_suffixes(titles) == ["Naruto - Anime", "Madhouse - Companies", "Top Anime"]
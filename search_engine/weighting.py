@@ -0,0 +1,92 @@
+from whoosh import scoring
+
+import numpy as np
+import threading
+
+# Weighting model that blends a document's PageRank with its BM25F term score:
+#	a*pr + b*bm25
+# PageRank is read from a dense array indexed by the top level docnum, so no
+# stored field or dictionary lookup happens while scoring a posting.
+class PageRankBM25F(scoring.WeightingModel):
+
+	def __init__(self, page_rank, a = 100000, b = 1.5, B = 0.75, K1 = 1.2):
+		self.page_rank = np.asarray(page_rank, dtype=np.float64)
+		self.a = a # Most PageRank is 1E-6 place
+		self.b = b
+		self.bm25f = scoring.BM25F(B=B, K1=K1)
+		self.max_page_rank = float(self.page_rank.max()) if len(self.page_rank) else 0.0
+		# Setting tally.postings = [0] on a thread counts the postings its searches score
+		self.tally = threading.local()
+
+	def supports_block_quality(self):
+		return True
+
+	# Returns a scorer for one term, built once and reused for every posting of that term
+	def scorer(self, searcher, fieldname, text, qf = 1):
+		bm25 = self.bm25f.scorer(searcher, fieldname, text, qf=qf)
+		# Sub-searchers of a multi-segment index number their documents from 0,
+		# so shift into the top level docnum space with a view of the array
+		offset = 0
+		if searcher.has_parent():
+			offset = searcher.get_parent()._offset_for_subsearcher(searcher)
+		scorer = PageRankBM25FScorer(self.page_rank[offset:], self.max_page_rank, bm25, self.a, self.b)
+		postings = getattr(self.tally, "postings", None)
+		return scorer if postings is None else CountingScorer(scorer, postings)
+
+
+class PageRankBM25FScorer(scoring.BaseScorer):
+
+	def __init__(self, page_rank, max_page_rank, bm25, a, b):
+		self.page_rank = page_rank
+		self.bm25 = bm25
+		self.a = a
+		self.b = b
+		# The PageRank half of the score is bounded by the best page in the index
+		self.pr_quality = a*max_page_rank
+
+	def supports_block_quality(self):
+		return self.bm25.supports_block_quality()
+
+	def score(self, matcher):
+		return self.a*self.page_rank[matcher.id()] + self.b*self.bm25.score(matcher)
+
+	def max_quality(self):
+		return self.pr_quality + self.b*self.bm25.max_quality()
+
+	def block_quality(self, matcher):
+		return self.pr_quality + self.b*self.bm25.block_quality(matcher)
+
+
+# BM25F, for the "rerank" and "static" modes, whose scorers count postings on a
+# thread with tally.postings set like PageRankBM25F's do
+class CountingBM25F(scoring.BM25F):
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.tally = threading.local()
+
+	def scorer(self, searcher, fieldname, text, qf = 1):
+		scorer = super().scorer(searcher, fieldname, text, qf=qf)
+		postings = getattr(self.tally, "postings", None)
+		return scorer if postings is None else CountingScorer(scorer, postings)
+
+
+# Wraps a scorer to add the number of postings it scores to postings[0]
+class CountingScorer(scoring.BaseScorer):
+
+	def __init__(self, scorer, postings):
+		self.scorer = scorer
+		self.postings = postings
+
+	def supports_block_quality(self):
+		return self.scorer.supports_block_quality()
+
+	def score(self, matcher):
+		self.postings[0] += 1
+		return self.scorer.score(matcher)
+
+	def max_quality(self):
+		return self.scorer.max_quality()
+
+	def block_quality(self, matcher):
+		return self.scorer.block_quality(matcher)